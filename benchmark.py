@@ -0,0 +1,661 @@
+#! /usr/bin/env python3
+
+import configparser
+import contextlib
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import findDuplicates
+import lib
+from debug import Debug
+from fileTable import FileTable
+from resultWriters import new_result_writer
+from scanDirectory import ScanDirectory
+from settings import Settings
+from stageTimers import StageTimers
+
+
+USAGE = """benchmark.py COMMAND [options]
+
+Commands:
+    hashes    Report the throughput (MB/s) of each hash algorithm on this
+              machine.
+    mmap      Compare the throughput (MB/s) of buffered reads against memory
+              mapping when checksumming files of several sizes.
+    memory    Report the memory used per file by the table that stores the
+              results of a scan, against the dictionaries of lists that were
+              used before it.
+    generate  Build a synthetic source and target tree under --tree, which
+              must not exist yet.
+    suite     Time the scan, the hashing helpers and the compare on a synthetic
+              tree (built under --tree first, unless it already exists)."""
+
+HASH_ALGORITHMS = ["md5", "sha1", "sha256", "blake2b", "blake2s"]
+
+MMAP_FILE_SIZES_MB = [1, 16, 128, 512]
+
+
+# ------------------------------------------------------------------------------
+def benchmark_hashes(algorithms, size_mb=64, digest_size=0, repeat=3):
+    """
+    Times how fast each hash algorithm can digest an in-memory buffer. The
+    buffer is fed to the hash in the same sized chunks that lib.full_checksum
+    reads from disk, so the numbers reflect the cost of the hashing itself
+    without any I/O.
+
+    :param algorithms: A list of hashlib algorithm names.
+    :param size_mb: The size of the buffer to hash in megabytes. Defaults to 64.
+    :param digest_size: The digest size in bytes for the algorithms that
+           support it (blake2). If 0, the default size is used. Defaults to 0.
+    :param repeat: How many times to hash the buffer. The fastest time is kept.
+           Defaults to 3.
+
+    :return: A list of dictionaries, one per algorithm, holding the algorithm
+             name, the digest size, and the throughput in MB/s.
+    """
+
+    data = os.urandom(size_mb * 1024 * 1024)
+    view = memoryview(data)
+
+    output = list()
+    for algorithm in algorithms:
+
+        # Algorithms that do not support a digest size use their default.
+        size = digest_size if algorithm.startswith("blake2") else 0
+
+        best = None
+        for _ in range(repeat):
+            hash_obj = lib.new_hash(algorithm, size)
+            chunk_size = 128 * hash_obj.block_size
+            start = time.perf_counter()
+            for offset in range(0, len(data), chunk_size):
+                hash_obj.update(view[offset:offset + chunk_size])
+            hash_obj.hexdigest()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        output.append({
+            "algorithm": algorithm,
+            "digest_size": size if size else hash_obj.digest_size,
+            "mb_per_sec": round(size_mb / best, 1),
+        })
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def benchmark_mmap(sizes_mb, algorithm="md5", work_dir=None, repeat=3):
+    """
+    Times checksumming files of several sizes with buffered reads and with
+    memory mapping. Each file is checksummed once before timing so that both
+    methods read it from the page cache, which isolates the cost of the reads
+    themselves (syscalls and copies) from the speed of the disk.
+
+    :param sizes_mb: A list of file sizes in megabytes.
+    :param algorithm: The hashlib algorithm to use. Defaults to md5.
+    :param work_dir: The directory to write the test files to. If None, the
+           system temp directory is used. Defaults to None.
+    :param repeat: How many times to checksum each file with each method. The
+           fastest time is kept. Defaults to 3.
+
+    :return: A list of dictionaries, one per file size, holding the size and
+             the throughput of each method in MB/s.
+    """
+
+    output = list()
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+
+        for size_mb in sizes_mb:
+
+            file_path = os.path.join(temp_dir, str(size_mb) + ".bin")
+            with open(file_path, "wb") as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+
+            result = {"size_mb": size_mb}
+            methods = [("buffered_mb_per_sec", 0), ("mmap_mb_per_sec", 1)]
+            for name, mmap_threshold in methods:
+                lib.full_checksum(file_path, algorithm, 0, mmap_threshold)
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    lib.full_checksum(file_path, algorithm, 0, mmap_threshold)
+                    elapsed = time.perf_counter() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                result[name] = round(size_mb / best, 1)
+
+            os.remove(file_path)
+            output.append(result)
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def synthetic_listings(file_count, files_per_dir=100):
+    """
+    Builds directory listings for a made up tree of files, in the same form as
+    ScanDirectory.list_dir returns them, without touching the disk. Names are
+    reused across directories the way they are in real trees (every project
+    having its own "render_0001.exr"), and the directories are nested a few
+    levels deep under a common root.
+
+    :param file_count: The number of files to build.
+    :param files_per_dir: The number of files in each directory. Defaults to
+           100.
+
+    :return: A list of tuples of the directory and its list of files.
+    """
+
+    output = list()
+    for dir_number in range((file_count + files_per_dir - 1) // files_per_dir):
+        dir_path = os.path.join("/mnt/projects",
+                                "show_" + str(dir_number // 1000),
+                                "shot_" + str(dir_number // 10),
+                                "take_" + str(dir_number))
+        files = list()
+        for file_number in range(min(files_per_dir,
+                                     file_count - dir_number * files_per_dir)):
+            file_name = "render_" + str(file_number).rjust(4, "0") + ".exr"
+            file_id = dir_number * files_per_dir + file_number
+            files.append((file_name, os.path.join(dir_path, file_name),
+                          1000000 + file_id % 50000, 2049, 1000000 + file_id,
+                          1600000000000000000 + file_id))
+        output.append((dir_path, files))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def benchmark_memory(file_count, files_per_dir=100):
+    """
+    Measures the memory each file costs once a scan has stored it. The same
+    synthetic listings are loaded into a FileTable, into a dictionary of lists
+    keyed on path (the way source directories used to be stored) and into a
+    dictionary of lists of lists keyed on size (the way target directories used
+    to be stored). The listings are built fresh for each method and freed once
+    they are loaded, so what is counted is only the memory that is still held
+    afterwards.
+
+    :param file_count: The number of files to store.
+    :param files_per_dir: The number of files in each directory. Defaults to
+           100.
+
+    :return: A list of dictionaries, one per storage method, holding the name of
+             the method, the total memory used in megabytes and the memory used
+             per file in bytes.
+    """
+
+    # ----------------------------------------------------------------------
+    def by_path(listings):
+        items = dict()
+        for dir_path, files in listings:
+            for file_name, file_path, file_size, st_dev, st_ino, st_mtime_ns \
+                    in files:
+                items[file_path] = [file_name, file_size, st_dev, st_ino,
+                                    st_mtime_ns]
+        return items
+
+    # ----------------------------------------------------------------------
+    def by_size(listings):
+        items = dict()
+        for dir_path, files in listings:
+            for file_name, file_path, file_size, st_dev, st_ino, st_mtime_ns \
+                    in files:
+                items.setdefault(file_size, list()).append(
+                    [file_path, file_size, st_dev, st_ino, st_mtime_ns])
+        return items
+
+    # ----------------------------------------------------------------------
+    def file_table(listings):
+        table = FileTable()
+        for dir_path, files in listings:
+            table.add_dir(dir_path, files)
+        table.build_size_index()
+        return table
+
+    output = list()
+    methods = [("dict_by_path", by_path),
+               ("dict_by_size", by_size),
+               ("file_table", file_table)]
+    for name, function in methods:
+
+        tracemalloc.start()
+        listings = synthetic_listings(file_count, files_per_dir)
+        result = function(listings)
+        del listings
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+
+        output.append({
+            "method": name,
+            "files": file_count,
+            "total_mb": round(used / (1024 * 1024), 1),
+            "bytes_per_file": round(used / file_count, 1),
+        })
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def generate_tree(root, file_count, min_size=1024, max_size=1048576,
+                  dup_ratio=0.2, prefix_ratio=0.1, hardlink_ratio=0.05,
+                  files_per_dir=100, seed=0):
+    """
+    Builds a synthetic source and target tree to benchmark against. Half of the
+    files go in root/source and half in root/target, spread over nested
+    directories. File sizes are drawn from a log-uniform distribution, so there
+    are many more small files than large ones, the way there are on real disks.
+    Each target file is one of:
+
+        - a copy of a source file (dup_ratio),
+        - a file the same size as a source file that shares its first part but
+          differs further in (prefix_ratio),
+        - a hardlink to a source file (hardlink_ratio), or
+        - a file of random contents and size.
+
+    The same seed always builds the same tree.
+
+    :param root: The directory to build the tree in. It must not exist yet.
+    :param file_count: The total number of files to build.
+    :param min_size: The smallest file size in bytes. Defaults to 1K.
+    :param max_size: The largest file size in bytes. Defaults to 1M.
+    :param dup_ratio: The fraction of target files that are copies of a source
+           file. Defaults to 0.2.
+    :param prefix_ratio: The fraction of target files that share a prefix with
+           a source file of the same size. Defaults to 0.1.
+    :param hardlink_ratio: The fraction of target files that are hardlinks to a
+           source file. Defaults to 0.05.
+    :param files_per_dir: The number of files in each directory. Defaults to
+           100.
+    :param seed: The seed for the random number generator. Defaults to 0.
+
+    :return: A dictionary describing the tree that was built.
+    """
+
+    rng = random.Random(seed)
+
+    # --------------------------------------------------------------------------
+    def file_path(side, number):
+        dir_number = number // files_per_dir
+        dir_path = os.path.join(root, side, "d" + str(dir_number // 100),
+                                "d" + str(dir_number))
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        return os.path.join(dir_path, "f" + str(number) + ".bin")
+
+    # --------------------------------------------------------------------------
+    def random_size():
+        return int(math.exp(rng.uniform(math.log(min_size),
+                                        math.log(max_size))))
+
+    output = {"source_files": 0, "target_files": 0, "duplicates": 0,
+              "shared_prefixes": 0, "hardlinks": 0, "total_mb": 0.0}
+    total_bytes = 0
+
+    source_count = file_count // 2
+    source_paths = list()
+    for number in range(source_count):
+        path = file_path("source", number)
+        size = random_size()
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(size))
+        source_paths.append((path, size))
+        total_bytes += size
+    output["source_files"] = source_count
+
+    for number in range(file_count - source_count):
+        path = file_path("target", number)
+        kind = rng.random()
+        source_path, size = source_paths[rng.randrange(len(source_paths))] \
+            if source_paths else (None, random_size())
+
+        if source_path is not None and kind < dup_ratio:
+            with open(source_path, "rb") as f:
+                data = f.read()
+            output["duplicates"] += 1
+
+        elif source_path is not None and kind < dup_ratio + prefix_ratio:
+            with open(source_path, "rb") as f:
+                data = bytearray(f.read())
+            position = rng.randrange(len(data) // 2, len(data))
+            data[position] = (data[position] + 1) % 256
+            output["shared_prefixes"] += 1
+
+        elif source_path is not None and \
+                kind < dup_ratio + prefix_ratio + hardlink_ratio:
+            os.link(source_path, path)
+            output["hardlinks"] += 1
+            continue
+
+        else:
+            size = random_size()
+            data = rng.randbytes(size)
+
+        with open(path, "wb") as f:
+            f.write(data)
+        total_bytes += len(data)
+
+    output["target_files"] = file_count - source_count
+    output["total_mb"] = round(total_bytes / (1024 * 1024), 1)
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def read_resources():
+    """
+    Reads the english resources file that sits next to this script.
+
+    :return: A ConfigParser object.
+    """
+
+    resources_obj = configparser.ConfigParser(allow_no_value=True)
+    resources_obj.read(os.path.join(os.path.dirname(os.path.realpath(
+        __file__)), "resources", "resources_english.ini"))
+
+    return resources_obj
+
+
+# ------------------------------------------------------------------------------
+def set_up_compare(resources_obj, source_dir, target_dir, log_file):
+    """
+    The compare functions in findDuplicates read their settings from the
+    module's globals, which are normally set up by its main block. This sets
+    them up the same way (with every option at its default, and without the
+    digest cache) so the functions can be timed on their own.
+
+    :param resources_obj: The resources object.
+    :param source_dir: The source directory.
+    :param target_dir: The target directory.
+    :param log_file: The results log to write to.
+
+    :return: Nothing.
+    """
+
+    defaults = dict()
+    for key in findDuplicates.OPTIONS_SETTINGS.keys():
+        defaults[key] = findDuplicates.OPTIONS_SETTINGS[key][3]
+    defaults["source_dir"] = source_dir
+    defaults["target_dir"] = target_dir
+    defaults["log_file"] = log_file
+
+    settings = Settings(resources_obj, defaults)
+
+    findDuplicates.resources_obj = resources_obj
+    findDuplicates.settings = settings
+    findDuplicates.debug_obj = Debug(False, resources_obj)
+    findDuplicates.digest_cache_obj = None
+    findDuplicates.digest_memo = dict()
+    findDuplicates.hash_pool_obj = None
+    findDuplicates.stage_timers = StageTimers()
+    findDuplicates.stage_progress = dict()
+    findDuplicates.hash_algo = settings.hash_algo
+    findDuplicates.digest_size = settings.digest_size
+    findDuplicates.mmap_threshold = settings.mmap_threshold
+    findDuplicates.results_log = new_result_writer("text", log_file)
+    findDuplicates.errors_log = open(log_file + ".errors", "w")
+
+
+# ------------------------------------------------------------------------------
+def timed(name, function, *args):
+    """
+    Calls a function with stdOut silenced and measures how long it takes.
+
+    :param name: The name of what is being timed.
+    :param function: The function to call.
+    :param args: Any arguments to pass to the function.
+
+    :return: A tuple of the function's return value and a dictionary holding
+             the name, the wall clock time and the CPU time in seconds.
+    """
+
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            result = function(*args)
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+
+    return result, {"stage": name,
+                    "wall_sec": round(wall, 3),
+                    "cpu_sec": round(cpu, 3)}
+
+
+# ------------------------------------------------------------------------------
+def benchmark_suite(tree_dir):
+    """
+    Times each part of a run against a tree built by generate_tree: scanning the
+    source and target, the partial, sampled and full checksum helpers on every
+    target file, and finally the compare itself (the size pruning and
+    do_compare) with every option at its default. The digest cache is not used,
+    but the files will mostly be in the page cache after the checksum helpers
+    have read them, so the compare time measures the engine rather than the
+    disk.
+
+    :param tree_dir: The directory holding the source and target trees.
+
+    :return: A list of dictionaries, one per stage, holding the name of the
+             stage, the wall clock and CPU time, the number of files and MB
+             involved, and the throughput.
+    """
+
+    resources_obj = read_resources()
+    source_dir = os.path.join(tree_dir, "source")
+    target_dir = os.path.join(tree_dir, "target")
+
+    output = list()
+
+    # --------------------------------------------------------------------------
+    def add_result(result, files, num_bytes):
+        result["files"] = files
+        result["mb"] = round(num_bytes / (1024 * 1024), 1)
+        wall = max(result["wall_sec"], 0.000001)
+        result["files_per_sec"] = int(files / wall)
+        result["mb_per_sec"] = round(num_bytes / (1024 * 1024) / wall, 1)
+        output.append(result)
+
+    # Scan
+    scans = list()
+    for name, scan_dir, is_source in [("scan_source", source_dir, True),
+                                      ("scan_target", target_dir, False)]:
+        scan_obj = ScanDirectory(scan_dir, resources_obj,
+                                 type_is_source=is_source)
+        ignore, result = timed(name, scan_obj.scan)
+        add_result(result, len(scan_obj.files), sum(scan_obj.files.sizes))
+        scans.append(scan_obj)
+    source_obj, target_obj = scans
+
+    # Hashing helpers
+    target_files = [(file_path, file_size) for index, file_path, file_size
+                    in target_obj.files.iter_files()]
+    sample_bytes = 4096 * (5 + 3)
+    helpers = [
+        ("partial_checksum", lib.partial_checksum, (1024,),
+         lambda size: min(size, 1024)),
+        ("sampled_checksum", lib.sampled_checksum, (4096, 5),
+         lambda size: min(size, sample_bytes)),
+        ("full_checksum", lib.full_checksum, (),
+         lambda size: size),
+    ]
+    for name, function, args, read_size in helpers:
+        ignore, result = timed(name, lambda: [function(file_path, *args)
+                                              for file_path, file_size
+                                              in target_files])
+        add_result(result, len(target_files),
+                   sum([read_size(file_size)
+                        for file_path, file_size in target_files]))
+
+    # Compare
+    with tempfile.TemporaryDirectory() as temp_dir:
+        set_up_compare(resources_obj, source_dir, target_dir,
+                       os.path.join(temp_dir, "results.log"))
+        compared_bytes = sum(source_obj.files.sizes) + \
+            sum(target_obj.files.sizes)
+        compared_files = len(source_obj.files) + len(target_obj.files)
+
+        ignore, result = timed("prune_unmatched_sizes",
+                               findDuplicates.prune_unmatched_sizes,
+                               source_obj, target_obj)
+        add_result(result, compared_files, compared_bytes)
+
+        counts, result = timed("do_compare", findDuplicates.do_compare,
+                               source_obj, target_obj)
+        add_result(result, compared_files, compared_bytes)
+        result["duplicates_found"] = counts[1]
+        result["hardlinks_found"] = counts[3]
+
+        findDuplicates.results_log.close()
+        findDuplicates.errors_log.close()
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def display_results(results, as_json=False):
+    """
+    Displays a list of benchmark results, either as a table or as JSON.
+
+    :param results: A list of dictionaries, all with the same keys.
+    :param as_json: If True, the results are written as a single JSON document.
+           Defaults to False.
+
+    :return: Nothing.
+    """
+
+    if as_json:
+        lib.display_message(json.dumps(results, indent=4))
+        return
+
+    if not results:
+        return
+
+    keys = list()
+    for result in results:
+        keys.extend([key for key in result.keys() if key not in keys])
+    widths = [max([len(key)] + [len(str(result.get(key, "")))
+                                for result in results])
+              for key in keys]
+
+    lib.display_message("  ".join(
+        [key.ljust(width) for key, width in zip(keys, widths)]).rstrip())
+    for result in results:
+        lib.display_message("  ".join(
+            [str(result.get(key, "")).ljust(width)
+             for key, width in zip(keys, widths)]).rstrip())
+
+
+# ==============================================================================
+if __name__ == "__main__":
+
+    parser = OptionParser(usage=USAGE)
+    parser.add_option("--algorithms", action="store", type="string",
+                      dest="algorithms", default=",".join(HASH_ALGORITHMS),
+                      help="Comma separated list of hash algorithms to test.")
+    parser.add_option("--digest-size", action="store", type="int",
+                      dest="digest_size", default=0,
+                      help="Digest size in bytes for the blake2 algorithms.")
+    parser.add_option("--size-mb", action="store", type="int",
+                      dest="size_mb", default=64,
+                      help="Megabytes of data to hash per algorithm.")
+    parser.add_option("--sizes-mb", action="store", type="string",
+                      dest="sizes_mb",
+                      default=",".join([str(size) for size in
+                                        MMAP_FILE_SIZES_MB]),
+                      help="Comma separated list of file sizes (in MB) to "
+                           "test memory mapping with.")
+    parser.add_option("--work-dir", action="store", type="string",
+                      dest="work_dir", default=None,
+                      help="Directory to write test files to.")
+    parser.add_option("--files", action="store", type="int",
+                      dest="files", default=None,
+                      help="Number of files to store when measuring memory "
+                           "(default 1000000) or to build in the synthetic "
+                           "tree (default 10000).")
+    parser.add_option("--files-per-dir", action="store", type="int",
+                      dest="files_per_dir", default=100,
+                      help="Number of files in each directory when measuring "
+                           "memory.")
+    parser.add_option("--tree", action="store", type="string",
+                      dest="tree", default=None,
+                      help="Directory to build (or find) the synthetic tree "
+                           "in.")
+    parser.add_option("--min-size", action="store", type="int",
+                      dest="min_size", default=1024,
+                      help="Smallest synthetic file size in bytes.")
+    parser.add_option("--max-size", action="store", type="int",
+                      dest="max_size", default=1048576,
+                      help="Largest synthetic file size in bytes.")
+    parser.add_option("--dup-ratio", action="store", type="float",
+                      dest="dup_ratio", default=0.2,
+                      help="Fraction of target files that copy a source file.")
+    parser.add_option("--prefix-ratio", action="store", type="float",
+                      dest="prefix_ratio", default=0.1,
+                      help="Fraction of target files that share a prefix with "
+                           "a source file.")
+    parser.add_option("--hardlink-ratio", action="store", type="float",
+                      dest="hardlink_ratio", default=0.05,
+                      help="Fraction of target files that hardlink a source "
+                           "file.")
+    parser.add_option("--seed", action="store", type="int",
+                      dest="seed", default=0,
+                      help="Seed for the synthetic tree.")
+    parser.add_option("--json", action="store_true", dest="json",
+                      default=False,
+                      help="Write the results as JSON.")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+
+    if args[0] == "hashes":
+        algorithms = [algorithm.strip().lower()
+                      for algorithm in options.algorithms.split(",")
+                      if algorithm.strip().lower()
+                      in hashlib.algorithms_available]
+        display_results(benchmark_hashes(algorithms, options.size_mb,
+                                         options.digest_size),
+                        options.json)
+
+    elif args[0] == "mmap":
+        sizes_mb = [int(size) for size in options.sizes_mb.split(",")]
+        algorithm = options.algorithms.split(",")[0].strip().lower()
+        display_results(benchmark_mmap(sizes_mb, algorithm, options.work_dir),
+                        options.json)
+
+    elif args[0] in ["generate", "suite"]:
+        if options.tree is None:
+            parser.error("--tree is required")
+        if args[0] == "generate" and os.path.exists(options.tree):
+            parser.error("--tree " + options.tree + " already exists")
+        if not os.path.exists(options.tree):
+            tree = generate_tree(options.tree, options.files or 10000,
+                                 options.min_size, options.max_size,
+                                 options.dup_ratio, options.prefix_ratio,
+                                 options.hardlink_ratio,
+                                 options.files_per_dir, options.seed)
+            if args[0] == "generate":
+                display_results([tree], options.json)
+        if args[0] == "suite":
+            display_results(benchmark_suite(options.tree), options.json)
+
+    elif args[0] == "memory":
+        display_results(benchmark_memory(options.files or 1000000,
+                                         options.files_per_dir),
+                        options.json)
+
+    else:
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
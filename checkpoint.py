@@ -0,0 +1,139 @@
+import os
+import pickle
+
+
+# Bumped whenever the contents of a checkpoint change, so that checkpoints
+# written by an older version are not resumed from.
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(object):
+    """
+    Saves the state of a long compare so that it can be resumed if the run dies
+    part way through.
+
+    A checkpoint is made of two files next to the results log. The scan file
+    holds the scanned (and pruned) file tables. It is large, so it is only
+    written once, as soon as the scan is done. The progress file is small and
+    is rewritten every time a chunk of file sizes has been compared. It holds
+    the largest size completed so far, the running totals and how far into the
+    results and errors logs they had been written. Both are written to a
+    temporary file first and then moved into place, so a run that dies while
+    saving still leaves the previous checkpoint intact.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, file_name, key):
+        """
+        Initializes the object.
+
+        :param file_name: The path of the progress file. The scan file is the
+               same path with ".scan" added.
+        :param key: A string describing the settings of the run. A checkpoint
+               saved with a different key is never resumed from.
+
+        :return: Nothing.
+        """
+
+        self.file_name = file_name
+        self.scan_file_name = file_name + ".scan"
+        self.key = key
+
+    # --------------------------------------------------------------------------
+    def write(self, file_name, state):
+        """
+        Saves a state to a file.
+
+        :param file_name: The file to write.
+        :param state: A dictionary holding the state.
+
+        :return: Nothing.
+        """
+
+        temp_path = file_name + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump((CHECKPOINT_VERSION, self.key, state), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, file_name)
+
+    # --------------------------------------------------------------------------
+    def read(self, file_name):
+        """
+        Loads a state from a file.
+
+        :param file_name: The file to read.
+
+        :return: The dictionary holding the state, or None if there is no
+                 usable checkpoint (it is missing, unreadable, owned by another
+                 user, from an older version or from a run with different
+                 settings).
+        """
+
+        try:
+            # Unpickling runs code, so only trust files this user wrote
+            if hasattr(os, "getuid") and \
+                    os.stat(file_name).st_uid != os.getuid():
+                return None
+            with open(file_name, "rb") as f:
+                version, key, state = pickle.load(f)
+        except (OSError, IOError, pickle.PickleError, EOFError, ValueError):
+            return None
+
+        if version != CHECKPOINT_VERSION or key != self.key:
+            return None
+
+        return state
+
+    # --------------------------------------------------------------------------
+    def save_scan(self, state):
+        """
+        Saves the state of the scan.
+
+        :param state: A dictionary holding the state.
+
+        :return: Nothing.
+        """
+
+        self.write(self.scan_file_name, state)
+
+    # --------------------------------------------------------------------------
+    def save_progress(self, state):
+        """
+        Saves the progress of the compare.
+
+        :param state: A dictionary holding the state.
+
+        :return: Nothing.
+        """
+
+        self.write(self.file_name, state)
+
+    # --------------------------------------------------------------------------
+    def load(self):
+        """
+        Loads the last checkpoint.
+
+        :return: A tuple of the scan state and the progress state, or None if
+                 there is no usable checkpoint.
+        """
+
+        scan_state = self.read(self.scan_file_name)
+        progress_state = self.read(self.file_name)
+        if scan_state is None or progress_state is None:
+            return None
+
+        return scan_state, progress_state
+
+    # --------------------------------------------------------------------------
+    def remove(self):
+        """
+        Deletes the checkpoint (once the run has finished).
+
+        :return: Nothing.
+        """
+
+        for file_name in [self.file_name, self.scan_file_name]:
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
@@ -1,27 +1,38 @@
 import os
 import sys
+import threading
+import time
 
-import lib
+
+# Message levels, lowest first. Only messages at or above the level of the Debug
+# object are written.
+LEVELS = {
+    "debug": 10,
+    "info": 20,
+    "warning": 30,
+    "error": 40,
+}
 
 
 class Debug(object):
     """
     A Debug class responsible for printing to stdOut or stdErr.
+
+    The debug file is opened once and written through a buffer that is flushed
+    every flush_interval seconds (and when the object is closed), rather than
+    being opened and closed for every message. Messages are only converted to
+    strings if they are actually going to be written, so leaving debug calls in
+    hot loops costs next to nothing when debugging is off.
     """
 
     # ----------------------------------------------------------------------------------------------
-    def __init__(self, do_debug, resources_obj, max_count=1000,
-                 exit_on_max_count=False, write_to_file=True, debug_file=None,
-                 write_to_stdout=False, write_to_stderr=True):
+    def __init__(self, do_debug, resources_obj, write_to_file=True,
+                 debug_file=None, write_to_stdout=False, write_to_stderr=True,
+                 level="debug", max_bytes=None, backup_count=3,
+                 flush_interval=1.0):
         """
         Set up the basic settings.
 
-        :param max_count: The maximum number of lines to write to the log before
-               no longer writing any more messages. If None, then do not limit
-               the number of lines written. Defaults to 1000. This will not
-               prevent messages past this number to write to stdOut or stdErr.
-        :param exit_on_max_count: Whether to terminate the entire app upon
-               reaching the maximum number of lines. Defaults to False.
         :param write_to_file: If true, writes the debug messages to the file
                given by debug_file. Defaults to False.
         :param debug_file: The full path to the debug file where the messages
@@ -32,27 +43,57 @@ class Debug(object):
                False.
         :param write_to_stderr: Also write log messages to stdErr. Defaults to
                True.
+        :param level: The lowest level of message to write (one of the keys of
+               LEVELS). Defaults to "debug".
+        :param max_bytes: When the debug file grows past this many bytes it is
+               renamed to debug_file.1 (shifting any older ones along) and a new
+               one is started. If None, the file is never rotated. Defaults to
+               None.
+        :param backup_count: The number of rotated debug files to keep. Defaults
+               to 3.
+        :param flush_interval: The most time, in seconds, that a message will
+               sit in the buffer before it is written to the debug file.
+               Defaults to 1.0.
         """
 
         self.do_debug = do_debug
         self.resources_obj = resources_obj
-        self.max_count = max_count
-        self.exit_on_max_count = exit_on_max_count
         self.write_to_file = write_to_file
         self.write_to_stdout = write_to_stdout
         self.write_to_stderr = write_to_stderr
+        self.level = LEVELS[level]
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
 
         if debug_file is None:
             self.debug_file = os.path.expanduser("~/findDuplicates.debug")
         else:
             self.debug_file = debug_file
 
+        # Messages may come from several scanning threads at once
+        self.lock = threading.Lock()
+
         # If they want to write to a file, open it now
+        self.file_obj = None
+        self.file_bytes = 0
+        self.last_flush = time.monotonic()
         if self.write_to_file and self.do_debug:
-            f = open(self.debug_file, "w")
-            f.close()
+            self.file_obj = open(self.debug_file, "w", buffering=1048576)
 
-        self.count = 0
+    # ----------------------------------------------------------------------------------------------
+    def is_enabled(self, level="debug"):
+        """
+        Returns whether messages at a given level will be written. Use this to
+        skip building anything expensive (or looping over anything large) just
+        to log it.
+
+        :param level: The level to check. Defaults to "debug".
+
+        :return: True if messages at this level will be written.
+        """
+
+        return self.do_debug and LEVELS[level] >= self.level
 
     # ----------------------------------------------------------------------------------------------
     def debug(self, *msgs):
@@ -60,36 +101,112 @@ class Debug(object):
         Takes any number of message arguments, converts them to strings,
         concatenates them, and then outputs them to the appropriate locations.
 
-        :param msgs: Any number of arguments that will be written out
+        :param msgs: Any number of arguments that will be written out. Any
+               argument that is callable is called (with no arguments) to get
+               the value to write, but only if the message is written.
+
+        :return: Nothing.
+        """
+
+        self.log("debug", *msgs)
+
+    # ----------------------------------------------------------------------------------------------
+    def info(self, *msgs):
+        """
+        The same as debug, but at the info level.
+
+        :param msgs: Any number of arguments that will be written out.
+
+        :return: Nothing.
+        """
+
+        self.log("info", *msgs)
+
+    # ----------------------------------------------------------------------------------------------
+    def log(self, level, *msgs):
+        """
+        Writes a message at a given level.
+
+        :param level: The level of the message (one of the keys of LEVELS).
+        :param msgs: Any number of arguments that will be written out. Any
+               argument that is callable is called (with no arguments) to get
+               the value to write, but only if the message is written.
 
         :return: Nothing.
         """
 
-        if not self.do_debug:
+        if not self.do_debug or LEVELS[level] < self.level:
             return
 
-        output = ""
-        for msg in msgs:
-            output += " " + str(msg)
-        output.strip(" ")
+        output = "".join([" " + str(msg() if callable(msg) else msg)
+                          for msg in msgs])
 
-        if self.write_to_file:
-            if self.max_count is None or self.count < self.max_count:
-                f = open(self.debug_file, "a")
-                f.write(output + "\n")
-                f.close()
+        with self.lock:
 
-        if self.write_to_stderr:
-            print(output, file=sys.stderr)
+            if self.file_obj is not None:
+                self.write_line(output + "\n")
 
-        if self.write_to_stdout:
-            print(output)
+            if self.write_to_stderr:
+                print(output, file=sys.stderr)
 
-        self.count += 1
+            if self.write_to_stdout:
+                print(output)
+
+    # ----------------------------------------------------------------------------------------------
+    def write_line(self, line):
+        """
+        Writes a line to the debug file, rotating the file first if it has grown
+        too large, and flushing the buffer if it has not been flushed for a
+        while. Must be called with the lock held.
+
+        :param line: The line to write.
+
+        :return: Nothing.
+        """
+
+        if self.max_bytes is not None and \
+                self.file_bytes + len(line) > self.max_bytes and \
+                self.file_bytes > 0:
+            self.rotate()
+
+        self.file_obj.write(line)
+        self.file_bytes += len(line)
+
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.file_obj.flush()
+            self.last_flush = now
+
+    # ----------------------------------------------------------------------------------------------
+    def rotate(self):
+        """
+        Closes the debug file, renames it (and any older rotated files) out of
+        the way, and starts a new one. Must be called with the lock held.
+
+        :return: Nothing.
+        """
+
+        self.file_obj.close()
+
+        for number in range(self.backup_count - 1, 0, -1):
+            older = self.debug_file + "." + str(number)
+            if os.path.exists(older):
+                os.replace(older, self.debug_file + "." + str(number + 1))
+        if self.backup_count > 0:
+            os.replace(self.debug_file, self.debug_file + ".1")
+
+        self.file_obj = open(self.debug_file, "w", buffering=1048576)
+        self.file_bytes = 0
+
+    # ----------------------------------------------------------------------------------------------
+    def close(self):
+        """
+        Writes out anything still in the buffer and closes the debug file.
+
+        :return: Nothing.
+        """
 
-        if self.exit_on_max_count:
-            if self.max_count is not None:
-                if self.count >= self.max_count:
-                    lib.display_error(
-                        self.resources_obj.get("messages", "debug_count_limit"))
-                    sys.exit(0)
\ No newline at end of file
+        with self.lock:
+            if self.file_obj is not None:
+                self.file_obj.close()
+                self.file_obj = None
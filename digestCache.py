@@ -0,0 +1,178 @@
+import os
+import sqlite3
+import time
+
+
+class DigestCache(object):
+    """
+    A class responsible for persisting file digests between runs so that files
+    which have not changed since the last run never have to be read again.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, cache_file=None, max_entries=5000000, commit_every=1000):
+        """
+        Initializes the object and opens (or creates) the on-disk store.
+
+        :param cache_file: The full path to the SQLite database holding the
+               digests. If None, the database will be stored in the
+               .findDuplicates directory of the user's home directory.
+        :param max_entries: The maximum number of digests to keep. When the
+               cache is closed, the least recently used digests above this
+               number are evicted. If None, the cache is never trimmed.
+               Defaults to 5,000,000.
+        :param commit_every: How many writes to batch up before committing them
+               to disk. Defaults to 1000.
+
+        :return: Nothing.
+        """
+
+        if cache_file is None:
+            self.cache_file = os.path.expanduser(
+                "~/.findDuplicates/digest_cache.db")
+        else:
+            self.cache_file = cache_file
+
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+        self.pending_writes = 0
+
+        if not os.path.exists(os.path.split(self.cache_file)[0]):
+            os.makedirs(os.path.split(self.cache_file)[0])
+
+        self.connection = sqlite3.connect(self.cache_file)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "st_dev INTEGER NOT NULL, "
+            "st_ino INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, "
+            "digest TEXT NOT NULL, "
+            "last_used REAL NOT NULL, "
+            "PRIMARY KEY (st_dev, st_ino, kind))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS digests_last_used "
+            "ON digests (last_used)")
+        self.connection.commit()
+
+    # --------------------------------------------------------------------------
+    def get(self, file_stat, kind):
+        """
+        Looks up a digest for a file. If the file has been modified since the
+        digest was stored (its size or modification time no longer match), the
+        stale digest is discarded.
+
+        :param file_stat: The os.stat_result of the file.
+        :param kind: A string describing what sort of digest this is (i.e. which
+               algorithm and whether it is a partial or full digest).
+
+        :return: The stored digest, or None if there is no valid digest.
+        """
+
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, digest FROM digests "
+            "WHERE st_dev = ? AND st_ino = ? AND kind = ?",
+            (file_stat.st_dev, file_stat.st_ino, kind)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        # The file has changed since we stored the digest, so it is useless.
+        if row[0] != file_stat.st_size or row[1] != file_stat.st_mtime_ns:
+            self.connection.execute(
+                "DELETE FROM digests "
+                "WHERE st_dev = ? AND st_ino = ? AND kind = ?",
+                (file_stat.st_dev, file_stat.st_ino, kind))
+            self._wrote()
+            self.invalidations += 1
+            self.misses += 1
+            return None
+
+        self.connection.execute(
+            "UPDATE digests SET last_used = ? "
+            "WHERE st_dev = ? AND st_ino = ? AND kind = ?",
+            (time.time(), file_stat.st_dev, file_stat.st_ino, kind))
+        self._wrote()
+        self.hits += 1
+        return row[2]
+
+    # --------------------------------------------------------------------------
+    def put(self, file_stat, kind, digest):
+        """
+        Stores a digest for a file.
+
+        :param file_stat: The os.stat_result of the file, taken before the file
+               was read.
+        :param kind: A string describing what sort of digest this is.
+        :param digest: The digest to store.
+
+        :return: Nothing.
+        """
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO digests "
+            "(st_dev, st_ino, kind, size, mtime_ns, digest, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (file_stat.st_dev, file_stat.st_ino, kind, file_stat.st_size,
+             file_stat.st_mtime_ns, digest, time.time()))
+        self._wrote()
+
+    # --------------------------------------------------------------------------
+    def _wrote(self):
+        """
+        Counts a write and commits once enough writes have been batched up.
+
+        :return: Nothing.
+        """
+
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    # --------------------------------------------------------------------------
+    def evict(self):
+        """
+        Removes the least recently used digests until the cache holds no more
+        than max_entries digests.
+
+        :return: The number of digests evicted.
+        """
+
+        if self.max_entries is None:
+            return 0
+
+        count = self.connection.execute(
+            "SELECT COUNT(*) FROM digests").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+
+        self.connection.execute(
+            "DELETE FROM digests WHERE rowid IN ("
+            "SELECT rowid FROM digests ORDER BY last_used LIMIT ?)",
+            (excess,))
+        self.connection.commit()
+        self.evictions += excess
+        return excess
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """
+        Trims the cache down to size, commits any outstanding writes, and
+        closes the database.
+
+        :return: Nothing.
+        """
+
+        self.connection.commit()
+        self.evict()
+        self.connection.close()
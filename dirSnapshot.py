@@ -0,0 +1,129 @@
+import array
+import os
+import sys
+
+
+class DirSnapshot(object):
+    """
+    A compact record of the listing of every directory read by a scan, so that
+    the next scan can reuse the listings of the directories that have not been
+    modified since.
+
+    Like FileTable, this keeps parallel arrays of machine sized integers rather
+    than a tuple (and a full path string) per file. Only the base names of the
+    files and sub-directories are kept, interned so that the same name in many
+    directories is only stored once. The full paths are joined back onto the
+    directory when a listing is handed out.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        """
+        Initializes the object.
+
+        :return: Nothing.
+        """
+
+        # One entry per directory
+        self.dir_ids_by_path = dict()
+        self.dir_mtimes = array.array("q")
+        self.checked_counts = array.array("Q")
+        self.file_starts = array.array("Q")
+        self.sub_dir_starts = array.array("Q")
+
+        # The number of files skipped for each reason, only for the directories
+        # where any were.
+        self.skip_counts = dict()
+
+        # One entry per file
+        self.names = list()
+        self.sizes = array.array("q")
+        self.devs = array.array("Q")
+        self.inodes = array.array("Q")
+        self.mtimes = array.array("q")
+
+        # One entry per sub-directory
+        self.sub_dir_names = list()
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Returns the number of directories in the snapshot.
+
+        :return: An integer.
+        """
+
+        return len(self.dir_mtimes)
+
+    # --------------------------------------------------------------------------
+    def add(self, dir_path, dir_mtime, listing):
+        """
+        Records the listing of a directory. A directory may only be added once.
+
+        :param dir_path: The directory.
+        :param dir_mtime: The st_mtime_ns of the directory when it was read.
+        :param listing: The tuple returned by ScanDirectory.list_dir for the
+               directory.
+
+        :return: Nothing.
+        """
+
+        files, sub_folders, checked_counter, skipped = listing
+
+        dir_id = len(self.dir_mtimes)
+        self.dir_ids_by_path[dir_path] = dir_id
+        self.dir_mtimes.append(dir_mtime)
+        self.checked_counts.append(checked_counter)
+        self.file_starts.append(len(self.sizes))
+        self.sub_dir_starts.append(len(self.sub_dir_names))
+        if skipped:
+            self.skip_counts[dir_id] = dict(skipped)
+
+        for file_name, file_path, file_size, st_dev, st_ino, st_mtime_ns in \
+                files:
+            self.names.append(sys.intern(file_name))
+            self.sizes.append(file_size)
+            self.devs.append(st_dev)
+            self.inodes.append(st_ino)
+            self.mtimes.append(st_mtime_ns)
+
+        for sub_folder in sub_folders:
+            self.sub_dir_names.append(
+                sys.intern(os.path.basename(sub_folder)))
+
+    # --------------------------------------------------------------------------
+    def get(self, dir_path, dir_mtime):
+        """
+        Returns the listing of a directory, if it has not been modified since it
+        was recorded.
+
+        :param dir_path: The directory.
+        :param dir_mtime: The current st_mtime_ns of the directory.
+
+        :return: The same tuple as ScanDirectory.list_dir, or None if the
+                 directory is not in the snapshot or has been modified.
+        """
+
+        dir_id = self.dir_ids_by_path.get(dir_path)
+        if dir_id is None or self.dir_mtimes[dir_id] != dir_mtime:
+            return None
+
+        if dir_id + 1 < len(self.dir_mtimes):
+            file_end = self.file_starts[dir_id + 1]
+            sub_dir_end = self.sub_dir_starts[dir_id + 1]
+        else:
+            file_end = len(self.sizes)
+            sub_dir_end = len(self.sub_dir_names)
+
+        files = [(self.names[index],
+                  os.path.join(dir_path, self.names[index]),
+                  self.sizes[index], self.devs[index], self.inodes[index],
+                  self.mtimes[index])
+                 for index in range(self.file_starts[dir_id], file_end)]
+
+        sub_folders = [os.path.join(dir_path, self.sub_dir_names[index])
+                       for index in range(self.sub_dir_starts[dir_id],
+                                          sub_dir_end)]
+
+        return (files, sub_folders, self.checked_counts[dir_id],
+                dict(self.skip_counts.get(dir_id, dict())))
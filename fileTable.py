@@ -0,0 +1,352 @@
+import array
+import os
+import sys
+
+
+class FileTable(object):
+    """
+    A compact table of the files found by a scan. Instead of a Python list (and
+    a full path string) per file, the table keeps parallel arrays of machine
+    sized integers, one entry per file, plus the base name of each file and a
+    table of the directories they are in. Every directory path is stored only
+    once, and each base name is interned so that the same name in many
+    directories is only stored once as well.
+
+    Files are referred to by their index in the table. The files in each
+    directory are stored next to each other and sorted by name, so a path can
+    be looked up with a binary search inside its directory. Lookups by size use
+    a second array of indices sorted by size that is built the first time it is
+    needed.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        """
+        Initializes the object.
+
+        :return: Nothing.
+        """
+
+        # One entry per file
+        self.names = list()
+        self.dir_ids = array.array("I")
+        self.sizes = array.array("q")
+        self.devs = array.array("Q")
+        self.inodes = array.array("Q")
+        self.mtimes = array.array("q")
+
+        # One entry per directory. Each directory's files are the range
+        # dir_starts[i]:dir_ends[i] of the arrays above.
+        self.dirs = list()
+        self.dir_starts = array.array("I")
+        self.dir_ends = array.array("I")
+        self.dir_ids_by_path = dict()
+
+        # File indices sorted by size, built on demand.
+        self.size_order = None
+        self.sorted_sizes = None
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Returns the number of files in the table.
+
+        :return: An integer.
+        """
+
+        return len(self.sizes)
+
+    # --------------------------------------------------------------------------
+    def add_dir(self, dir_path, files):
+        """
+        Adds all of the files in a single directory to the table. A directory
+        may only be added once.
+
+        :param dir_path: The directory the files are in.
+        :param files: A list of tuples of file name, file path, size, st_dev,
+               st_ino and st_mtime_ns (as returned by ScanDirectory.list_dir).
+
+        :return: Nothing.
+        """
+
+        if not files:
+            return
+
+        dir_id = len(self.dirs)
+        self.dirs.append(dir_path)
+        self.dir_ids_by_path[dir_path] = dir_id
+        self.dir_starts.append(len(self.sizes))
+
+        for file_name, file_path, file_size, st_dev, st_ino, st_mtime_ns in \
+                sorted(files):
+            self.names.append(sys.intern(file_name))
+            self.dir_ids.append(dir_id)
+            self.sizes.append(file_size)
+            self.devs.append(st_dev)
+            self.inodes.append(st_ino)
+            self.mtimes.append(st_mtime_ns)
+
+        self.dir_ends.append(len(self.sizes))
+
+        # Any existing size index is now out of date.
+        self.size_order = None
+        self.sorted_sizes = None
+
+    # --------------------------------------------------------------------------
+    def path(self, index):
+        """
+        Returns the full path of a file.
+
+        :param index: The index of the file in the table.
+
+        :return: A path.
+        """
+
+        return os.path.join(self.dirs[self.dir_ids[index]], self.names[index])
+
+    # --------------------------------------------------------------------------
+    def inode(self, index):
+        """
+        Returns the device and inode of a file (of the link itself, for a
+        symlink).
+
+        :param index: The index of the file in the table.
+
+        :return: A tuple of (st_dev, st_ino).
+        """
+
+        return self.devs[index], self.inodes[index]
+
+    # --------------------------------------------------------------------------
+    def find(self, file_path):
+        """
+        Looks up a file by its path.
+
+        :param file_path: The path to look up.
+
+        :return: The index of the file in the table, or None if it is not in the
+                 table.
+        """
+
+        dir_id = self.dir_ids_by_path.get(os.path.dirname(file_path))
+        if dir_id is None:
+            return None
+
+        file_name = os.path.basename(file_path)
+        low = self.dir_starts[dir_id]
+        high = self.dir_ends[dir_id]
+        while low < high:
+            middle = (low + high) // 2
+            if self.names[middle] < file_name:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.dir_ends[dir_id] and self.names[low] == file_name:
+            return low
+        return None
+
+    # --------------------------------------------------------------------------
+    def __contains__(self, file_path):
+        """
+        Returns whether a path is in the table.
+
+        :param file_path: The path to look up.
+
+        :return: True if the path is in the table.
+        """
+
+        return self.find(file_path) is not None
+
+    # --------------------------------------------------------------------------
+    def build_size_index(self):
+        """
+        Builds the arrays used to look up files by size.
+
+        :return: Nothing.
+        """
+
+        sizes = self.sizes
+        self.size_order = array.array(
+            "I", sorted(range(len(sizes)), key=sizes.__getitem__))
+        self.sorted_sizes = array.array(
+            "q", [sizes[index] for index in self.size_order])
+
+    # --------------------------------------------------------------------------
+    def with_size(self, file_size):
+        """
+        Returns every file of a given size.
+
+        :param file_size: The size to look up.
+
+        :return: A list of file indices.
+        """
+
+        if self.size_order is None:
+            self.build_size_index()
+
+        low = self.bisect(file_size)
+        high = low
+        while high < len(self.sorted_sizes) and \
+                self.sorted_sizes[high] == file_size:
+            high += 1
+
+        return list(self.size_order[low:high])
+
+    # --------------------------------------------------------------------------
+    def bisect(self, file_size):
+        """
+        Returns the position of the first entry in sorted_sizes that is not
+        smaller than a given size.
+
+        :param file_size: The size to look up.
+
+        :return: An index into sorted_sizes.
+        """
+
+        low = 0
+        high = len(self.sorted_sizes)
+        while low < high:
+            middle = (low + high) // 2
+            if self.sorted_sizes[middle] < file_size:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    # --------------------------------------------------------------------------
+    def size_set(self):
+        """
+        Returns all of the distinct file sizes in the table.
+
+        :return: A set of integers.
+        """
+
+        return set(self.sizes)
+
+    # --------------------------------------------------------------------------
+    def prune(self, keep_sizes):
+        """
+        Removes every file whose size is not in a given set of sizes, and any
+        directory left empty by that. The table is rebuilt in place so that the
+        memory held by the removed files is given back.
+
+        :param keep_sizes: A set of the file sizes to keep.
+
+        :return: A tuple of the number of files removed and the total size of
+                 those files in bytes.
+        """
+
+        names = list()
+        dir_ids = array.array("I")
+        sizes = array.array("q")
+        devs = array.array("Q")
+        inodes = array.array("Q")
+        mtimes = array.array("q")
+        dirs = list()
+        dir_starts = array.array("I")
+        dir_ends = array.array("I")
+
+        removed_count = 0
+        removed_bytes = 0
+        for dir_id, dir_path in enumerate(self.dirs):
+            new_dir_id = len(dirs)
+            start = len(sizes)
+            for index in range(self.dir_starts[dir_id], self.dir_ends[dir_id]):
+                file_size = self.sizes[index]
+                if file_size not in keep_sizes:
+                    removed_count += 1
+                    removed_bytes += file_size
+                    continue
+                names.append(self.names[index])
+                dir_ids.append(new_dir_id)
+                sizes.append(file_size)
+                devs.append(self.devs[index])
+                inodes.append(self.inodes[index])
+                mtimes.append(self.mtimes[index])
+            if len(sizes) > start:
+                dirs.append(dir_path)
+                dir_starts.append(start)
+                dir_ends.append(len(sizes))
+
+        self.names = names
+        self.dir_ids = dir_ids
+        self.sizes = sizes
+        self.devs = devs
+        self.inodes = inodes
+        self.mtimes = mtimes
+        self.dirs = dirs
+        self.dir_starts = dir_starts
+        self.dir_ends = dir_ends
+        self.dir_ids_by_path = dict([(dir_path, dir_id) for dir_id, dir_path
+                                     in enumerate(dirs)])
+        self.size_order = None
+        self.sorted_sizes = None
+
+        return removed_count, removed_bytes
+
+    # --------------------------------------------------------------------------
+    def subtree(self, dir_path):
+        """
+        Returns a new table holding only the files that are inside a given
+        directory (at any depth).
+
+        :param dir_path: The directory. It must be given in the same form as the
+               directories in this table (i.e. it must start with the directory
+               that was scanned).
+
+        :return: A FileTable.
+        """
+
+        dir_path = dir_path.rstrip(os.sep) or os.sep
+        prefix = os.path.join(dir_path, "")
+
+        output = FileTable()
+        for dir_id, table_dir_path in enumerate(self.dirs):
+            if table_dir_path != dir_path and \
+                    not table_dir_path.startswith(prefix):
+                continue
+            files = list()
+            for index in range(self.dir_starts[dir_id], self.dir_ends[dir_id]):
+                files.append((self.names[index], None, self.sizes[index],
+                              self.devs[index], self.inodes[index],
+                              self.mtimes[index]))
+            output.add_dir(table_dir_path, files)
+
+        return output
+
+    # --------------------------------------------------------------------------
+    def extend(self, other):
+        """
+        Adds all of the files in another table to this one. Directories that are
+        already in this table are not added again.
+
+        :param other: The FileTable to add.
+
+        :return: Nothing.
+        """
+
+        for dir_id, dir_path in enumerate(other.dirs):
+            if dir_path in self.dir_ids_by_path:
+                continue
+            files = list()
+            for index in range(other.dir_starts[dir_id],
+                               other.dir_ends[dir_id]):
+                files.append((other.names[index], None, other.sizes[index],
+                              other.devs[index], other.inodes[index],
+                              other.mtimes[index]))
+            self.add_dir(dir_path, files)
+
+    # --------------------------------------------------------------------------
+    def iter_files(self):
+        """
+        Yields every file in the table, in the order they were added.
+
+        :return: A generator yielding tuples of the file index, path and size.
+        """
+
+        for dir_id, dir_path in enumerate(self.dirs):
+            for index in range(self.dir_starts[dir_id], self.dir_ends[dir_id]):
+                yield index, os.path.join(dir_path, self.names[index]), \
+                    self.sizes[index]
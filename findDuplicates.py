@@ -1,20 +1,45 @@
 #! /usr/bin/env python3
 
+import collections
+import concurrent.futures
 import configparser
-import hashlib
+import cProfile
 import os
 import os.path
+import sqlite3
 import sys
 import time
 from optparse import OptionParser
+from optparse import SUPPRESS_HELP
 
 import lib
+from checkpoint import Checkpoint
 from debug import Debug
+from debug import LEVELS
+from digestCache import DigestCache
+from progress import Progress
+from resultWriters import OUTPUT_FORMATS
+from resultWriters import new_result_writer
+from runMetrics import RunMetrics
 from scanDirectory import ScanDirectory
 from settings import Settings
+from stageTimers import StageTimers
 from ui import TrueFalseUI
 
 
+# The number of files each stage of the compare pipeline gathers up before
+# working on them. Large enough to keep the hashing pool busy, small enough that
+# results start coming out early.
+PIPELINE_BATCH_FILES = 10000
+
+# The number of files compared between checkpoints (at most; a checkpoint is
+# only saved if checkpoint_interval seconds have passed since the last one).
+CHECKPOINT_BATCH_FILES = 100000
+
+# The seconds between checkpoints of a resumed run, if no checkpoint interval
+# was given.
+RESUME_CHECKPOINT_INTERVAL = 300
+
 OPTIONS_SETTINGS = {
     "interactive":
         ("-i", "--interactive", "store_true", False, None),
@@ -31,13 +56,13 @@ OPTIONS_SETTINGS = {
     "source_dir":
         ("-s", "--source-dir", "store", os.path.expanduser("~"), "string"),
     "skip_source_sub_dirs":
-        ("-k", "--skip-source", "store_false", False, None),
+        ("-k", "--skip-source", "store_true", False, None),
     "source_dirs_to_skip":
         ("", "--source-dirs-to-skip", "store", None, "string"),
     "target_dir":
-        ("-t", "--target-dir", "store", os.path.expanduser("~"), "string"),
+        ("-t", "--target-dir", "append", None, "string"),
     "skip_target_sub_dirs":
-        ("-K", "--skip-target", "store_false", False, None),
+        ("-K", "--skip-target", "store_true", False, None),
     "target_dirs_to_skip":
         ("", "--target-dirs-to-skip", "store", None, "string"),
     "log_file":
@@ -63,8 +88,44 @@ OPTIONS_SETTINGS = {
         ("-m", "--many-dupes-expected", "store_false", False, None),
     "do_debug":
         ("", "--do-debug", "store_true", False, None),
-    "debug_limit":
-        ("", "--debug-limit", "store", 1000, "int"),
+    "debug_max_mb":
+        ("", "--debug-max-mb", "store", 100, "int"),
+    "debug_level":
+        ("", "--debug-level", "store", "debug", "string"),
+    "use_digest_cache":
+        ("", "--no-digest-cache", "store_false", True, None),
+    "digest_cache_limit":
+        ("", "--digest-cache-limit", "store", 5000000, "int"),
+    "jobs":
+        ("-j", "--jobs", "store", 1, "int"),
+    "hash_algo":
+        ("", "--hash-algo", "store", "md5", "string"),
+    "digest_size":
+        ("", "--digest-size", "store", 0, "int"),
+    "sample_size":
+        ("", "--sample-size", "store", 4096, "int"),
+    "sample_count":
+        ("", "--sample-count", "store", 5, "int"),
+    "stream_max_files":
+        ("", "--stream-max-files", "store", 4, "int"),
+    "mmap_threshold":
+        ("", "--mmap-threshold", "store", 67108864, "int"),
+    "scan_jobs":
+        ("", "--scan-jobs", "store", 1, "int"),
+    "max_depth":
+        ("", "--max-depth", "store", 0, "int"),
+    "checkpoint_interval":
+        ("", "--checkpoint-interval", "store", 0, "int"),
+    "resume":
+        ("", "--resume", "store_true", False, None),
+    "output_format":
+        ("", "--output-format", "store", "text", "string"),
+    "profile":
+        ("", "--profile", "store", "", "string"),
+    "incremental_scan":
+        ("", "--incremental-scan", "store_true", False, None),
+    "force_full_scan":
+        ("", "--force-full-scan", "store_true", False, None),
 }
 
 
@@ -127,11 +188,14 @@ def overwrite_file_ui():
 
 
 # ------------------------------------------------------------------------------
-def create_error_log(file_name):
+def create_error_log(file_name, position=None):
     """
     Create the error log file.
 
     :param file_name: The name of the error log file.
+    :param position: If not None, the existing error log is continued from this
+           position (anything after it is cut off) instead of a new one being
+           created. Defaults to None.
 
     :return: The error log file object.
     """
@@ -149,6 +213,10 @@ def create_error_log(file_name):
     lib.display_message("-" * 80)
 
     try:
+        if position is not None:
+            with open(file_name + ".errors", "r+") as f:
+                f.truncate(position)
+            return open(file_name + ".errors", "a")
         errors_file = open(file_name + ".errors", "w")
     except (OSError, IOError):
         lib.display_error(
@@ -158,24 +226,37 @@ def create_error_log(file_name):
     errors_file.write(headers)
 
     errors_file.write(source + "\t" + settings.source_dir + "\n")
-    errors_file.write(target + "\t" + settings.target_dir + "\n")
+    for target_dir in settings.target_dirs:
+        errors_file.write(target + "\t" + target_dir + "\n")
 
     return errors_file
 
 
 # ------------------------------------------------------------------------------
-def create_duplicates_log(file_name):
+def create_duplicates_log(file_name, output_format="text", with_roots=False,
+                          position=None):
     """
     Create the log file.
 
     :param file_name: The name of the log file.
-
-    :return: The duplicates log.
+    :param output_format: The format to write the results in. One of the names
+           in resultWriters.OUTPUT_FORMATS. Defaults to "text".
+    :param with_roots: If True, the target directory of each duplicate is
+           written as well (in the text format; the others always have it).
+           Defaults to False.
+    :param position: If not None, the existing log is continued from this
+           position instead of a new one being created. Defaults to None.
+
+    :return: The result writer for the duplicates log.
     """
 
     creating_log = resources_obj.get("messages", "creating_dup_log")
     error = resources_obj.get("errors", "cannot_create_log")
-    headers = resources_obj.get("headers", "log_file").replace(r"\t", "\t")
+    if with_roots:
+        headers = resources_obj.get("headers", "log_file_with_roots")
+    else:
+        headers = resources_obj.get("headers", "log_file")
+    headers = headers.replace(r"\t", "\t")
 
     lib.display_message(
         lib.format_string(creating_log.format(
@@ -184,13 +265,12 @@ def create_duplicates_log(file_name):
     lib.display_message("-" * 80)
 
     try:
-        results_file = open(file_name, "w")
-    except (OSError, IOError):
+        results_file = new_result_writer(output_format, file_name, headers,
+                                         with_roots, position)
+    except (OSError, IOError, sqlite3.Error):
         lib.display_error(error)
         sys.exit(1)
 
-    results_file.write(headers)
-
     return results_file
 
 
@@ -267,6 +347,11 @@ def define_options():
                 help=resources_obj.get(setting, "description_cl"),
                 )
 
+        # --debug-limit was replaced by --debug-max-mb. It is still accepted
+        # (but not listed) so that old scripts get a clear error.
+        parser.add_option("--debug-limit", action="store", type="int",
+                          dest="debug_limit", default=None, help=SUPPRESS_HELP)
+
         # actually parse the command my_line
         opts, args = parser.parse_args()
 
@@ -297,7 +382,12 @@ def load_defaults_from_preset(preset_file):
     preset_obj = configparser.ConfigParser()
     preset_obj.read(preset_file)
 
+    # Start with the app defaults so that presets written by older versions
+    # (which may be missing newer settings) still load.
     output = dict()
+    for key in OPTIONS_SETTINGS:
+        output[key] = OPTIONS_SETTINGS[key][3]
+
     preset_items = preset_obj.items("presets")
     for item in preset_items:
         if item[1].upper() == "TRUE":
@@ -322,7 +412,7 @@ def load_defaults_from_options():
     output["source_dir"] = options.source_dir
     output["skip_source_sub_dirs"] = options.skip_source_sub_dirs
     output["source_dirs_to_skip"] = options.source_dirs_to_skip
-    output["target_dir"] = options.target_dir
+    output["target_dir"] = options.target_dir or [os.path.expanduser("~")]
     output["skip_target_sub_dirs"] = options.skip_target_sub_dirs
     output["target_dirs_to_skip"] = options.target_dirs_to_skip
     output["log_file"] = options.log_file
@@ -336,11 +426,363 @@ def load_defaults_from_options():
     output["follow_links"] = options.follow_links
     output["many_dupes"] = options.many_dupes
     output["do_debug"] = options.do_debug
-    output["debug_limit"] = options.debug_limit
+    output["debug_max_mb"] = options.debug_max_mb
+    output["debug_level"] = options.debug_level
+    output["use_digest_cache"] = options.use_digest_cache
+    output["digest_cache_limit"] = options.digest_cache_limit
+    output["jobs"] = options.jobs
+    output["hash_algo"] = options.hash_algo
+    output["digest_size"] = options.digest_size
+    output["sample_size"] = options.sample_size
+    output["sample_count"] = options.sample_count
+    output["stream_max_files"] = options.stream_max_files
+    output["mmap_threshold"] = options.mmap_threshold
+    output["scan_jobs"] = options.scan_jobs
+    output["max_depth"] = options.max_depth
+    output["incremental_scan"] = options.incremental_scan
+    output["checkpoint_interval"] = options.checkpoint_interval
+    output["output_format"] = options.output_format
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def remembered_digest(file_path, kind):
+    """
+    Looks up a digest in the per-run memo. The memo is keyed on the normalized
+    path, so a file that appears in both the source and the target (or under
+    two spellings of the same path) is only read once.
+
+    :param file_path: The file to look up.
+    :param kind: A string describing what sort of digest this is.
+
+    :return: The hex digest, or None if it has not been computed this run.
+    """
+
+    return digest_memo.get(os.path.normpath(file_path), dict()).get(kind)
+
+
+# ------------------------------------------------------------------------------
+def remember_digest(file_path, kind, checksum):
+    """
+    Stores a digest that has just been computed in the per-run memo (see
+    remembered_digest).
+
+    :param file_path: The file the digest is of.
+    :param kind: A string describing what sort of digest this is.
+    :param checksum: The hex digest.
+
+    :return: Nothing.
+    """
+
+    digest_memo.setdefault(os.path.normpath(file_path), dict())[kind] = checksum
+
+
+# ------------------------------------------------------------------------------
+def get_digest(file_path, kind, checksum_function, *args):
+    """
+    Returns a digest of a file, computing it at most once per run. Digests are
+    remembered in the per-run memo (see remembered_digest), and, if the digest
+    cache is enabled, in the persistent digest cache as well.
+
+    :param file_path: The file to checksum.
+    :param kind: A string describing what sort of digest this is.
+    :param checksum_function: The function that actually reads the file and
+           returns its digest. It is called with file_path and then *args.
+    :param args: Any additional arguments to pass to checksum_function.
+
+    :return: The hex digest of the file.
+    """
+
+    # Check to see if we already hashed this file during this run
+    checksum = remembered_digest(file_path, kind)
+    if checksum is not None:
+        return checksum
+
+    if digest_cache_obj is None:
+        checksum = checksum_function(file_path, *args)
+    else:
+        file_stat = os.stat(file_path)
+        checksum = digest_cache_obj.get(file_stat, kind)
+        if checksum is None:
+            checksum = checksum_function(file_path, *args)
+            digest_cache_obj.put(file_stat, kind, checksum)
+
+    remember_digest(file_path, kind, checksum)
+    return checksum
+
+
+# ------------------------------------------------------------------------------
+def hash_name():
+    """
+    Returns the name of the hash currently in use, including the digest size if
+    one was given (i.e. "md5" or "blake2b-16"). This is used to make sure that
+    digests made with different algorithms are never mixed up.
+
+    :return: A string.
+    """
+
+    if digest_size:
+        return hash_algo + "-" + str(digest_size)
+    return hash_algo
+
+
+# ------------------------------------------------------------------------------
+def partial_digest(file_path, num_bytes=1024):
+    """
+    Returns the checksum of the first num_bytes of a file.
+
+    :param file_path: The file to checksum.
+    :param num_bytes: The number of bytes to hash. Defaults to 1K (1024)
+
+    :return: The hex digest of the first num_bytes of the file.
+    """
+
+    return get_digest(file_path, hash_name() + ":partial:" + str(num_bytes),
+                      lib.partial_checksum, num_bytes, hash_algo, digest_size)
+
+
+# ------------------------------------------------------------------------------
+def full_digest(file_path):
+    """
+    Returns the checksum of an entire file.
+
+    :param file_path: The file to checksum.
+
+    :return: The hex digest of the file.
+    """
+
+    return get_digest(file_path, hash_name() + ":full", lib.full_checksum,
+                      hash_algo, digest_size, mmap_threshold)
+
+
+# ------------------------------------------------------------------------------
+def run_jobs(function, items, *args, stage="", sizes=None):
+    """
+    Calls function(item, *args) for every item, either in this process or, if
+    more than one job has been requested, spread over the hashing pool. Either
+    way the results are yielded in the same order as the items, and the
+    progress (with throughput and time left) is displayed while they come in.
+    Every call for the same stage shares one progress display, whose totals
+    grow as each batch of the stage arrives (see finish_stage_progress).
+
+    :param function: The function to call. It must be importable by the worker
+           processes (i.e. defined at the top level of a module).
+    :param items: A list of items to call the function with.
+    :param args: Any additional arguments to pass to the function.
+    :param stage: The stage these jobs are part of (i.e. "partial"). Its name
+           is displayed with the progress and its time is added to the stage
+           timers. Defaults to an empty string.
+    :param sizes: A list of the number of bytes each item is expected to read,
+           used to display the throughput and time left. If None, only the
+           number of items is displayed. Defaults to None.
+
+    :return: A generator yielding, for each item, a tuple where the first item
+             is the result (or None if there was an error) and the second is
+             the error as a string (or None).
+    """
+
+    jobs = [(function, item, args) for item in items]
+    if not jobs:
+        return
+
+    if hash_pool_obj is None:
+        results = map(lib.run_job, jobs)
+    else:
+        chunk_size = max(1, min(64, len(jobs) // (settings.jobs * 4)))
+        results = hash_pool_obj.map(lib.run_job, jobs, chunksize=chunk_size)
+
+    if sizes is None:
+        sizes = [0] * len(jobs)
+
+    if stage not in stage_progress:
+        stage_progress[stage] = Progress(
+            resources_obj, resources_obj.get("messages", "stage_" + stage))
+    progress = stage_progress[stage]
+    progress.add_work(len(jobs), sum(sizes))
+
+    # The caller may stop asking for results as soon as it has the last one,
+    # so the stage timer is stopped before that one is handed back.
+    started = stage_timers.start()
+    for counter, (result, size) in enumerate(zip(results, sizes)):
+        progress.update(1, size)
+        if counter == len(jobs) - 1:
+            stage_timers.stop(stage, started, len(jobs), sum(sizes))
+        yield result
+
+
+# ------------------------------------------------------------------------------
+def finish_stage_progress():
+    """
+    Draws the final state of the progress of every stage that run_jobs has
+    displayed, and forgets them so that the next compare starts afresh.
+
+    :return: Nothing.
+    """
+
+    for progress in stage_progress.values():
+        progress.finish()
+    stage_progress.clear()
+
+
+# ------------------------------------------------------------------------------
+def get_digests(file_paths, kind, checksum_function, errors, *args, stage="",
+                read_sizes=None):
+    """
+    Returns digests for many files at once. Digests in the digest cache are not
+    computed again, and the files that do need to be read are spread over the
+    hashing pool when more than one job has been requested. The results are
+    identical to hashing the files one at a time.
+
+    Each stage of the pipeline reads a file at most once, so unlike get_digest
+    nothing is kept in the per-run memo (which would otherwise hold an entry
+    for every candidate file until the end of the run).
+
+    :param file_paths: A list of files to checksum.
+    :param kind: A string describing what sort of digest this is.
+    :param checksum_function: The function that actually reads a file and
+           returns its digest. It is called with a file path and then *args.
+           It must be importable by the worker processes (i.e. defined at the
+           top level of a module).
+    :param errors: A dictionary into which any files that could not be read
+           are added, keyed on the file path, with the error as the value.
+    :param args: Any additional arguments to pass to checksum_function.
+    :param stage: The stage this is part of (see run_jobs). Defaults to an
+           empty string.
+    :param read_sizes: A dictionary of the number of bytes that will be read
+           from each file, keyed on file path, used to display the throughput
+           and time left. Defaults to None.
+
+    :return: A dictionary of hex digests keyed on file path. Files that could
+             not be read are not included.
+    """
+
+    output = dict()
+    to_compute = list()
+
+    # Gather up every file that is not in the digest cache
+    for file_path in file_paths:
+
+        file_stat = None
+        if digest_cache_obj is not None:
+            try:
+                file_stat = os.stat(file_path)
+            except (OSError, IOError) as err:
+                errors[file_path] = str(err)
+                continue
+            checksum = digest_cache_obj.get(file_stat, kind)
+            if checksum is not None:
+                output[file_path] = checksum
+                continue
+
+        to_compute.append((file_path, file_stat))
+
+    # Then actually read the files, either here or in the hashing pool
+    sizes = None
+    if read_sizes is not None:
+        sizes = [read_sizes.get(item[0], 0) for item in to_compute]
+    results = run_jobs(checksum_function,
+                       [item[0] for item in to_compute], *args,
+                       stage=stage, sizes=sizes)
+
+    for item, result in zip(to_compute, results):
+
+        file_path, file_stat = item
+        checksum, error = result
+
+        if error is not None:
+
+            # DEBUG
+            debug_obj.debug("Unable to read file: ", file_path, error)
+            errors[file_path] = error
+            continue
+
+        if digest_cache_obj is not None:
+            digest_cache_obj.put(file_stat, kind, checksum)
+        output[file_path] = checksum
 
     return output
 
 
+# ------------------------------------------------------------------------------
+def partial_digests(file_paths, errors, file_sizes=None, num_bytes=1024):
+    """
+    Returns the checksums of the first num_bytes of many files.
+
+    :param file_paths: A list of files to checksum.
+    :param errors: A dictionary into which any files that could not be read
+           are added.
+    :param file_sizes: An optional dictionary of file sizes keyed on file path,
+           used to display the progress. Defaults to None.
+    :param num_bytes: The number of bytes to hash. Defaults to 1K (1024)
+
+    :return: A dictionary of hex digests keyed on file path.
+    """
+
+    read_sizes = None
+    if file_sizes is not None:
+        read_sizes = dict([(file_path, min(file_sizes[file_path], num_bytes))
+                           for file_path in file_sizes.keys()])
+
+    return get_digests(file_paths, hash_name() + ":partial:" + str(num_bytes),
+                       lib.partial_checksum, errors, num_bytes, hash_algo,
+                       digest_size,
+                       stage="partial",
+                       read_sizes=read_sizes)
+
+
+# ------------------------------------------------------------------------------
+def sampled_digests(file_paths, errors, file_sizes=None):
+    """
+    Returns the checksums of blocks sampled from the head, middle, tail and a
+    number of evenly spaced offsets of many files. The block size and number of
+    offsets are taken from the settings.
+
+    :param file_paths: A list of files to checksum.
+    :param errors: A dictionary into which any files that could not be read
+           are added.
+    :param file_sizes: An optional dictionary of file sizes keyed on file path,
+           used to display the progress. Defaults to None.
+
+    :return: A dictionary of hex digests keyed on file path.
+    """
+
+    read_sizes = None
+    if file_sizes is not None:
+        sampled_bytes = settings.sample_size * (settings.sample_count + 3)
+        read_sizes = dict([(file_path, min(file_sizes[file_path],
+                                           sampled_bytes))
+                           for file_path in file_sizes.keys()])
+
+    kind = hash_name() + ":sampled:" + str(settings.sample_size) + "x" + \
+        str(settings.sample_count)
+    return get_digests(file_paths, kind, lib.sampled_checksum, errors,
+                       settings.sample_size, settings.sample_count, hash_algo,
+                       digest_size,
+                       stage="sampled",
+                       read_sizes=read_sizes)
+
+
+# ------------------------------------------------------------------------------
+def full_digests(file_paths, errors, file_sizes=None):
+    """
+    Returns the checksums of many entire files.
+
+    :param file_paths: A list of files to checksum.
+    :param errors: A dictionary into which any files that could not be read
+           are added.
+    :param file_sizes: An optional dictionary of file sizes keyed on file path,
+           used to display the progress. Defaults to None.
+
+    :return: A dictionary of hex digests keyed on file path.
+    """
+
+    return get_digests(file_paths, hash_name() + ":full", lib.full_checksum,
+                       errors, hash_algo, digest_size, mmap_threshold,
+                       stage="full",
+                       read_sizes=file_sizes)
+
+
 # ------------------------------------------------------------------------------
 def md5_partial_match(file_path_a, file_path_b, num_bytes=1024):
     """
@@ -357,21 +799,8 @@ def md5_partial_match(file_path_a, file_path_b, num_bytes=1024):
     :return: True if the first N bytes of the two files match (via a hash)
     """
 
-    # file A first 'bytes' checksum
-    f = open(file_path_a, 'rb')
-    chunk = f.read(num_bytes)
-    f.close()
-    md5 = hashlib.md5()
-    md5.update(chunk)
-    checksum_a = md5.hexdigest()
-
-    # file B first 'bytes' checksum
-    f = open(file_path_b, 'rb')
-    chunk = f.read(num_bytes)
-    f.close()
-    md5 = hashlib.md5()
-    md5.update(chunk)
-    checksum_b = md5.hexdigest()
+    checksum_a = partial_digest(file_path_a, num_bytes)
+    checksum_b = partial_digest(file_path_b, num_bytes)
 
     # return whether they match
     return checksum_a == checksum_b
@@ -380,8 +809,8 @@ def md5_partial_match(file_path_a, file_path_b, num_bytes=1024):
 # ------------------------------------------------------------------------------
 def md5_full_match(file_path_a, file_path_b):
     """
-    Performs a full md5 checksum compare between two files. If they files match,
-    the md5 hash is returned. If they do not match, None is returned.
+    Performs a full checksum compare between two files. If they files match,
+    the checksum is returned. If they do not match, None is returned.
 
     :param file_path_a: The first file to compare
     :param file_path_b: The second file to compare
@@ -389,19 +818,8 @@ def md5_full_match(file_path_a, file_path_b):
     :return: The checksum of the files if they match, False otherwise.
     """
 
-    # file A full checksum
-    md5 = hashlib.md5()
-    with open(file_path_a, 'rb') as f:
-        for chunk in iter(lambda: f.read(128 * md5.block_size), b''):
-            md5.update(chunk)
-    checksum_a = md5.hexdigest()
-
-    # file B full checksum
-    md5 = hashlib.md5()
-    with open(file_path_b, 'rb') as f:
-        for chunk in iter(lambda: f.read(128 * md5.block_size), b''):
-            md5.update(chunk)
-    checksum_b = md5.hexdigest()
+    checksum_a = full_digest(file_path_a)
+    checksum_b = full_digest(file_path_b)
 
     # return their shared checksum if they match, False otherwise.
     if checksum_a == checksum_b:
@@ -411,159 +829,984 @@ def md5_full_match(file_path_a, file_path_b):
 
 
 # ------------------------------------------------------------------------------
-def do_compare(source, target):
+def is_useful_group(group):
     """
-    Actually run the compare.
+    Checks whether a group of candidate files could still produce a result, i.e.
+    whether it contains a source file and a different target file.
+
+    :param group: A list of group members (see size_groups).
+
+    :return: True if the group contains at least one source file and one target
+             file that is not the same file, False otherwise.
+    """
+
+    sources = [file_path for file_path, source_index, is_target, inode
+               in group if source_index is not None]
+    targets = [file_path for file_path, source_index, is_target, inode
+               in group if is_target]
+
+    if not sources or not targets:
+        return False
+
+    if len(sources) == 1 and len(targets) == 1 and sources[0] == targets[0]:
+        return False
+
+    return True
+
+
+# ------------------------------------------------------------------------------
+def collapse_hardlinks(group):
+    """
+    Collapses the hardlinks in a group of files. Files that share a device and
+    inode are the same file on disk, so only one of them (the first) ever needs
+    to be read. Symlinks are recorded by the scan with the device and inode of
+    the link itself, so a symlink is never collapsed into the file it points to.
+
+    :param group: A list of group members (see size_groups).
+
+    :return: An ordered dictionary where the keys are the file paths that need
+             to be read, and the values are lists of every member (including
+             the one for the key itself) that is a hardlink to that same file.
+    """
+
+    output = dict()
+    representatives = dict()
+    for member in group:
+        representative = representatives.setdefault(member[3], member[0])
+        output.setdefault(representative, list()).append(member)
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def refine_groups(groups, digests_function, errors, min_size=0):
+    """
+    Splits every group of candidate files into smaller groups whose members all
+    share the same digest (partial, sampled or full). Any resulting group that
+    can no longer produce a duplicate (a singleton, or one that has no source or
+    no target file in it) is dropped, so every file is read at most once per
+    stage no matter how many other files share its size. Hardlinks are only
+    read once, and a group made up entirely of hardlinks to the same file is
+    passed through without being read at all.
+
+    :param groups: A list of tuples where the first item is the size shared by
+           every file in the group, and the second is a list of group members
+           (see size_groups).
+    :param digests_function: A function that takes a list of file paths, the
+           errors dictionary and a dictionary of file sizes, and returns a
+           dictionary of digests keyed on file path (i.e. partial_digests or
+           full_digests).
+    :param errors: A dictionary into which any files that could not be read
+           are added, keyed on the file path, with the error as the value.
+    :param min_size: Groups of files smaller than this are passed through
+           without being refined. Defaults to 0.
+
+    :return: A new list of (size, group members) tuples.
+    """
+
+    output = list()
+
+    # Work out which files actually need to be read
+    to_refine = list()
+    for file_size, group in groups:
+
+        hardlinks = collapse_hardlinks(group)
+        if file_size < min_size or len(hardlinks) == 1:
+            output.append((file_size, group))
+        else:
+            to_refine.append((file_size, hardlinks))
+
+    # Hash every file in every group in one go so that the work can be spread
+    # over the hashing pool.
+    file_sizes = dict([(file_path, file_size)
+                       for file_size, hardlinks in to_refine
+                       for file_path in hardlinks.keys()])
+    digests = digests_function(list(file_sizes.keys()), errors, file_sizes)
+
+    for file_size, hardlinks in to_refine:
+
+        buckets = dict()
+        for file_path in hardlinks.keys():
+            if file_path in digests:
+                buckets.setdefault(digests[file_path], list()).extend(
+                    hardlinks[file_path])
+
+        for bucket in buckets.values():
+            if is_useful_group(bucket):
+                output.append((file_size, bucket))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def cached_digests(file_paths, kind):
+    """
+    Looks up the digests of many files in the digest cache, without reading any
+    of the files.
+
+    :param file_paths: A list of files to look up.
+    :param kind: A string describing what sort of digest this is.
+
+    :return: A tuple where the first item is a dictionary of the hex digests
+             that were found, keyed on file path, and the second is a
+             dictionary of the os.stat_result of the files that were not found
+             (taken now, so that a digest computed from them later can be
+             stored in the cache), also keyed on file path. Files that could not
+             be stat'ed are in neither, and both are empty if the digest cache
+             is not enabled.
+    """
+
+    digests = dict()
+    file_stats = dict()
+
+    if digest_cache_obj is None:
+        return digests, file_stats
+
+    for file_path in file_paths:
+
+        try:
+            file_stat = os.stat(file_path)
+        except (OSError, IOError):
+            continue
+        checksum = digest_cache_obj.get(file_stat, kind)
+        if checksum is not None:
+            digests[file_path] = checksum
+        else:
+            file_stats[file_path] = file_stat
+
+    return digests, file_stats
+
+
+# ------------------------------------------------------------------------------
+def stream_groups(groups):
+    """
+    Splits small groups of candidate files into groups of identical files by
+    reading all of the files in each group side by side (see
+    lib.split_identical_files). Files that differ only cost as many bytes as it
+    takes to find the first difference, and identical files are confirmed byte
+    for byte rather than by checksum. Hardlinks are only read once.
+
+    A group whose files all have a full digest in the digest cache is split by
+    those digests instead, without being read. When the digest cache is
+    enabled, the files are checksummed as they are streamed, and the full digest
+    of every group confirmed identical is stored in the cache (files that turned
+    out to differ from all the others are not).
+
+    :param groups: A list of (size, group members) tuples.
+
+    :return: A tuple where the first item is a list of (size, group members)
+             tuples of identical files, and the second is a list of the groups
+             that could not be compared this way (because a file could not be
+             read), which should be checksummed instead.
+    """
+
+    output = list()
+    failed = list()
+
+    kind = hash_name() + ":full"
+    algorithm = None
+    if digest_cache_obj is not None:
+        algorithm = hash_algo
+
+    to_stream = list()
+    for file_size, group in groups:
+
+        hardlinks = collapse_hardlinks(group)
+        if len(hardlinks) == 1:
+            output.append((file_size, group))
+            continue
+
+        # Skip the read if every file's digest is already known
+        digests, file_stats = cached_digests(list(hardlinks.keys()), kind)
+        if len(digests) < len(hardlinks):
+            to_stream.append((file_size, group, hardlinks, file_stats))
+            continue
+
+        buckets = dict()
+        for file_path, checksum in digests.items():
+            buckets.setdefault(checksum, list()).extend(hardlinks[file_path])
+        for bucket in buckets.values():
+            if is_useful_group(bucket):
+                output.append((file_size, bucket))
+
+    results = run_jobs(lib.split_identical_files,
+                       [list(item[2].keys()) for item in to_stream],
+                       1048576, algorithm, digest_size,
+                       stage="stream",
+                       sizes=[item[0] * len(item[2]) for item in to_stream])
+
+    for (file_size, group, hardlinks, file_stats), (identical_groups, error) \
+            in zip(to_stream, results):
+
+        if error is not None:
+
+            # DEBUG
+            debug_obj.debug("Unable to stream compare: ",
+                            list(hardlinks.keys()), error)
+            failed.append((file_size, group))
+            continue
+
+        # A path that matched no other path still stands for its whole set of
+        # hardlinks, which may be duplicates of each other on their own
+        grouped = set()
+        for identical_group, checksum in identical_groups:
+            grouped.update(identical_group)
+        for file_path, members in hardlinks.items():
+            if file_path not in grouped and is_useful_group(members):
+                output.append((file_size, list(members)))
+
+        for identical_group, checksum in identical_groups:
+
+            if checksum is not None:
+                for file_path in identical_group:
+                    if file_path in file_stats:
+                        digest_cache_obj.put(file_stats[file_path], kind,
+                                             checksum)
+
+            identical_group = [member for file_path in identical_group
+                               for member in hardlinks[file_path]]
+            if is_useful_group(identical_group):
+                output.append((file_size, identical_group))
+
+    return output, failed
+
+
+# ------------------------------------------------------------------------------
+def batch_groups(groups, batch_files=PIPELINE_BATCH_FILES):
+    """
+    Gathers groups coming down the pipeline into batches, so that each stage
+    can hand a useful amount of work to the hashing pool at once without
+    waiting for every group from the stage before it.
+
+    :param groups: An iterable of (size, group members) tuples.
+    :param batch_files: The number of files to gather before a batch is handed
+           on. Defaults to PIPELINE_BATCH_FILES.
+
+    :return: A generator yielding lists of (size, group members) tuples.
+    """
+
+    batch = list()
+    file_count = 0
+    for file_size, group in groups:
+        batch.append((file_size, group))
+        file_count += len(group)
+        if file_count >= batch_files:
+            yield batch
+            batch = list()
+            file_count = 0
+
+    if batch:
+        yield batch
+
+
+# ------------------------------------------------------------------------------
+def size_groups(source, target, sizes=None):
+    """
+    The first stage of the pipeline. Yields a group for every size that is found
+    in both the source and the target, smallest first. Paths are only built for
+    the files in these groups.
+
+    Each member of a group is a tuple of the file path, the index of the file in
+    the source table (None if it is only a target file), whether it is a target
+    file, and its (st_dev, st_ino). Everything the later stages need to know
+    about a file travels with it this way, and is gone once its group is. A
+    file that is in both the source and the target (only happens if the
+    directories overlap) is only added once.
 
     :param source: The source scan object.
     :param target: The target scan object.
+    :param sizes: A sorted list of the sizes to look at. If None, every size in
+           the source is looked at. Defaults to None.
 
-    :return: A tuple where the first item is the number of source files that
-             have duplicates, and the second is the total number of duplicates
-             found in the target dir.
+    :return: A generator yielding (size, group members) tuples.
     """
 
-    is_symlink = False
+    if sizes is None:
+        sizes = sorted(source.files.size_set())
+
+    for file_size in sizes:
+
+        target_indices = target.files.with_size(file_size)
+        if not target_indices:
+            continue
+
+        group = list()
+        positions = dict()
+        for target_index in target_indices:
+            target_file_path = target.files.path(target_index)
+            positions[target_file_path] = len(group)
+            group.append((target_file_path, None, True,
+                          target.files.inode(target_index)))
+
+        for source_index in source.files.with_size(file_size):
+            source_file_path = source.files.path(source_index)
+            if source_file_path in positions:
+                position = positions[source_file_path]
+                group[position] = (source_file_path, source_index, True,
+                                   group[position][3])
+            else:
+                group.append((source_file_path, source_index, False,
+                              source.files.inode(source_index)))
 
-    # preset some counters and flags
-    counter = 0
-    old_percent = 0
-    num_duplicates = 0
-    num_source_files_with_duplicates = 0
-    # num_unique = 0
-    # num_symlinks = 0
-    # num_errors = 0
+        if is_useful_group(group):
+            yield file_size, group
 
-    # make a list that will store each matched file so that it is not visited
-    # twice. i.e. if we find that A=B, we do not later want to record that B=A.
-    # This is really only an issue if the source and target directory are the
-    # same.
-    visited_files = list()
 
-    # test each source file
-    for source_file_path in source.items.keys():
+# ------------------------------------------------------------------------------
+def refine_stage(groups, digests_function, errors, min_size=0):
+    """
+    A digest stage of the pipeline. Runs refine_groups over the incoming groups
+    a batch at a time, yielding the refined groups of each batch as soon as it
+    is done.
+
+    :param groups: An iterable of (size, group members) tuples.
+    :param digests_function: See refine_groups.
+    :param errors: A dictionary into which any files that could not be read
+           are added, keyed on the file path, with the error as the value.
+    :param min_size: See refine_groups. Defaults to 0.
 
-        source_has_dup = False
+    :return: A generator yielding (size, group members) tuples.
+    """
 
-        # print the progress bar
-        counter += 1
-        old_percent = lib.display_progress(counter, len(source.items),
-                                           old_percent, 50, "#", "-")
+    for batch in batch_groups(groups):
 
-        source_file_name = source.items[source_file_path][0]
-        source_file_size = source.items[source_file_path][1]
+        refined = refine_groups(batch, digests_function, errors, min_size)
 
         # DEBUG
-        debug_obj.debug("\n\n\nChecking the following file:")
-        debug_obj.debug("    source_file_name = ", source_file_path)
-        debug_obj.debug("    source_file_size = ", source_file_size)
+        debug_obj.info("\n", digests_function.__name__, ": ", len(batch),
+                        " groups in, ", len(refined), " groups out")
 
-        # do not test files that have already been identified as matches for
-        # other files (only happens if both source and target dirs are the same)
-        if source.scan_dir == target.scan_dir:
-            if source_file_path in visited_files:
+        for file_size, group in refined:
+            yield file_size, group
 
-                # DEBUG
-                debug_obj.debug("This file was in 'visited_files'. Skipping.")
-                continue
 
-        # preset the log file lists and the unique flag
-        duplicate_list = list()
-        error_list = list()
-        # unique = False
+# ------------------------------------------------------------------------------
+def confirm_stage(groups, errors):
+    """
+    The last stage of the pipeline. Small groups are compared by reading their
+    files side by side instead of checksumming them, which stops at the first
+    difference. Everything else (including any small group that could not be
+    compared that way) is split by full digest. Every group yielded is a group
+    of identical files.
 
-        # check to see if any files in the target dir have the same size as the
-        # file we are testing.
-        try:
-            possible_matches_list = target.items[source_file_size]
+    :param groups: An iterable of (size, group members) tuples.
+    :param errors: A dictionary into which any files that could not be read
+           are added, keyed on the file path, with the error as the value.
 
-            # matched_size = True
-        except KeyError:
-            possible_matches_list = list()
-            # matched_size = False
+    :return: A generator yielding (size, group members) tuples.
+    """
 
-        # Check each possible match
-        for possibleMatch in possible_matches_list:
+    for batch in batch_groups(groups):
 
-            match_file_path = possibleMatch[0]
-            match_file_size = possibleMatch[1]
+        stream_max_files = min(settings.stream_max_files,
+                               lib.MAX_STREAM_FILES)
+        if stream_max_files > 1:
+            small_groups = [(file_size, group) for file_size, group in batch
+                            if len(group) <= stream_max_files]
+            batch = [(file_size, group) for file_size, group in batch
+                     if len(group) > stream_max_files]
+            identical_groups, failed_groups = stream_groups(small_groups)
+            batch.extend(failed_groups)
 
             # DEBUG
-            debug_obj.debug("Comparing to the following file:")
-            debug_obj.debug("    match_file_path = ", match_file_path)
-            debug_obj.debug("    match_file_size = ", match_file_size)
+            debug_obj.info("\nStream compared groups: ",
+                            len(identical_groups))
 
-            # Don't match against yourself
-            if source_file_path == match_file_path:
+            for file_size, group in identical_groups:
+                yield file_size, group
 
-                # DEBUG
-                debug_obj.debug("Source and match are the same. Skipping.")
-                continue
+        for file_size, group in refine_stage(batch, full_digests, errors):
+            yield file_size, group
 
-            # Since the file sizes match, compare the two files
-            match = compare_two_files(source_file_path, match_file_path,
-                                      settings.many_dupes)
 
-            # If a match, store this file in the duplicate_list
-            if match:
+# ------------------------------------------------------------------------------
+def find_duplicate_groups(source, target, errors, sizes=None):
+    """
+    Finds every group of identical files across the source and the target. This
+    is a pipeline of generators: the union of both scans is partitioned by
+    size, then by a partial digest, then by sampled blocks, and then confirmed
+    by comparing the files side by side or by a full digest, dropping groups
+    that can no longer produce a match after each stage. Work moves through
+    the pipeline a batch at a time, so each group is yielded as soon as it has
+    been confirmed, and only the groups in flight are held in memory.
 
-                # DEBUG
-                debug_obj.debug("These files are duplicates.")
-                duplicate_list.append([match_file_path,
-                                      str(match_file_size),
-                                      str(is_symlink)])
+    :param source: The source scan object.
+    :param target: The target scan object.
+    :param errors: A dictionary into which any files that could not be read
+           are added, keyed on the file path, with the error as the value.
+    :param sizes: A sorted list of the sizes to compare. If None, every size is
+           compared. Defaults to None.
+
+    :return: A generator yielding a tuple for each group of identical files,
+             where the first item is the file size and the second is a list of
+             the group members (see size_groups).
+    """
 
-                num_duplicates += 1
+    groups = size_groups(source, target, sizes)
 
-                source_has_dup = True
+    # Partition by partial digest (unless most files are expected to be
+    # duplicates, in which case this stage is mostly wasted reads).
+    if not settings.many_dupes:
+        groups = refine_stage(groups, partial_digests, errors)
 
-            # if nothing matches, this is a unique file
-            else:
+        # Partition by blocks sampled from throughout the file. Files that share
+        # a long header (images, disk images) get past the partial digest but
+        # usually differ somewhere further in. Files too small to sample
+        # without reading most of them go straight to the full digest.
+        if settings.sample_count > 0:
+            groups = refine_stage(
+                groups, sampled_digests, errors,
+                settings.sample_size * (settings.sample_count + 3) + 1)
 
-                # DEBUG
-                debug_obj.debug("These files are not duplicates.")
+    return confirm_stage(groups, errors)
+
+
+# ------------------------------------------------------------------------------
+def timed_scan(scan_obj, progress=None):
+    """
+    Scans a directory, adding the time it took to the stage timers.
 
-            # If we are listing A=B, don't also later list B=A if we already
-            # found a match.
-            if source_file_path == match_file_path and match:
-                visited_files.append(match_file_path)
+    :param scan_obj: The ScanDirectory object to scan.
+    :param progress: A Progress object shared with the other scans running at
+           the same time, or None if the scan is to show its own. Defaults to
+           None.
 
-        if source_has_dup:
-            num_source_files_with_duplicates += 1
+    :return: Nothing.
+    """
+
+    started = stage_timers.start()
+    scan_obj.scan(progress)
+    stage_timers.stop(scan_obj.stage, started, scan_obj.get_count())
+
+
+# ------------------------------------------------------------------------------
+def find_overlap(source_dir, target_dir):
+    """
+    Works out whether the source and target directories overlap.
 
-        # write the results to the log file (regardless of match outcome)
-        results_log.write("RESULT\t")
-        results_log.write("\t")
-        if len(duplicate_list) > 0:
-            results_log.write("DUPLICATE\t")
+    :param source_dir: The source directory.
+    :param target_dir: The target directory.
+
+    :return: "same" if they are the same directory, "target_in_source" if the
+             target is inside the source, "source_in_target" if the source is
+             inside the target, or None if they do not overlap.
+    """
+
+    source_dir = os.path.realpath(source_dir)
+    target_dir = os.path.realpath(target_dir)
+
+    if source_dir == target_dir:
+        return "same"
+
+    common_dir = os.path.commonpath([source_dir, target_dir])
+    if common_dir == source_dir:
+        return "target_in_source"
+    if common_dir == target_dir:
+        return "source_in_target"
+
+    return None
+
+
+# ------------------------------------------------------------------------------
+def drop_nested_dirs(dirs):
+    """
+    Removes every directory that is inside (or the same as) another directory in
+    a list, since its files are already covered by the other one.
+
+    :param dirs: A list of directories.
+
+    :return: A tuple where the first item is a list of the directories to keep
+             (in their original order), and the second is a list of tuples of
+             each directory dropped and the directory that covers it.
+    """
+
+    kept_indexes = list()
+    for index, dir_path in enumerate(dirs):
+        for other_index, other_dir in enumerate(dirs):
+            if other_index == index:
+                continue
+            overlap = find_overlap(other_dir, dir_path)
+            if overlap == "target_in_source" or \
+                    (overlap == "same" and other_index < index):
+                break
         else:
-            results_log.write("UNIQUE\t")
-        # sourceFullPath = os.path.join(options.sourceDir, source_file_name)
-        results_log.write(source_file_path + "\t")
-        results_log.write(str(source_file_size) + "\t")
-        results_log.write(str(is_symlink) + "\t")
-        for my_item in duplicate_list:
-            results_log.write(my_item[0] + "\t")
-            results_log.write(my_item[1] + "\t")
-            results_log.write(my_item[2] + "\t")
-        results_log.write("\n")
+            kept_indexes.append(index)
+    kept = [dirs[index] for index in kept_indexes]
+
+    # Only report a directory as covered by one that is actually kept (the
+    # directory that first covered it may have been dropped itself)
+    dropped = list()
+    for index, dir_path in enumerate(dirs):
+        if index in kept_indexes:
+            continue
+        for kept_dir in kept:
+            if find_overlap(kept_dir, dir_path) in ["same", "target_in_source"]:
+                dropped.append((dir_path, kept_dir))
+                break
+
+    return kept, dropped
+
+
+# ------------------------------------------------------------------------------
+def write_result(source_file_path, source_file_size, duplicate_list,
+                 hardlink_list):
+    """
+    Writes the result for a single source file to the results log. A source
+    file with duplicates gets a DUPLICATE result, and any hardlinks are written
+    as a HARDLINK result of their own. A source file whose only matches are
+    hardlinks gets just the HARDLINK result, and one with no matches at all a
+    UNIQUE result.
+
+    :param source_file_path: The path of the source file.
+    :param source_file_size: The size of the source file.
+    :param duplicate_list: A list of [path, size, is_symlink, root] lists for
+           each of the target files that duplicate the source file, where root
+           is the target directory the file was found in.
+    :param hardlink_list: A list of [path, size, is_symlink, root] lists for
+           each of the target files that are hardlinks of the source file.
+
+    :return: Nothing.
+    """
+
+    # write the results to the log file (regardless of match outcome)
+    if len(duplicate_list) > 0:
+        results_log.write_result("DUPLICATE", source_file_path,
+                                 source_file_size, duplicate_list)
+    elif not hardlink_list:
+        results_log.write_result("UNIQUE", source_file_path,
+                                 source_file_size, list())
+
+    # write any hardlinks as a result of their own
+    if hardlink_list:
+        results_log.write_result("HARDLINK", source_file_path,
+                                 source_file_size, hardlink_list)
+
+
+# ------------------------------------------------------------------------------
+def prune_unmatched_sizes(source, target):
+    """
+    Drops every file whose size is only found on one side of the compare from
+    both scans. None of these files can have a duplicate, so this is done
+    before any file is opened. The source files dropped are written to the
+    results log as UNIQUE straight away.
+
+    :param source: The source scan object.
+    :param target: The target scan object.
+
+    :return: A tuple where the first item is the number of source files
+             dropped, the second is the number of target files dropped, and the
+             third is the total size in bytes of all of the files dropped.
+    """
+
+    # When both sides are the same scan, a size only needs to be kept if more
+    # than one file has it.
+    if source.files is target.files:
+        size_counts = collections.Counter(source.files.sizes)
+        common_sizes = set([file_size for file_size in size_counts.keys()
+                            if size_counts[file_size] > 1])
+    else:
+        common_sizes = source.files.size_set() & target.files.size_set()
+
+    for source_index, source_file_path, source_file_size in \
+            source.files.iter_files():
+        if source_file_size not in common_sizes:
+            write_result(source_file_path, source_file_size, list(), list())
+
+    num_source_pruned, source_bytes_pruned = source.files.prune(common_sizes)
+    if target.files is source.files:
+        num_target_pruned, target_bytes_pruned = 0, 0
+    else:
+        num_target_pruned, target_bytes_pruned = target.files.prune(
+            common_sizes)
+
+    # DEBUG
+    debug_obj.info("\n\nSizes in common: ", len(common_sizes))
+    debug_obj.info("Source files pruned: ", num_source_pruned)
+    debug_obj.info("Target files pruned: ", num_target_pruned)
+
+    return (num_source_pruned, num_target_pruned,
+            source_bytes_pruned + target_bytes_pruned)
+
+
+# ------------------------------------------------------------------------------
+def checkpoint_key():
+    """
+    Describes everything about the settings that changes which files are
+    compared, or how, so that a checkpoint is only ever resumed by a run that
+    would have produced the same results.
+
+    :return: A string.
+    """
+
+    return repr((
+        os.path.realpath(settings.source_dir),
+        [os.path.realpath(target_dir) for target_dir in settings.target_dirs],
+        settings.skip_hidden, settings.skip_dsstore,
+        settings.limit_to_patterns, settings.pattern_list,
+        settings.skip_zero_len, hash_name(), settings.sample_size,
+        settings.sample_count, settings.output_format,
+        settings.skip_source, settings.source_dirs_to_skip,
+        settings.skip_target_sub_dirs, settings.target_dirs_to_skip,
+        settings.max_depth,
+    ))
+
+
+# ------------------------------------------------------------------------------
+def save_progress(checkpoint_obj, done_up_to, counts):
+    """
+    Saves the progress of the compare to the checkpoint, after making sure that
+    everything it covers has been written to the results and errors logs.
+
+    :param checkpoint_obj: The Checkpoint object.
+    :param done_up_to: The largest file size for which every source file has
+           had its result written (-1 if none have).
+    :param counts: The tuple of totals returned by do_compare, so far.
+
+    :return: Nothing.
+    """
+
+    errors_log.flush()
+    checkpoint_obj.save_progress({
+        "saved_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "done_up_to": done_up_to,
+        "counts": counts,
+        "results_position": results_log.get_position(),
+        "errors_position": errors_log.tell(),
+    })
+
+
+# ------------------------------------------------------------------------------
+def size_chunks(source, target, sizes, chunk_files=CHECKPOINT_BATCH_FILES):
+    """
+    Splits a sorted list of file sizes into chunks that each hold about
+    chunk_files files (counting both the source and the target).
+
+    :param source: The source scan object.
+    :param target: The target scan object.
+    :param sizes: A sorted list of file sizes.
+    :param chunk_files: The number of files to put in each chunk. If 0, all of
+           the sizes are put in a single chunk. Defaults to
+           CHECKPOINT_BATCH_FILES.
+
+    :return: A generator yielding sorted lists of file sizes.
+    """
+
+    if not chunk_files:
+        yield sizes
+        return
+
+    chunk = list()
+    file_count = 0
+    for file_size in sizes:
+        chunk.append(file_size)
+        file_count += len(source.files.with_size(file_size))
+        file_count += len(target.files.with_size(file_size))
+        if file_count >= chunk_files:
+            yield chunk
+            chunk = list()
+            file_count = 0
+
+    if chunk:
+        yield chunk
+
+
+# ------------------------------------------------------------------------------
+def do_compare(source, target, self_dedupe=False, checkpoint_obj=None,
+               progress_state=None):
+    """
+    Actually run the compare.
+
+    The sizes are compared a chunk at a time, smallest first. Once a chunk is
+    done every source file of those sizes has had its result written, so if a
+    checkpoint is being kept, the progress is saved after each chunk (at most
+    once every checkpoint_interval seconds). A resumed run picks up with the
+    first size after the last one saved.
+
+    :param source: The source scan object.
+    :param target: The target scan object.
+    :param self_dedupe: If True, the source and target directories overlap.
+           The files of a group that are in both are then not reported against
+           each other in both directions. Each source file that is not also a
+           target file gets a line listing the target files of its group. If
+           there are none, the group is reported once, on the line of its
+           first source file (by path). Defaults to False.
+    :param checkpoint_obj: If not None, the Checkpoint object to save the
+           progress to. Defaults to None.
+    :param progress_state: If not None, the progress loaded from a checkpoint
+           to resume from. Defaults to None.
+
+    :return: A tuple where the first item is the number of source files that
+             have duplicates, the second is the total number of duplicates
+             found in the target dir, the third is the number of source files
+             that have hardlinks in the target dir, and the fourth is the total
+             number of those hardlinks.
+    """
+
+    # preset some counters (or pick them up from where the last run stopped)
+    num_duplicates = 0
+    num_source_files_with_duplicates = 0
+    num_hardlinks = 0
+    num_source_files_with_hardlinks = 0
+    done_up_to = -1
+    if progress_state is not None:
+        (num_source_files_with_duplicates, num_duplicates,
+         num_source_files_with_hardlinks, num_hardlinks) = \
+            progress_state["counts"]
+        done_up_to = progress_state["done_up_to"]
+
+    sizes = [file_size for file_size in sorted(source.files.size_set())
+             if file_size > done_up_to]
+
+    chunk_files = 0
+    if checkpoint_obj is not None:
+        chunk_files = CHECKPOINT_BATCH_FILES
+    last_checkpoint = time.monotonic()
+
+    # Every source file whose result has been written is flagged (by its index
+    # in the source table) so that the rest can be written as UNIQUE at the end
+    # of each chunk.
+    already_reported = bytearray(len(source.files))
+
+    for chunk in size_chunks(source, target, sizes, chunk_files):
+
+        # Write out the results for each group of identical files as soon as
+        # it is found.
+        errors = dict()
+        for file_size, group in find_duplicate_groups(source, target, errors,
+                                                      chunk):
+
+            # Work out which target files duplicate each source file. When the
+            # directories overlap, a file that is both a source and a target
+            # file only gets a line of its own if nothing outside the overlap
+            # lists it, and then only the first one does (so that B=A is not
+            # reported after A=B).
+            sources = [member for member in group if member[1] is not None]
+            targets = [member for member in group if member[2]]
+            matches = list()
+            if self_dedupe:
+                source_only = [member for member in sources if not member[2]]
+                for member in source_only:
+                    matches.append((member, targets))
+                if not source_only:
+                    first_member = min(sources)
+                    matches.append((first_member, [
+                        target_member for target_member in targets
+                        if target_member[0] != first_member[0]]))
+            else:
+                for member in sources:
+                    matches.append((member, [
+                        target_member for target_member in targets
+                        if target_member[0] != member[0]]))
+
+            started = stage_timers.start()
+            for (source_file_path, source_index, is_target, source_inode), \
+                    match_members in matches:
+
+                # DEBUG
+                debug_obj.debug("\n\n\nResults for the following file:")
+                debug_obj.debug("    source_file_name = ", source_file_path)
+                debug_obj.debug("    source_file_size = ", file_size)
+
+                # preset the log file lists. Hardlinks are listed separately
+                # from true copies since removing a hardlink frees no space.
+                duplicate_list = list()
+                hardlink_list = list()
+                for match_file_path, match_index, match_is_target, \
+                        match_inode in match_members:
+
+                    match = [match_file_path, str(file_size),
+                             str(os.path.islink(match_file_path)),
+                             target.root_of(match_file_path) or
+                             source.root_of(match_file_path)]
+
+                    if match_inode == source_inode:
+
+                        # DEBUG
+                        debug_obj.debug("Hardlink: ", match_file_path)
+                        hardlink_list.append(match)
+
+                    else:
+
+                        # DEBUG
+                        debug_obj.debug("Duplicate: ", match_file_path)
+                        duplicate_list.append(match)
+
+                if duplicate_list:
+                    num_source_files_with_duplicates += 1
+                    num_duplicates += len(duplicate_list)
+
+                if hardlink_list:
+                    num_source_files_with_hardlinks += 1
+                    num_hardlinks += len(hardlink_list)
+
+                write_result(source_file_path, file_size, duplicate_list,
+                             hardlink_list)
+
+            stage_timers.stop("write", started, len(matches))
+
+            # The other members of the group have been reported as well
+            for member in sources:
+                already_reported[member[1]] = 1
+
+        # write the results for every source file in this chunk that was not
+        # in any group
+        started = stage_timers.start()
+        num_written = 0
+        for file_size in chunk:
+            for source_index in source.files.with_size(file_size):
+                if not already_reported[source_index]:
+                    write_result(source.files.path(source_index), file_size,
+                                 list(), list())
+                    num_written += 1
+        stage_timers.stop("write", started, num_written)
 
         # write the errors to the errors log file (if there are any)
-        if error_list:
+        for file_path in errors.keys():
             errors_log.write("Error comparing\t")
-            errors_log.write(source_file_name + "\t")
-            errors_log.write(
-                source_file_path.replace(options.sourceDir, "").lstrip("/") +
-                "\t")
-            errors_log.write(str(source_file_size) + "\t")
-            for my_item in error_list:
-                errors_log.write(my_item[0] + "\t")
-                errors_log.write(my_item[1] + "\t")
-                errors_log.write(my_item[2] + "\t")
-            errors_log.write("\n")
+            errors_log.write(file_path + "\t")
+            errors_log.write(errors[file_path] + "\n")
+
+        # Every source file up to the largest size in this chunk is done
+        if checkpoint_obj is not None and chunk and \
+                time.monotonic() - last_checkpoint >= \
+                settings.checkpoint_interval:
+            save_progress(checkpoint_obj, chunk[-1],
+                          (num_source_files_with_duplicates, num_duplicates,
+                           num_source_files_with_hardlinks, num_hardlinks))
+            last_checkpoint = time.monotonic()
+
+    finish_stage_progress()
 
     # Return the total number of duplicates found
-    return num_source_files_with_duplicates, num_duplicates
+    return (num_source_files_with_duplicates, num_duplicates,
+            num_source_files_with_hardlinks, num_hardlinks)
+
+
+# ------------------------------------------------------------------------------
+def build_metrics(source, target, scanned_bytes, prune_counts, compare_counts,
+                  run_started):
+    """
+    Gathers up the numbers describing this run for monitoring.
+
+    :param source: The source scan object.
+    :param target: The target scan object.
+    :param scanned_bytes: The total size of all of the distinct files that were
+           scanned (before any were pruned).
+    :param prune_counts: The tuple returned by prune_unmatched_sizes.
+    :param compare_counts: The tuple returned by do_compare.
+    :param run_started: The time (from time.time) the run started.
+
+    :return: A RunMetrics object.
+    """
+
+    metrics_obj = RunMetrics()
+
+    metrics_obj.add("run_start_timestamp_seconds", round(run_started, 3),
+                    "When the run started, in seconds since the epoch.")
+    metrics_obj.add("run_duration_seconds",
+                    round(time.time() - run_started, 3),
+                    "How long the whole run took, in seconds.")
+
+    # The scan
+    sides = [("source", source), ("target", target)]
+    for side, scan_obj in sides:
+        metrics_obj.add("files_checked", scan_obj.checked_count,
+                        "Files looked at by the scan.", {"side": side})
+    for side, scan_obj in sides:
+        metrics_obj.add("files_added", scan_obj.get_count(),
+                        "Files kept by the scan for the compare.",
+                        {"side": side})
+    for side, scan_obj in sides:
+        for reason in ["hidden", "dsstore", "pattern", "zero_len",
+                       "unreadable"]:
+            metrics_obj.add("files_skipped",
+                            scan_obj.skip_counts.get(reason, 0),
+                            "Files skipped by the scan, by reason.",
+                            {"side": side, "reason": reason})
+    for side, scan_obj in sides:
+        metrics_obj.add("dirs_pruned", scan_obj.pruned_count,
+                        "Sub-directories not scanned because they matched a "
+                        "skip pattern or were too deep.", {"side": side})
+    metrics_obj.add("scanned_bytes", scanned_bytes,
+                    "Total size of the distinct files kept by the scan.")
+
+    # Pruning files whose size is only on one side
+    num_source_pruned, num_target_pruned, bytes_pruned = prune_counts
+    metrics_obj.add("files_pruned", num_source_pruned,
+                    "Files dropped without being read because no file on the "
+                    "other side has the same size.", {"side": "source"})
+    metrics_obj.add("files_pruned", num_target_pruned,
+                    "Files dropped without being read because no file on the "
+                    "other side has the same size.", {"side": "target"})
+    metrics_obj.add("pruned_bytes", bytes_pruned,
+                    "Total size of the files dropped by size pruning.")
+
+    # Hashing and reading. Digests that came from the digest cache are not
+    # counted, as they did not read anything.
+    bytes_read = 0
+    for stage in ["partial", "sampled", "full", "stream"]:
+        wall, cpu, files, num_bytes = stage_timers.stages.get(
+            stage, [0.0, 0.0, 0, 0])
+        bytes_read += num_bytes
+        if stage == "stream":
+            metrics_obj.add("stream_compares", files,
+                            "Groups of files compared side by side.")
+        else:
+            metrics_obj.add("digests_computed", files,
+                            "Digests computed by reading the files, by kind.",
+                            {"kind": stage})
+    metrics_obj.add("bytes_read", bytes_read,
+                    "Bytes read from the files to compute digests and to "
+                    "compare them side by side.")
+    metrics_obj.add("read_amplification",
+                    round(bytes_read / max(scanned_bytes, 1), 6),
+                    "Bytes read divided by the total size of the files "
+                    "scanned.")
+
+    if digest_cache_obj is not None:
+        metrics_obj.add("digest_cache_hits", digest_cache_obj.hits,
+                        "Digests found in the digest cache.")
+        metrics_obj.add("digest_cache_misses", digest_cache_obj.misses,
+                        "Digests not found in the digest cache.")
+        metrics_obj.add("digest_cache_invalidations",
+                        digest_cache_obj.invalidations,
+                        "Cached digests discarded because the file changed.")
+        metrics_obj.add("digest_cache_evictions", digest_cache_obj.evictions,
+                        "Cached digests evicted to keep the cache in size.")
+
+    # The results
+    (num_source_files_with_dupes, num_duplicates,
+     num_source_files_with_links, num_hardlinks) = compare_counts
+    metrics_obj.add("source_files_with_duplicates",
+                    num_source_files_with_dupes,
+                    "Source files with at least one duplicate.")
+    metrics_obj.add("duplicate_files", num_duplicates,
+                    "Duplicates found, counted once for each source file they "
+                    "duplicate.")
+    metrics_obj.add("source_files_with_hardlinks",
+                    num_source_files_with_links,
+                    "Source files with at least one hardlink in the target.")
+    metrics_obj.add("hardlink_files", num_hardlinks,
+                    "Hardlinks found, counted once for each source file they "
+                    "link to.")
+
+    # Where the time went
+    for stage, (wall, cpu, files, num_bytes) in stage_timers.stages.items():
+        metrics_obj.add("stage_wall_seconds", round(wall, 6),
+                        "Wall clock time spent in each stage.",
+                        {"stage": stage})
+    for stage, (wall, cpu, files, num_bytes) in stage_timers.stages.items():
+        metrics_obj.add("stage_cpu_seconds", round(cpu, 6),
+                        "CPU time of the main process spent in each stage.",
+                        {"stage": stage})
+    for stage, (wall, cpu, files, num_bytes) in stage_timers.stages.items():
+        metrics_obj.add("stage_files", files,
+                        "Files processed in each stage.", {"stage": stage})
+    for stage, (wall, cpu, files, num_bytes) in stage_timers.stages.items():
+        metrics_obj.add("stage_bytes", num_bytes,
+                        "Bytes read in each stage.", {"stage": stage})
+
+    return metrics_obj
 
 
 # ------------------------------------------------------------------------------
@@ -615,6 +1858,96 @@ def compare_two_files(file_a, file_b, single_pass=False):
     return False
 
 
+# ------------------------------------------------------------------------------
+def verify_hash_algo(algorithm, size):
+    """
+    Check to see that the hash algorithm (and digest size) requested is one
+    that is available on this machine.
+
+    :param algorithm: The name of the hashlib algorithm.
+    :param size: The digest size in bytes, or 0 for the algorithm's default.
+
+    :return: Nothing.
+    """
+
+    try:
+        lib.new_hash(algorithm, size).hexdigest()
+    except (ValueError, TypeError) as err:
+        msg = resources_obj.get("errors", "bad_hash_algo")
+        lib.display_error(lib.format_string(msg.format(
+            hash_algo=algorithm, digest_size=size, error=err)))
+        sys.exit(1)
+
+
+# ------------------------------------------------------------------------------
+def verify_output_format(output_format):
+    """
+    Check to see that the output format requested is one that is supported.
+
+    :param output_format: The name of the output format.
+
+    :return: Nothing.
+    """
+
+    if output_format not in OUTPUT_FORMATS:
+        msg = resources_obj.get("errors", "bad_output_format")
+        lib.display_error(lib.format_string(msg.format(
+            output_format=output_format, formats=", ".join(OUTPUT_FORMATS))))
+        sys.exit(1)
+
+
+# ------------------------------------------------------------------------------
+def verify_dirs_to_skip(skip_sub_dirs, dirs_to_skip, skip_option, list_option,
+                        from_preset=False):
+    """
+    Check that a list of sub-directories to skip is only given along with the
+    flag that turns skipping on, rather than being silently ignored.
+
+    Presets saved by older versions always have the flag turned off, even when
+    they hold a list, so a list that came from a preset is only warned about
+    (and dropped) rather than stopping the run.
+
+    :param skip_sub_dirs: Whether skipping sub-directories is turned on.
+    :param dirs_to_skip: The list of sub-directories to skip.
+    :param skip_option: The command line option that turns skipping on.
+    :param list_option: The command line option that gives the list.
+    :param from_preset: Whether the settings were loaded from a preset.
+           Defaults to False.
+
+    :return: The list of sub-directories to skip.
+    """
+
+    if dirs_to_skip and not skip_sub_dirs:
+        if from_preset:
+            msg = resources_obj.get("errors", "dirs_to_skip_ignored")
+            lib.display_error(lib.format_string(msg.format(
+                list_option=list_option, skip_option=skip_option)))
+            return list()
+        msg = resources_obj.get("errors", "dirs_to_skip_without_flag")
+        lib.display_error(lib.format_string(msg.format(
+            list_option=list_option, skip_option=skip_option)))
+        sys.exit(1)
+
+    return dirs_to_skip
+
+
+# ------------------------------------------------------------------------------
+def verify_debug_limit(debug_limit):
+    """
+    Check that the old --debug-limit option was not given. It limited the debug
+    log to a number of lines, which --debug-max-mb (a size) now replaces.
+
+    :param debug_limit: The value given to --debug-limit, or None.
+
+    :return: Nothing.
+    """
+
+    if debug_limit is not None:
+        msg = resources_obj.get("errors", "debug_limit_removed")
+        lib.display_error(lib.format_string(msg))
+        sys.exit(1)
+
+
 # ------------------------------------------------------------------------------
 def verify_preset():
     """
@@ -684,14 +2017,30 @@ if __name__ == "__main__":
 
     # Set up the option parser and process the command line options.
     options, sys.argv[1:] = define_options()
+    verify_debug_limit(options.debug_limit)
 
     # If they want to write out the settings to a preset file, verify that now
     preset_out_obj = verify_preset()
 
+    # There is no digest cache until the settings are known, so comparing two
+    # files from the command line always reads them. Within a run, though, each
+    # digest get_digest computes is only ever computed once.
+    digest_cache_obj = None
+    digest_memo = dict()
+    hash_pool_obj = None
+    stage_timers = StageTimers()
+    stage_progress = dict()
+    verify_hash_algo(options.hash_algo, options.digest_size)
+    verify_output_format(options.output_format)
+    hash_algo = options.hash_algo
+    digest_size = options.digest_size
+    mmap_threshold = options.mmap_threshold
+
     # If they want to compare two files to see if they match.
     verify_compare()
 
     # If they want to load from a preset, load the preset into the defaults.
+    from_preset = False
     if options.use_preset:
 
         # There should be exactly 2 items left in the args
@@ -701,6 +2050,7 @@ if __name__ == "__main__":
             sys.exit(1)
 
         defaults = load_defaults_from_preset(sys.argv[1])
+        from_preset = True
 
     # Not loading a preset
     else:
@@ -720,6 +2070,7 @@ if __name__ == "__main__":
             if os.path.exists(preset_path):
                 defaults = load_defaults_from_preset(
                     os.path.expanduser(preset_path))
+                from_preset = True
 
             # Otherwise, load the actual default values as defined by the app
             else:
@@ -740,6 +2091,15 @@ if __name__ == "__main__":
     if options.interactive:
         settings.run_wizard()
 
+    # Check the lists of sub-directories to skip before saving them, so that a
+    # list dropped from an old preset is not saved again.
+    settings.source_dirs_to_skip = verify_dirs_to_skip(
+        settings.skip_source, settings.source_dirs_to_skip,
+        "-k (--skip-source)", "--source-dirs-to-skip", from_preset)
+    settings.target_dirs_to_skip = verify_dirs_to_skip(
+        settings.skip_target_sub_dirs, settings.target_dirs_to_skip,
+        "-K (--skip-target)", "--target-dirs-to-skip", from_preset)
+
     # Always save a preset to ~/.findDuplicates/last_run.preset
     preset_path = os.path.expanduser("~/.findDuplicates/last_run.preset")
     settings.write_preset(preset_path)
@@ -749,24 +2109,83 @@ if __name__ == "__main__":
         preset_path = os.path.expanduser(options.save_preset)
         settings.write_preset(preset_path)
 
+    # Use the hash algorithm from the final settings
+    verify_hash_algo(settings.hash_algo, settings.digest_size)
+    verify_output_format(settings.output_format)
+    hash_algo = settings.hash_algo
+    digest_size = settings.digest_size
+    mmap_threshold = settings.mmap_threshold
+
     # Initialize the debug object
+    if settings.debug_level not in LEVELS:
+        msg = resources_obj.get("errors", "bad_debug_level")
+        lib.display_error(lib.format_string(msg.format(
+            debug_level=settings.debug_level, levels=", ".join(LEVELS))))
+        sys.exit(1)
     debug_obj = Debug(
         do_debug=settings.do_debug,
         resources_obj=resources_obj,
-        max_count=settings.debug_limit,
-        exit_on_max_count=True,
         write_to_file=True,
         write_to_stdout=False,
-        write_to_stderr=False)
+        write_to_stderr=False,
+        level=settings.debug_level,
+        max_bytes=settings.debug_max_mb * 1024 * 1024)
 
-    # Create the log files
-    lib.display_message("\n\n\n\n")
-    results_log = create_duplicates_log(settings.log_file)
-    errors_log = create_error_log(settings.log_file)
+    # Open the persistent digest cache
+    if settings.use_digest_cache:
+        try:
+            digest_cache_obj = DigestCache(
+                max_entries=settings.digest_cache_limit)
+        except (OSError, sqlite3.Error) as err:
+            msg = resources_obj.get("errors", "cannot_open_digest_cache")
+            lib.display_error(lib.format_string(msg.format(error=err)))
+
+    # Start up the pool of hashing processes
+    if settings.jobs > 1:
+        hash_pool_obj = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.jobs)
+
+    # Keep a checkpoint next to the log file, if asked to, so that a run that
+    # dies part way through can be resumed (see do_compare). A resumed run
+    # keeps saving checkpoints in case it dies again.
+    if options.resume and settings.checkpoint_interval == 0:
+        settings.checkpoint_interval = RESUME_CHECKPOINT_INTERVAL
+    checkpoint_obj = None
+    if settings.checkpoint_interval > 0:
+        checkpoint_obj = Checkpoint(settings.log_file + ".checkpoint",
+                                    checkpoint_key())
+    resume_state = None
+    progress_state = None
+    results_position = None
+    errors_position = None
+    if options.resume:
+        resume_state = checkpoint_obj.load()
+        if resume_state is None:
+            lib.display_message(resources_obj.get("messages",
+                                                  "resume_not_found"))
+        else:
+            results_position = resume_state[1]["results_position"]
+            errors_position = resume_state[1]["errors_position"]
 
-    # DEBUG
-    debug_obj.debug("\n\nScanning Source Dir: ", settings.source_dir)
-    debug_obj.debug("#"*60)
+    # Create the log files (or carry on with the ones from the checkpoint)
+    lib.display_message("\n\n\n\n")
+    results_log = create_duplicates_log(settings.log_file,
+                                        settings.output_format,
+                                        len(settings.target_dirs) > 1,
+                                        results_position)
+    errors_log = create_error_log(settings.log_file, errors_position)
+
+    # Where to keep the directory listings between runs (if anywhere)
+    snapshot_dir = None
+    if settings.incremental_scan:
+        snapshot_dir = os.path.expanduser("~/.findDuplicates/snapshots")
+
+    # Every scan reads its directories in the same pool, so that no more than
+    # scan_jobs directory reads are in flight however many scans there are.
+    scan_executor = None
+    if settings.scan_jobs > 1:
+        scan_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.scan_jobs)
 
     # Build the source list
     source_obj = ScanDirectory(
@@ -778,27 +2197,151 @@ if __name__ == "__main__":
         patterns=settings.pattern_list,
         skip_zero_len=settings.skip_zero_len,
         type_is_source=True,
-        debug_obj=debug_obj
+        debug_obj=debug_obj,
+        scan_jobs=settings.scan_jobs,
+        snapshot_dir=snapshot_dir,
+        force_full_scan=options.force_full_scan,
+        dirs_to_skip=(settings.source_dirs_to_skip
+                      if settings.skip_source else None),
+        max_depth=settings.max_depth,
+        executor=scan_executor
     )
-    source_obj.scan()
+
+    # Build a target list for each target directory. A target directory inside
+    # another one would only add its files a second time.
+    target_dirs, nested_dirs = drop_nested_dirs(settings.target_dirs)
+    for target_dir, other_dir in nested_dirs:
+        nested_msg = resources_obj.get("messages", "target_nested")
+        lib.display_message(nested_msg.format(target_dir=target_dir,
+                                              other_dir=other_dir))
+    target_objs = list()
+    for target_dir in target_dirs:
+        target_objs.append(ScanDirectory(
+            scan_dir=target_dir,
+            resources_obj=resources_obj,
+            skip_hidden=settings.skip_hidden,
+            skip_dsstore=settings.skip_dsstore,
+            limit_to_patterns=settings.limit_to_patterns,
+            patterns=settings.pattern_list,
+            skip_zero_len=settings.skip_zero_len,
+            type_is_source=False,
+            debug_obj=debug_obj,
+            scan_jobs=settings.scan_jobs,
+            snapshot_dir=snapshot_dir,
+            force_full_scan=options.force_full_scan,
+            dirs_to_skip=(settings.target_dirs_to_skip
+                          if settings.skip_target_sub_dirs else None),
+            max_depth=settings.max_depth,
+            executor=scan_executor
+        ))
+    target_obj = target_objs[0]
 
     # DEBUG
-    debug_obj.debug("\n\nScanning Target Dir: ", settings.target_dir)
+    debug_obj.debug("\n\nScanning Source Dir: ", settings.source_dir)
+    debug_obj.debug("\n\nScanning Target Dirs: ", ", ".join(target_dirs))
     debug_obj.debug("#"*60)
 
-    # Build the target list
-    target_obj = ScanDirectory(
-        scan_dir=settings.target_dir,
-        resources_obj=resources_obj,
-        skip_hidden=settings.skip_hidden,
-        skip_dsstore=settings.skip_dsstore,
-        limit_to_patterns=settings.limit_to_patterns,
-        patterns=settings.pattern_list,
-        skip_zero_len=settings.skip_zero_len,
-        type_is_source=False,
-        debug_obj=debug_obj
-    )
-    target_obj.scan()
+    run_started = time.time()
+
+    # Profile everything from here on if asked to. Only this process is
+    # profiled, not the hashing processes.
+    profile_obj = None
+    if options.profile:
+        profile_obj = cProfile.Profile()
+        profile_obj.enable()
+
+    # Pick up the scan from the checkpoint if we are resuming
+    if resume_state is not None:
+        scan_state, progress_state = resume_state
+        resume_msg = resources_obj.get("messages", "resume_found")
+        lib.display_message(resume_msg.format(
+            saved_time=progress_state["saved_time"],
+            done_up_to=progress_state["done_up_to"]))
+        overlap = scan_state["overlap"]
+        source_obj.set_state(scan_state["source"])
+        if overlap == "same" and len(target_objs) == 1:
+            target_obj = source_obj
+        else:
+            target_obj.set_state(scan_state["target"])
+        scanned_bytes = scan_state["scanned_bytes"]
+
+    else:
+
+        # If the source overlaps a target directory, only the outer one of the
+        # two is scanned. The inner one is taken from its scan. Nested target
+        # directories have already been dropped, so at most one target can be
+        # the source or hold it, and then no other target is inside the source.
+        overlaps = [find_overlap(settings.source_dir, target_dir)
+                    for target_dir in target_dirs]
+
+        # Taking the files of one directory from the scan of another would
+        # also take the other's pruning, which is only right if the two are the
+        # same directory and prune the same sub-directories.
+        for index, other_obj in enumerate(target_objs):
+            if overlaps[index] is not None and \
+                    (source_obj.prunes_dirs() or other_obj.prunes_dirs()):
+                if overlaps[index] != "same" or \
+                        source_obj.get_dir_filters() != \
+                        other_obj.get_dir_filters():
+                    overlaps[index] = None
+
+        overlap = None
+        for target_overlap in overlaps:
+            if target_overlap is not None:
+                overlap = target_overlap
+                break
+
+        if "same" in overlaps:
+            lib.display_message(resources_obj.get("messages", "scan_same"))
+
+        # Scan every directory that is not inside another one
+        if "source_in_target" in overlaps:
+            outer_obj = target_objs[overlaps.index("source_in_target")]
+            scan_objs = list()
+        else:
+            outer_obj = source_obj
+            scan_objs = [source_obj]
+        for index, other_obj in enumerate(target_objs):
+            if overlaps[index] in [None, "source_in_target"]:
+                scan_objs.append(other_obj)
+
+        # If we are scanning in parallel, scan them all at the same time as
+        # well, on one progress line.
+        if settings.scan_jobs > 1 and len(scan_objs) > 1:
+            scan_progress = Progress(
+                resources_obj, resources_obj.get("messages", "stage_scan"))
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(scan_objs)) as scan_pool:
+                scans = [scan_pool.submit(timed_scan, scan_obj, scan_progress)
+                         for scan_obj in scan_objs]
+                for scan in scans:
+                    scan.result()
+            scan_progress.finish()
+        else:
+            for scan_obj in scan_objs:
+                timed_scan(scan_obj)
+
+        # Remember how much there was to compare before any of it is pruned
+        scanned_bytes = sum([sum(scan_obj.files.sizes)
+                             for scan_obj in scan_objs])
+
+        # Then take the inner directories from those scans
+        if outer_obj is not source_obj:
+            source_obj.scan_from(outer_obj)
+        if overlaps == ["same"]:
+            target_obj = source_obj
+        else:
+            for index, other_obj in enumerate(target_objs):
+                if overlaps[index] in ["same", "target_in_source"]:
+                    other_obj.scan_from(source_obj)
+
+        # Put every target directory into one table so that each source file
+        # is only looked up (and read) once, however many targets there are.
+        for other_obj in target_objs[1:]:
+            target_obj.add_scan(other_obj)
+
+    if scan_executor is not None:
+        scan_executor.shutdown()
 
     # Display a status to the user
     status_msg = resources_obj.get("messages", "start_comparing")
@@ -806,26 +2349,72 @@ if __name__ == "__main__":
         source_count=source_obj.get_count(),
         source_dir=source_obj.scan_dir,
         target_count=target_obj.get_count(),
-        target_dir=target_obj.scan_dir,
+        target_dir=", ".join(target_obj.roots),
         start_time=time.strftime("%I:%M:%S"),
     )
     lib.display_message(lib.format_string(status_msg))
     lib.display_message("-" * 80)
 
+    # Drop every file whose size is only on one side before reading anything
+    # (already done if we are resuming)
+    if resume_state is not None:
+        num_source_pruned, num_target_pruned, bytes_pruned = \
+            scan_state["pruned"]
+    else:
+        with stage_timers.stage("prune", source_obj.get_count() +
+                                target_obj.get_count()):
+            num_source_pruned, num_target_pruned, bytes_pruned = \
+                prune_unmatched_sizes(source_obj, target_obj)
+    prune_msg = resources_obj.get("messages", "prune_summary")
+    prune_msg = prune_msg.format(
+        num_source_pruned=num_source_pruned,
+        num_target_pruned=num_target_pruned,
+        mb_pruned=round(bytes_pruned / (1024 * 1024), 1),
+    )
+    lib.display_message(lib.format_string(prune_msg))
+
+    # Save the pruned scan (once) and the fact that nothing has been compared
+    # yet
+    if checkpoint_obj is not None and resume_state is None:
+        checkpoint_obj.save_scan({
+            "overlap": overlap,
+            "source": source_obj.get_state(),
+            "target": target_obj.get_state(),
+            "scanned_bytes": scanned_bytes,
+            "pruned": (num_source_pruned, num_target_pruned, bytes_pruned),
+        })
+        save_progress(checkpoint_obj, -1, (0, 0, 0, 0))
+
     # Do the actual comparison
     lib.display_message("\n\n")
-    num_source_files_with_dupes, final_dup_count = do_compare(source_obj,
-                                                              target_obj)
+    (num_source_files_with_dupes, final_dup_count,
+     num_source_files_with_links, final_link_count) = do_compare(
+        source_obj, target_obj, self_dedupe=overlap is not None,
+        checkpoint_obj=checkpoint_obj,
+        progress_state=progress_state)
+
+    # Stop profiling (the rest is just printing the summary)
+    if profile_obj is not None:
+        profile_obj.disable()
+        profile_obj.dump_stats(os.path.expanduser(options.profile))
 
     # clean up
-    results_log.close()
+    with stage_timers.stage("write"):
+        results_log.close()
+    if checkpoint_obj is not None:
+        checkpoint_obj.remove()
     errors_log.close()
+    debug_obj.close()
+    if digest_cache_obj is not None:
+        digest_cache_obj.close()
+    if hash_pool_obj is not None:
+        hash_pool_obj.shutdown()
 
     summary = resources_obj.get("messages", "summary")
     summary = summary.format(
         time_now=time.strftime("%I:%M:%S"),
         source_dir=settings.source_dir,
-        target_dir=settings.target_dir,
+        target_dir=", ".join(target_dirs),
         source_file_count=source_obj.get_count(),
         target_file_count=target_obj.get_count(),
         num_duplicates=num_source_files_with_dupes,
@@ -836,4 +2425,51 @@ if __name__ == "__main__":
     summary = lib.format_string(summary)
     lib.display_message(summary)
 
-
+    if final_link_count:
+        link_summary = resources_obj.get("messages", "hardlink_summary")
+        link_summary = link_summary.format(
+            num_hardlinks=num_source_files_with_links,
+            num_target_hardlinks=final_link_count
+        )
+        lib.display_message(lib.format_string(link_summary))
+
+    if digest_cache_obj is not None:
+        cache_summary = resources_obj.get("messages", "digest_cache_summary")
+        cache_summary = cache_summary.format(
+            hits=digest_cache_obj.hits,
+            misses=digest_cache_obj.misses,
+            invalidations=digest_cache_obj.invalidations,
+            evictions=digest_cache_obj.evictions,
+            cache_file=digest_cache_obj.cache_file
+        )
+        lib.display_message(lib.format_string(cache_summary))
+
+    # Show where the time went
+    lib.display_message(lib.format_string(
+        resources_obj.get("messages", "stage_timer_header")))
+    for line in stage_timers.summary(resources_obj):
+        lib.display_message(line)
+
+    if profile_obj is not None:
+        profile_msg = resources_obj.get("messages", "profile_written")
+        lib.display_message(lib.format_string(profile_msg.format(
+            profile_file=os.path.expanduser(options.profile))))
+
+    # Write the metrics for this run next to the results log
+    metrics_obj = build_metrics(
+        source_obj, target_obj, scanned_bytes,
+        (num_source_pruned, num_target_pruned, bytes_pruned),
+        (num_source_files_with_dupes, final_dup_count,
+         num_source_files_with_links, final_link_count),
+        run_started)
+    try:
+        metrics_obj.write_json(settings.log_file + ".metrics.json")
+        metrics_obj.write_prometheus(settings.log_file + ".prom")
+    except (OSError, IOError) as err:
+        msg = resources_obj.get("errors", "cannot_write_metrics")
+        lib.display_error(lib.format_string(msg.format(error=err)))
+    else:
+        metrics_msg = resources_obj.get("messages", "metrics_written")
+        lib.display_message(lib.format_string(metrics_msg.format(
+            json_file=settings.log_file + ".metrics.json",
+            prom_file=settings.log_file + ".prom")))
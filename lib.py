@@ -1,4 +1,7 @@
-import math
+import ast
+import hashlib
+import mmap
+import os
 import sys
 
 # define some colors
@@ -20,70 +23,301 @@ BRIGHT_CYAN = '\033[96m'
 BRIGHT_WHITE = '\033[97m'
 ENDC = '\033[0m'
 
+# The most files split_identical_files will hold open at once.
+MAX_STREAM_FILES = 64
+
+
+# ------------------------------------------------------------------------------
+def new_hash(algorithm="md5", digest_size=0):
+    """
+    Returns a new hash object.
+
+    :param algorithm: The name of any algorithm supported by hashlib (blake2b,
+           blake2s, sha1, sha256, md5, etc.). Defaults to md5.
+    :param digest_size: The size of the digest in bytes. Only the blake2
+           algorithms support this. If 0, the algorithm's default digest size is
+           used. Defaults to 0.
+
+    :return: A hashlib hash object.
+    """
+
+    if digest_size:
+        return hashlib.new(algorithm, digest_size=digest_size)
+    return hashlib.new(algorithm)
+
+
+# ------------------------------------------------------------------------------
+def partial_checksum(file_path, num_bytes=1024, algorithm="md5",
+                     digest_size=0):
+    """
+    Returns the checksum of the first num_bytes of a file.
+
+    :param file_path: The file to checksum.
+    :param num_bytes: The number of bytes to hash. Defaults to 1K (1024)
+    :param algorithm: The hashlib algorithm to use. Defaults to md5.
+    :param digest_size: The size of the digest in bytes (blake2 only). If 0,
+           the algorithm's default size is used. Defaults to 0.
+
+    :return: The hex digest of the first num_bytes of the file.
+    """
+
+    with open(file_path, 'rb') as f:
+        chunk = f.read(num_bytes)
+    hash_obj = new_hash(algorithm, digest_size)
+    hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
+# ------------------------------------------------------------------------------
+def sample_offsets(file_size, sample_size=4096, sample_count=5):
+    """
+    Works out where in a file the sample blocks should be read from. There is
+    always a block at the head, the middle and the tail of the file, plus
+    sample_count evenly spaced blocks between them.
+
+    :param file_size: The size of the file in bytes.
+    :param sample_size: The size of each sample block in bytes. Defaults to 4K.
+    :param sample_count: The number of evenly spaced blocks to add to the head,
+           middle and tail blocks. Defaults to 5.
+
+    :return: A sorted list of byte offsets.
+    """
+
+    last = max(0, file_size - sample_size)
+
+    offsets = {0, last // 2, last}
+    for i in range(1, sample_count + 1):
+        offsets.add(last * i // (sample_count + 1))
+
+    return sorted(offsets)
+
+
+# ------------------------------------------------------------------------------
+def sampled_checksum(file_path, sample_size=4096, sample_count=5,
+                     algorithm="md5", digest_size=0):
+    """
+    Returns the checksum of a number of small blocks sampled from throughout a
+    file (see sample_offsets). Two files with different sampled checksums are
+    certainly different, while only reading a few KB of each.
+
+    :param file_path: The file to checksum.
+    :param sample_size: The size of each sample block in bytes. Defaults to 4K.
+    :param sample_count: The number of evenly spaced blocks to sample in
+           addition to the head, middle and tail. Defaults to 5.
+    :param algorithm: The hashlib algorithm to use. Defaults to md5.
+    :param digest_size: The size of the digest in bytes (blake2 only). If 0,
+           the algorithm's default size is used. Defaults to 0.
+
+    :return: The hex digest of the sampled blocks.
+    """
+
+    hash_obj = new_hash(algorithm, digest_size)
+
+    # Unbuffered, so that each sample only reads the bytes it needs.
+    with open(file_path, 'rb', buffering=0) as f:
+        file_size = os.fstat(f.fileno()).st_size
+        for offset in sample_offsets(file_size, sample_size, sample_count):
+            f.seek(offset)
+            hash_obj.update(f.read(sample_size))
+
+    return hash_obj.hexdigest()
+
+
+# ------------------------------------------------------------------------------
+def mmap_checksum(file_path, algorithm="md5", digest_size=0,
+                  chunk_size=1048576):
+    """
+    Returns the checksum of an entire file by memory mapping it and feeding
+    slices of the mapping straight to the hash. No bytes objects are created
+    and no read calls are made, which is much cheaper for very large files.
+
+    :param file_path: The file to checksum.
+    :param algorithm: The hashlib algorithm to use. Defaults to md5.
+    :param digest_size: The size of the digest in bytes (blake2 only). If 0,
+           the algorithm's default size is used. Defaults to 0.
+    :param chunk_size: How many bytes to hand the hash at a time. Defaults to
+           1MB.
+
+    :return: The hex digest of the file.
+
+    :raises: ValueError or OSError if the file cannot be memory mapped (empty
+             files, or file systems that do not support it).
+    """
+
+    hash_obj = new_hash(algorithm, digest_size)
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for offset in range(0, len(view), chunk_size):
+                    hash_obj.update(view[offset:offset + chunk_size])
+    return hash_obj.hexdigest()
+
+
+# ------------------------------------------------------------------------------
+def full_checksum(file_path, algorithm="md5", digest_size=0,
+                  mmap_threshold=0):
+    """
+    Returns the checksum of an entire file.
+
+    :param file_path: The file to checksum.
+    :param algorithm: The hashlib algorithm to use. Defaults to md5.
+    :param digest_size: The size of the digest in bytes (blake2 only). If 0,
+           the algorithm's default size is used. Defaults to 0.
+    :param mmap_threshold: Files of at least this many bytes are memory mapped
+           instead of read (see mmap_checksum), falling back to reading them if
+           that fails. If 0, files are always read. Defaults to 0.
+
+    :return: The hex digest of the file.
+    """
+
+    if mmap_threshold and os.path.getsize(file_path) >= mmap_threshold:
+        try:
+            return mmap_checksum(file_path, algorithm, digest_size)
+        except (ValueError, OSError):
+            # Either the file system does not support mmap, or the file
+            # changed underneath us. Either way, read it the usual way (which
+            # will raise a genuine read error if there is one).
+            pass
+
+    hash_obj = new_hash(algorithm, digest_size)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(128 * hash_obj.block_size), b''):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
 
 # ------------------------------------------------------------------------------
-def display_progress(count, total, old_percent, width=50, completed_char="#",
-                     empty_char="."):
-    """
-    Draws and updates ASCII progress bar on the stdout.
-
-    :param count: The current count for our progress bar.
-    :param total: The count at 100%.
-    :param old_percent: The previous percent. Necessary to prevent updates if
-           the percentage has not changed since the last call.
-    :param width: How wide to draw the progress bar in characters. If given an
-           odd number, it will be rounded down to the nearest even value.
-    :param completed_char: The character to display for a completed chunk.
-    :param empty_char: The character to display for an as-yet uncompleted chunk.
-
-    :return: The percent value for the current state.
-    """
-
-    # only allow even numbered widths
-    if width % 2 != 0:
-        width -= 1
-
-    # calculate the percent
-    percent = round((count * 1.0) / total * 100, 1)
-
-    # only update the display if the percentage has changed
-    if percent == old_percent:
-        return percent
-
-    # build the completed and uncompleted portions of the progress bar
-    done_str = "{0}".format(completed_char *
-        (int(round(percent / (100 / width), 0))))
-    empty_str = "{0}".format(empty_char *
-        (width - (int(round(percent / (100 / width))))))
-
-    # build the X out of Y text
-    count_str = " (" + BRIGHT_WHITE + str(count) + ENDC + " of " + \
-                BRIGHT_WHITE + str(total) + ENDC + ")"
-
-    # build the percent string
-    percent_str = "{0}".format(" " *
-        (4 - len(str(int(math.floor(percent)))))) + str(percent) + "%" + " "
-
-    # build the complete string, and insert the percent
-    progress_bar_str = "[" + done_str + empty_str + "]"
-    progress_left = progress_bar_str[:int((len(progress_bar_str) / 2) -
-                                     math.floor(len(percent_str) / 2)) + 2]
-    progress_right = progress_bar_str[int((len(progress_bar_str) / 2) +
-                                      math.ceil(len(percent_str) / 2)) + 2:]
-    progress_bar_str = progress_left
-    progress_bar_str += BRIGHT_YELLOW + percent_str + ENDC
-    progress_bar_str += progress_right
-
-    # append the count string
-    progress_bar_str += count_str
-
-    # show it
-    sys.stdout.write(progress_bar_str)
-    sys.stdout.flush()
-    sys.stdout.write("\b" * (len(progress_bar_str)))  # return to start of line
-
-    # return the percent (so that we only update the percentage when it changes)
-    return percent
+def split_identical_files(file_paths, block_size=1048576, algorithm=None,
+                          digest_size=0):
+    """
+    Reads a group of files of the same size side by side, one block at a time,
+    and splits them into groups of identical files. As soon as a file's block
+    differs from every other file's block it is closed and never read again, so
+    files that differ early cost very little, and files that are identical are
+    confirmed byte for byte.
+
+    Every file in the group is open at the same time, so the group may hold no
+    more than MAX_STREAM_FILES files.
+
+    :param file_paths: A list of paths to files that are all the same size.
+    :param block_size: How many bytes to read from each file at a time.
+           Defaults to 1MB.
+    :param algorithm: If not None, each group of identical files is also
+           checksummed with this algorithm as it is read (which gives the same
+           digest as full_checksum). Defaults to None.
+    :param digest_size: The digest size to use with algorithm (see new_hash).
+           Defaults to 0.
+
+    :return: A list of tuples where the first item is a list of two or more
+             paths of files with identical contents, and the second is their
+             hex digest (or None if no algorithm was given). Files that match no
+             other file are not included.
+    """
+
+    if len(file_paths) > MAX_STREAM_FILES:
+        raise ValueError("Cannot stream compare more than " +
+                         str(MAX_STREAM_FILES) + " files at once.")
+
+    output = list()
+    handles = dict()
+
+    try:
+        for file_path in file_paths:
+            handles[file_path] = open(file_path, 'rb')
+
+        hash_obj = None
+        if algorithm is not None:
+            hash_obj = new_hash(algorithm, digest_size)
+
+        pending = [(list(file_paths), hash_obj)]
+        while pending:
+
+            still_pending = list()
+            for group, hash_obj in pending:
+
+                blocks = dict()
+                for file_path in group:
+                    block = handles[file_path].read(block_size)
+                    blocks.setdefault(block, list()).append(file_path)
+
+                for block, members in blocks.items():
+                    if len(members) < 2:
+                        handles[members[0]].close()
+                    elif block == b'':
+                        output.append((members, hash_obj and
+                                       hash_obj.hexdigest()))
+                    else:
+                        member_hash_obj = None
+                        if hash_obj is not None:
+                            member_hash_obj = hash_obj
+                            if len(blocks) > 1:
+                                member_hash_obj = hash_obj.copy()
+                            member_hash_obj.update(block)
+                        still_pending.append((members, member_hash_obj))
+
+            pending = still_pending
+
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def run_job(job):
+    """
+    Runs a single job. This is the unit of work handed to the hashing pool, so
+    any error reading a file is returned rather than raised (which would
+    otherwise abort every other job in the same batch).
+
+    :param job: A tuple containing the function to run, the item to run it on
+           (i.e. the path of the file to checksum), and a tuple of any
+           additional arguments to pass to the function.
+
+    :return: A tuple where the first item is the result (or None if a file
+             could not be read), and the second is the error as a string (or
+             None if there was no error).
+    """
+
+    function, item, args = job
+
+    try:
+        return function(item, *args), None
+    except (OSError, IOError) as err:
+        return None, str(err)
+
+
+# ------------------------------------------------------------------------------
+def parse_list(value):
+    """
+    Converts a setting that may hold several items into a list. The value may
+    already be a list, or it may be a string holding a Python style list (as
+    written to presets), a comma separated list of quoted items (as given on
+    the command line), or a single unquoted item. A value that only looks like
+    one of the lists (i.e. a directory called "[photos]") is a single item.
+
+    :param value: The value to convert.
+
+    :return: A list of strings. Empty if the value is None or empty.
+    """
+
+    if value is None:
+        return list()
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+
+    value = str(value).strip()
+    if not value:
+        return list()
+    try:
+        if value[0] == "[":
+            return [str(item) for item in ast.literal_eval(value)]
+        if value[0] in "\"'":
+            return [str(item) for item in ast.literal_eval("[" + value + "]")]
+    except (ValueError, SyntaxError):
+        pass
+    return [value]
 
 
 # ------------------------------------------------------------------------------
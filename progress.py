@@ -0,0 +1,199 @@
+import sys
+import threading
+import time
+
+
+class Progress(object):
+    """
+    Reports the progress of a single stage (scanning a directory, hashing a
+    batch of files, etc.) on stdOut.
+
+    The display is only redrawn every interval seconds, no matter how often
+    update is called, so it costs next to nothing per file. On a terminal the
+    line is redrawn in place. When stdOut is not a terminal (a cron job, or
+    output piped to a file), a plain line is printed every log_interval seconds
+    instead.
+
+    Several threads may update the same object (e.g. the source and target
+    scans running at once), in which case they share one line.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, resources_obj, stage, total_files=0, total_bytes=0,
+                 interval=0.1, log_interval=10.0, stream=None):
+        """
+        Initializes the object.
+
+        :param resources_obj: The resources object.
+        :param stage: The name of the stage to display.
+        :param total_files: The number of files in the stage, or 0 if it is not
+               known ahead of time. Defaults to 0.
+        :param total_bytes: The number of bytes that will be read in the stage,
+               or 0 if it is not known. Defaults to 0.
+        :param interval: The least time, in seconds, between redraws on a
+               terminal. Defaults to 0.1 (at most 10 redraws a second).
+        :param log_interval: The least time, in seconds, between lines when not
+               writing to a terminal. Defaults to 10.0.
+        :param stream: The stream to write to. If None, stdOut is used.
+               Defaults to None.
+
+        :return: Nothing.
+        """
+
+        self.resources_obj = resources_obj
+        self.stage = stage
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.stream = stream if stream is not None else sys.stdout
+        self.is_tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.interval = interval if self.is_tty else log_interval
+
+        self.files_done = 0
+        self.bytes_done = 0
+        self.start_time = time.monotonic()
+        self.last_draw = self.start_time
+        self.last_width = 0
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def update(self, files=1, num_bytes=0):
+        """
+        Records that more files have been processed, and redraws the display if
+        it has not been redrawn for a while.
+
+        :param files: The number of files processed since the last update.
+               Defaults to 1.
+        :param num_bytes: The number of bytes read since the last update.
+               Defaults to 0.
+
+        :return: Nothing.
+        """
+
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += num_bytes
+
+            now = time.monotonic()
+            if now - self.last_draw >= self.interval:
+                self.last_draw = now
+                self.draw(now)
+
+    # --------------------------------------------------------------------------
+    def add_work(self, files=0, num_bytes=0):
+        """
+        Adds to the total amount of work in the stage, for stages whose work
+        arrives a batch at a time.
+
+        :param files: The number of files to add to the total. Defaults to 0.
+        :param num_bytes: The number of bytes to add to the total. Defaults to
+               0.
+
+        :return: Nothing.
+        """
+
+        with self.lock:
+            self.total_files += files
+            self.total_bytes += num_bytes
+
+    # --------------------------------------------------------------------------
+    def message(self, msg):
+        """
+        Prints a message on a line of its own without breaking up the progress
+        line. On a terminal the progress line is cleared first, and drawn again
+        below the message.
+
+        :param msg: The message to print.
+
+        :return: Nothing.
+        """
+
+        with self.lock:
+            if self.is_tty and self.last_width:
+                self.stream.write("\r" + " " * self.last_width + "\r")
+            self.stream.write(msg + "\n")
+            if self.is_tty and self.last_width:
+                self.draw(time.monotonic())
+            self.stream.flush()
+
+    # --------------------------------------------------------------------------
+    def finish(self):
+        """
+        Draws the final state of the stage and moves on to a new line.
+
+        :return: Nothing.
+        """
+
+        with self.lock:
+            self.draw(time.monotonic())
+            if self.is_tty:
+                self.stream.write("\n")
+                self.stream.flush()
+
+    # --------------------------------------------------------------------------
+    def format_line(self, now):
+        """
+        Builds the text describing the current progress.
+
+        :param now: The current time (from time.monotonic).
+
+        :return: A string.
+        """
+
+        elapsed = max(now - self.start_time, 0.000001)
+        files_per_sec = self.files_done / elapsed
+        mb_per_sec = self.bytes_done / elapsed / (1024 * 1024)
+
+        if not self.total_files:
+            line = self.resources_obj.get("messages", "progress_open")
+            return line.format(stage=self.stage,
+                               files_done=self.files_done,
+                               files_per_sec=int(files_per_sec))
+
+        # Estimate the time left from whichever measure of the work we have
+        bytes_left = max(0, self.total_bytes - self.bytes_done)
+        if self.total_bytes and self.bytes_done:
+            seconds_left = bytes_left / (self.bytes_done / elapsed)
+        elif self.files_done:
+            seconds_left = (self.total_files - self.files_done) / files_per_sec
+        else:
+            seconds_left = None
+
+        if seconds_left is None:
+            eta = "--:--:--"
+        else:
+            seconds_left = int(seconds_left)
+            eta = "{0:02d}:{1:02d}:{2:02d}".format(seconds_left // 3600,
+                                                   seconds_left // 60 % 60,
+                                                   seconds_left % 60)
+
+        line = self.resources_obj.get("messages", "progress")
+        return line.format(
+            stage=self.stage,
+            percent=round(self.files_done * 100.0 / self.total_files, 1),
+            files_done=self.files_done,
+            total_files=self.total_files,
+            files_per_sec=int(files_per_sec),
+            mb_per_sec=round(mb_per_sec, 1),
+            mb_left=round(bytes_left / (1024 * 1024), 1),
+            eta=eta)
+
+    # --------------------------------------------------------------------------
+    def draw(self, now):
+        """
+        Writes the current progress out, either over the previous line (on a
+        terminal) or as a line of its own.
+
+        :param now: The current time (from time.monotonic).
+
+        :return: Nothing.
+        """
+
+        line = self.format_line(now)
+
+        if self.is_tty:
+            self.stream.write("\r" + line +
+                              " " * max(0, self.last_width - len(line)))
+            self.last_width = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
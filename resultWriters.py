@@ -0,0 +1,391 @@
+import csv
+import json
+import sqlite3
+
+
+OUTPUT_FORMATS = ["text", "jsonl", "csv", "sqlite"]
+
+
+# ==============================================================================
+class ResultWriter(object):
+    """
+    Writes the result of the compare for each source file. Results are held in
+    memory and written in batches, so that each file only costs one write call
+    for every batch_size files instead of one for every field.
+
+    This is the original tab delimited format. Every source file has a line
+    tagged DUPLICATE (if it has duplicates), HARDLINK (if its only matches are
+    hardlinks to it) or UNIQUE, followed by the path, size and symlink flag of
+    the source file and then of each match. A source file with both duplicates
+    and hardlinks has a DUPLICATE line followed by a HARDLINK line listing the
+    hardlinks. When there is more than one target directory, the target
+    directory each match was found in follows its symlink flag.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, file_name, header="", batch_size=10000,
+                 with_roots=False, position=None):
+        """
+        Initializes the object and opens the output file.
+
+        :param file_name: The file to write the results to.
+        :param header: Text to write at the top of the file (for the formats
+               that have one). Defaults to an empty string.
+        :param batch_size: The number of results to hold in memory before they
+               are written out. Defaults to 10000.
+        :param with_roots: If True, the tab delimited format includes the
+               target directory of each match. The other formats always
+               include it. Defaults to False.
+        :param position: If not None, an existing output file is continued
+               instead of a new one being created. Anything written after this
+               position (as returned by get_position) is thrown away first.
+               Defaults to None.
+
+        :return: Nothing.
+        """
+
+        self.name = file_name
+        self.batch_size = batch_size
+        self.with_roots = with_roots
+        self.pending = list()
+        if position is None:
+            self.open(header)
+        else:
+            self.reopen(position)
+
+    # --------------------------------------------------------------------------
+    def open(self, header):
+        """
+        Opens the output file.
+
+        :param header: Text to write at the top of the file.
+
+        :return: Nothing.
+        """
+
+        self.file_obj = open(self.name, "w")
+        self.file_obj.write(header)
+
+    # --------------------------------------------------------------------------
+    def reopen(self, position):
+        """
+        Opens an existing output file to add more results to it, cutting off
+        anything written after a given position.
+
+        :param position: The position returned by get_position.
+
+        :return: Nothing.
+        """
+
+        with open(self.name, "r+") as f:
+            f.truncate(position)
+        self.file_obj = open(self.name, "a")
+
+    # --------------------------------------------------------------------------
+    def get_position(self):
+        """
+        Writes out all of the results being held in memory and returns how far
+        into the output file they go, so that the file can be continued from
+        exactly this point later (see reopen).
+
+        :return: An integer.
+        """
+
+        self.flush()
+        self.file_obj.flush()
+        return self.file_obj.tell()
+
+    # --------------------------------------------------------------------------
+    def write_result(self, result, source_path, source_size, matches):
+        """
+        Adds the result for a single source file.
+
+        :param result: DUPLICATE, UNIQUE or HARDLINK.
+        :param source_path: The path of the source file.
+        :param source_size: The size of the source file.
+        :param matches: A list of [path, size, is_symlink, root] lists for each
+               of the target files that matched the source file (empty if
+               UNIQUE). The root is the target directory the file was found
+               in.
+
+        :return: Nothing.
+        """
+
+        self.pending.append((result, source_path, source_size, matches))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    # --------------------------------------------------------------------------
+    def flush(self):
+        """
+        Writes out all of the results being held in memory.
+
+        :return: Nothing.
+        """
+
+        lines = list()
+        for result, source_path, source_size, matches in self.pending:
+            fields = ["RESULT", "", result, source_path, str(source_size),
+                      "False"]
+            for match in matches:
+                if self.with_roots:
+                    fields.extend([str(value) for value in match])
+                else:
+                    fields.extend([str(value) for value in match[:3]])
+            lines.append("\t".join(fields) + "\t\n")
+
+        self.file_obj.writelines(lines)
+        self.pending = list()
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """
+        Writes out any remaining results and closes the output file.
+
+        :return: Nothing.
+        """
+
+        self.flush()
+        self.file_obj.close()
+
+
+# ==============================================================================
+class JsonlResultWriter(ResultWriter):
+    """
+    Writes one JSON object per source file (JSON Lines), with the result, the
+    source path and size, and a list of matches, each with its path, size,
+    symlink flag and the target directory it was found in. Source files get the
+    same results as in the tab delimited format (see ResultWriter), so one with
+    both duplicates and hardlinks has two objects.
+    """
+
+    # --------------------------------------------------------------------------
+    def open(self, header):
+        """
+        Opens the output file. JSON Lines files have no header.
+
+        :param header: Ignored.
+
+        :return: Nothing.
+        """
+
+        self.file_obj = open(self.name, "w")
+
+    # --------------------------------------------------------------------------
+    def flush(self):
+        """
+        Writes out all of the results being held in memory.
+
+        :return: Nothing.
+        """
+
+        lines = list()
+        for result, source_path, source_size, matches in self.pending:
+            lines.append(json.dumps({
+                "result": result,
+                "source": source_path,
+                "size": source_size,
+                "matches": [{"path": match[0],
+                             "size": int(match[1]),
+                             "is_symlink": match[2] == "True",
+                             "root": match[3]}
+                            for match in matches],
+            }) + "\n")
+
+        self.file_obj.writelines(lines)
+        self.pending = list()
+
+
+# ==============================================================================
+class CsvResultWriter(ResultWriter):
+    """
+    Writes a CSV file with a fixed set of columns: result, source path, source
+    size, match path, match size and match root (the target directory the
+    match was found in). A source file with several matches has one
+    row per match, and a unique source file has a single row with empty match
+    columns. Results are tagged as in the tab delimited format (see
+    ResultWriter).
+    """
+
+    # --------------------------------------------------------------------------
+    def open(self, header):
+        """
+        Opens the output file and writes the column names.
+
+        :param header: Ignored.
+
+        :return: Nothing.
+        """
+
+        self.file_obj = open(self.name, "w", newline="")
+        self.csv_writer = csv.writer(self.file_obj)
+        self.csv_writer.writerow(["result", "source_path", "source_size",
+                                  "match_path", "match_size", "match_root"])
+
+    # --------------------------------------------------------------------------
+    def reopen(self, position):
+        """
+        Opens an existing output file to add more results to it, cutting off
+        anything written after a given position.
+
+        :param position: The position returned by get_position.
+
+        :return: Nothing.
+        """
+
+        with open(self.name, "r+") as f:
+            f.truncate(position)
+        self.file_obj = open(self.name, "a", newline="")
+        self.csv_writer = csv.writer(self.file_obj)
+
+    # --------------------------------------------------------------------------
+    def flush(self):
+        """
+        Writes out all of the results being held in memory.
+
+        :return: Nothing.
+        """
+
+        self.csv_writer.writerows(rows_from_results(self.pending))
+        self.pending = list()
+
+
+# ==============================================================================
+class SqliteResultWriter(ResultWriter):
+    """
+    Writes the results to a results table in an SQLite database, with the same
+    columns (and one row per match) as the CSV format. Any existing file at the
+    same path (database or not) is replaced.
+    """
+
+    # --------------------------------------------------------------------------
+    def open(self, header):
+        """
+        Creates the database and the results table.
+
+        :param header: Ignored.
+
+        :return: Nothing.
+        """
+
+        # Empty out whatever is there first (an empty file is a new database)
+        open(self.name, "w").close()
+        self.file_obj = sqlite3.connect(self.name)
+        self.file_obj.execute("CREATE TABLE results ("
+                              "result TEXT, "
+                              "source_path TEXT, "
+                              "source_size INTEGER, "
+                              "match_path TEXT, "
+                              "match_size INTEGER, "
+                              "match_root TEXT)")
+
+    # --------------------------------------------------------------------------
+    def reopen(self, position):
+        """
+        Opens an existing database to add more results to it, deleting any rows
+        added after a given position.
+
+        :param position: The position returned by get_position.
+
+        :return: Nothing.
+        """
+
+        self.file_obj = sqlite3.connect(self.name)
+        with self.file_obj:
+            self.file_obj.execute("DELETE FROM results WHERE rowid > ?",
+                                  (position,))
+
+    # --------------------------------------------------------------------------
+    def get_position(self):
+        """
+        Writes out all of the results being held in memory and returns the
+        number of the last row written (see reopen).
+
+        :return: An integer.
+        """
+
+        self.flush()
+        return self.file_obj.execute(
+            "SELECT COALESCE(MAX(rowid), 0) FROM results").fetchone()[0]
+
+    # --------------------------------------------------------------------------
+    def flush(self):
+        """
+        Writes out all of the results being held in memory in one transaction.
+
+        :return: Nothing.
+        """
+
+        with self.file_obj:
+            self.file_obj.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                rows_from_results(self.pending))
+        self.pending = list()
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """
+        Writes out any remaining results, indexes the table and closes the
+        database.
+
+        :return: Nothing.
+        """
+
+        self.flush()
+        with self.file_obj:
+            self.file_obj.execute("CREATE INDEX IF NOT EXISTS results_source "
+                                  "ON results (source_path)")
+        self.file_obj.close()
+
+
+# ------------------------------------------------------------------------------
+def rows_from_results(results):
+    """
+    Flattens a list of results into rows with one match each.
+
+    :param results: A list of tuples of result, source path, source size and
+           list of matches.
+
+    :return: A list of tuples of result, source path, source size, match path,
+             match size and match root. The match path, size and root are None
+             if there were no matches.
+    """
+
+    rows = list()
+    for result, source_path, source_size, matches in results:
+        if not matches:
+            rows.append((result, source_path, source_size, None, None, None))
+        for match in matches:
+            rows.append((result, source_path, source_size, match[0],
+                         int(match[1]), match[3]))
+
+    return rows
+
+
+# ------------------------------------------------------------------------------
+def new_result_writer(output_format, file_name, header="", with_roots=False,
+                      position=None):
+    """
+    Creates the result writer for an output format.
+
+    :param output_format: One of the names in OUTPUT_FORMATS.
+    :param file_name: The file to write the results to.
+    :param header: Text to write at the top of the file (for the formats that
+           have one). Defaults to an empty string.
+    :param with_roots: If True, the tab delimited format includes the target
+           directory of each match. Defaults to False.
+    :param position: If not None, continue an existing output file from this
+           position (see ResultWriter.get_position). Defaults to None.
+
+    :return: A result writer.
+    """
+
+    writers = {
+        "text": ResultWriter,
+        "jsonl": JsonlResultWriter,
+        "csv": CsvResultWriter,
+        "sqlite": SqliteResultWriter,
+    }
+
+    return writers[output_format](file_name, header, with_roots=with_roots,
+                                  position=position)
@@ -0,0 +1,148 @@
+import json
+import os
+
+
+class RunMetrics(object):
+    """
+    Collects the numbers describing a single run (files scanned and skipped,
+    digests computed, bytes read, duplicates found, time spent in each stage,
+    etc.) and writes them out for monitoring, either as JSON or in the
+    Prometheus text exposition format (suitable for node_exporter's textfile
+    collector).
+
+    Every metric describes this run only, so they are all exported as gauges.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, prefix="findduplicates"):
+        """
+        Initializes the object.
+
+        :param prefix: The prefix added to the name of every metric in the
+               Prometheus output. Defaults to "findduplicates".
+
+        :return: Nothing.
+        """
+
+        self.prefix = prefix
+
+        # The help text of each metric, and its values as a list of (labels,
+        # value) tuples. Metrics are kept in the order they were first added.
+        self.help = dict()
+        self.values = dict()
+
+    # --------------------------------------------------------------------------
+    def add(self, name, value, help_text, labels=None):
+        """
+        Adds a value to a metric.
+
+        :param name: The name of the metric (without the prefix).
+        :param value: The value (an int or float).
+        :param help_text: A one line description of the metric.
+        :param labels: A dictionary of label names and values that tell this
+               value apart from the other values of the same metric. If None,
+               the value has no labels. Defaults to None.
+
+        :return: Nothing.
+        """
+
+        self.help.setdefault(name, help_text)
+        self.values.setdefault(name, list()).append((labels or dict(), value))
+
+    # --------------------------------------------------------------------------
+    def to_json(self):
+        """
+        Returns the metrics as a JSON document. A metric without labels is
+        written as its value. A metric with labels is written as a list of
+        objects holding the labels and the value.
+
+        :return: A string.
+        """
+
+        output = dict()
+        for name, values in self.values.items():
+            if len(values) == 1 and not values[0][0]:
+                output[name] = values[0][1]
+            else:
+                output[name] = [dict(labels, value=value)
+                                for labels, value in values]
+
+        return json.dumps(output, indent=2) + "\n"
+
+    # --------------------------------------------------------------------------
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+
+        :return: A string.
+        """
+
+        lines = list()
+        for name, values in self.values.items():
+            full_name = self.prefix + "_" + name
+            lines.append("# HELP " + full_name + " " + self.help[name])
+            lines.append("# TYPE " + full_name + " gauge")
+            for labels, value in values:
+                label_text = ""
+                if labels:
+                    label_text = "{" + ",".join(
+                        [key + '="' + escape_label(str(labels[key])) + '"'
+                         for key in sorted(labels.keys())]) + "}"
+                lines.append(full_name + label_text + " " + repr(value))
+
+        return "\n".join(lines) + "\n"
+
+    # --------------------------------------------------------------------------
+    def write_file(self, file_name, text):
+        """
+        Writes text to a file. It is written to a temporary file first and then
+        moved into place, so that a collector reading the file never sees half
+        of it.
+
+        :param file_name: The file to write.
+        :param text: The text to write.
+
+        :return: Nothing.
+        """
+
+        temp_path = file_name + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+        os.replace(temp_path, file_name)
+
+    # --------------------------------------------------------------------------
+    def write_json(self, file_name):
+        """
+        Writes the metrics to a JSON file.
+
+        :param file_name: The file to write.
+
+        :return: Nothing.
+        """
+
+        self.write_file(file_name, self.to_json())
+
+    # --------------------------------------------------------------------------
+    def write_prometheus(self, file_name):
+        """
+        Writes the metrics to a file in the Prometheus text exposition format.
+
+        :param file_name: The file to write.
+
+        :return: Nothing.
+        """
+
+        self.write_file(file_name, self.to_prometheus())
+
+
+# ------------------------------------------------------------------------------
+def escape_label(value):
+    """
+    Escapes a label value for the Prometheus text exposition format.
+
+    :param value: The label value.
+
+    :return: The escaped value.
+    """
+
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,20 +1,47 @@
+import concurrent.futures
+import fnmatch
+import hashlib
 import os
-import sys
+import pickle
+import re
 import time
 
 import lib
+from dirSnapshot import DirSnapshot
+from fileTable import FileTable
+from progress import Progress
+
+
+# Bumped whenever the form of a directory listing changes, so that snapshots
+# saved by an older version are not reused.
+SNAPSHOT_VERSION = 4
+
+# The number of directories a parallel scan may read ahead of the walk, for
+# each scan job.
+READ_AHEAD_PER_JOB = 64
 
 
 class ScanDirectory(object):
     """
     A class responsible for scanning and storing the data from a single
     directory.
+
+    The files found are stored in files, a FileTable, which can look them up
+    both by path (for source directories) and by size (for target directories).
+    The scans of several target directories can be added together (see
+    add_scan) so that they are all looked up in one table.
+
+    Sub-directories that match one of the dirs_to_skip patterns, or that are
+    deeper than max_depth, are pruned as soon as their parent has been read, so
+    nothing inside them is ever read.
     """
 
     # --------------------------------------------------------------------------
     def __init__(self, scan_dir, resources_obj, skip_hidden=True,
                  skip_dsstore=True, limit_to_patterns=False, patterns=None,
-                 skip_zero_len=True, type_is_source=True, debug_obj=None):
+                 skip_zero_len=True, type_is_source=True, debug_obj=None,
+                 scan_jobs=1, snapshot_dir=None, force_full_scan=False,
+                 dirs_to_skip=None, max_depth=0, executor=None):
         """
         Initializes the object.
 
@@ -32,11 +59,38 @@ class ScanDirectory(object):
                True.
         :param debug_obj: An optional debug object to write out debug info.
                Defaults to None.
+        :param scan_jobs: The number of directories to read at the same time.
+               Storage with a high latency (NFS, large RAID sets) can serve
+               many directory reads at once. Defaults to 1.
+        :param snapshot_dir: If not None, the listing of every directory is
+               saved to a snapshot in this directory at the end of the scan.
+               The next scan of the same directory (with the same filters) only
+               re-reads directories whose modification time has changed, and
+               reuses the saved listing for the rest. Note that modifying a
+               file in place does not change its directory's modification
+               time. Defaults to None.
+        :param force_full_scan: If True, any existing snapshot is ignored (but
+               a new one is still saved). Defaults to False.
+        :param dirs_to_skip: A list of glob patterns of sub-directories to
+               skip. A pattern that is an absolute path is matched against the
+               full path of each sub-directory, any other pattern with a path
+               separator in it is matched against the path relative to
+               scan_dir, and a pattern without one is matched against the name
+               of each sub-directory (at any depth). If None, no sub-directories
+               are skipped. Defaults to None.
+        :param max_depth: The number of levels of sub-directories to scan below
+               scan_dir. If 0, there is no limit. Defaults to 0.
+        :param executor: A thread pool to read the directories in. Pass the
+               same one to several scans that run at the same time to keep the
+               total number of directory reads in flight to its size. If None,
+               and scan_jobs is more than 1, the scan creates its own.
+               Defaults to None.
 
         :return: Nothing.
         """
 
         self.scan_dir = scan_dir
+        self.roots = [scan_dir]
         self.resources_obj = resources_obj
         self.skip_hidden = skip_hidden
         self.skip_dsstore = skip_dsstore
@@ -46,18 +100,532 @@ class ScanDirectory(object):
         self.type_is_source = type_is_source
         if type_is_source:
             self.type = resources_obj.get("words", "source").capitalize()
+            self.stage = "scan_source"
         else:
             self.type = resources_obj.get("words", "target").capitalize()
+            self.stage = "scan_target"
         self.debug_obj = debug_obj
+        self.scan_jobs = max(1, scan_jobs)
+        self.executor = executor
+        self.snapshot_dir = snapshot_dir
+        self.force_full_scan = force_full_scan
+        self.dirs_to_skip = list(dirs_to_skip or [])
+        self.max_depth = max(0, max_depth)
+
+        # The skip patterns, compiled and sorted by what they are matched
+        # against: the name, the relative path or the full path.
+        self.skip_names = list()
+        self.skip_relative_paths = list()
+        self.skip_full_paths = list()
+        for pattern in self.dirs_to_skip:
+            pattern = os.path.expanduser(pattern)
+            if os.sep not in pattern:
+                self.skip_names.append(self.compile_pattern(pattern))
+            elif os.path.isabs(pattern):
+                self.skip_full_paths.append(
+                    self.compile_pattern(os.path.normpath(pattern)))
+            else:
+                self.skip_relative_paths.append(
+                    self.compile_pattern(os.path.normpath(pattern)))
+        self.scan_dir_prefix = os.path.join(scan_dir, "")
+        self.full_scan_dir = os.path.abspath(scan_dir)
 
         self.file_count = 0
-        self.items = dict()
+        self.checked_count = 0
+        self.files = FileTable()
+
+        # The number of files skipped for each reason (hidden, dsstore,
+        # pattern, zero_len or unreadable)
+        self.skip_counts = dict()
+
+        # The number of sub-directories pruned (not counting anything inside
+        # them, which was never read)
+        self.pruned_count = 0
+
+        # The listings from the previous scan, and the listings from this one
+        self.old_snapshot = DirSnapshot()
+        self.new_snapshot = DirSnapshot()
+        self.reused_count = 0
+
+    # --------------------------------------------------------------------------
+    def list_dir(self, root):
+        """
+        Reads a single directory, applying all of the filters to the files in
+        it. This does not touch any of the object's data, so it is safe to run
+        for several directories at once.
+
+        :param root: The directory to read.
+
+        :return: A tuple where the first item is a list of the files to add
+                 (each a tuple of file name, file path, size, st_dev, st_ino
+                 and st_mtime_ns, where st_dev and st_ino are those of the
+                 link itself for a symlink), the second is a list of the
+                 sub-directories to scan, the third is the number of files
+                 that were checked, and the fourth is a dictionary of the
+                 number of files skipped for each reason.
+        """
+
+        files = list()
+        sub_folders = list()
+        checked_counter = 0
+        skipped = dict()
+
+        # os.scandir hands back each entry's type along with its name, so the
+        # only extra system call per file is the single stat that gives us its
+        # size, device, inode and modification time.
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            # DEBUG
+            if self.debug_obj is not None:
+                self.debug_obj.debug("\nCannot read dir. skipping: ", root)
+            return files, sub_folders, checked_counter, skipped
+
+        for entry in entries:
+
+            # Sub-directories are scanned later. Symlinks to directories are
+            # never followed.
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    sub_folders.append(entry.path)
+                continue
+
+            file_name = entry.name
+
+            # DEBUG
+            if self.debug_obj is not None:
+                self.debug_obj.debug("\nscanning: ", file_name)
+
+            # Increment the number of files checked
+            checked_counter += 1
+
+            # Skip any files that are hidden if so directed.
+            if self.skip_hidden and file_name[0] == ".":
+                # DEBUG
+                if self.debug_obj is not None:
+                    self.debug_obj.debug("file is hidden. skipping.")
+                skipped["hidden"] = skipped.get("hidden", 0) + 1
+                continue
+
+            # Skip .DSStore files if so directed.
+            if self.skip_dsstore and file_name == ".DS_Store":
+                # DEBUG
+                if self.debug_obj is not None:
+                    self.debug_obj.debug("file is .DSStore. skipping.")
+                skipped["dsstore"] = skipped.get("dsstore", 0) + 1
+                continue
+
+            # Skip files if they are not specific file types if so directed.
+            if self.limit_to_patterns and self.patterns is not None:
+                ext = os.path.splitext(file_name)[1]
+                ext = ext.upper().lstrip(".")
+                if self.limit_to_patterns and ext not in self.patterns:
+                    # DEBUG
+                    if self.debug_obj is not None:
+                        self.debug_obj.debug("ext is wrong type. skipping.")
+                    skipped["pattern"] = skipped.get("pattern", 0) + 1
+                    continue
+
+            # Get the stats of the current file.
+            try:
+                file_stat = entry.stat()
+            except OSError:
+                # TODO: Log this in the errors log (Needs to be passed
+                # TODO: to this object first
+                # DEBUG
+                if self.debug_obj is not None:
+                    self.debug_obj.debug("Cannot read size. skipping.")
+                skipped["unreadable"] = skipped.get("unreadable", 0) + 1
+                continue
+
+            # If we are to skip zero files and the file size is less than 0,
+            # then continue
+            if self.skip_zero_len and file_stat.st_size < 1:
+                # DEBUG
+                if self.debug_obj is not None:
+                    self.debug_obj.debug("file is zero length. skipping.")
+                skipped["zero_len"] = skipped.get("zero_len", 0) + 1
+                continue
+
+            # A symlink has the device and inode of the file it points to, but
+            # it is not a hardlink to it. Record the link's own device and
+            # inode so that the two are never taken for the same file.
+            st_dev = file_stat.st_dev
+            st_ino = file_stat.st_ino
+            if entry.is_symlink():
+                try:
+                    link_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    skipped["unreadable"] = skipped.get("unreadable", 0) + 1
+                    continue
+                st_dev = link_stat.st_dev
+                st_ino = link_stat.st_ino
+
+            files.append((file_name, entry.path, file_stat.st_size,
+                          st_dev, st_ino, file_stat.st_mtime_ns))
+
+        return files, sub_folders, checked_counter, skipped
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def compile_pattern(pattern):
+        """
+        Compiles a glob pattern into a regular expression. The case of the
+        pattern matters on the same platforms it does for file names.
+
+        :param pattern: The glob pattern.
+
+        :return: A compiled regular expression.
+        """
+
+        return re.compile(fnmatch.translate(os.path.normcase(pattern)))
+
+    # --------------------------------------------------------------------------
+    def prunes_dirs(self):
+        """
+        Returns whether this scan prunes any sub-directories at all.
+
+        :return: True if there are any skip patterns or a depth limit.
+        """
+
+        return bool(self.dirs_to_skip) or self.max_depth > 0
 
     # --------------------------------------------------------------------------
-    def scan(self):
+    def get_dir_filters(self):
+        """
+        Returns the settings that decide which sub-directories are pruned, so
+        that two scans can be checked for whether they would prune the same
+        ones.
+
+        :return: A tuple.
+        """
+
+        return tuple(self.dirs_to_skip), self.max_depth
+
+    # --------------------------------------------------------------------------
+    def is_skipped_dir(self, dir_path):
+        """
+        Returns whether a sub-directory matches any of the skip patterns.
+
+        :param dir_path: The path of the sub-directory (inside scan_dir).
+
+        :return: True if the sub-directory is to be skipped.
+        """
+
+        if self.skip_names:
+            name = os.path.normcase(os.path.basename(dir_path))
+            for pattern in self.skip_names:
+                if pattern.match(name):
+                    return True
+
+        if self.skip_relative_paths or self.skip_full_paths:
+            relative_path = dir_path[len(self.scan_dir_prefix):]
+            normalized = os.path.normcase(relative_path)
+            for pattern in self.skip_relative_paths:
+                if pattern.match(normalized):
+                    return True
+            normalized = os.path.normcase(
+                os.path.join(self.full_scan_dir, relative_path))
+            for pattern in self.skip_full_paths:
+                if pattern.match(normalized):
+                    return True
+
+        return False
+
+    # --------------------------------------------------------------------------
+    def prune_listing(self, listing, depth):
+        """
+        Removes the sub-directories that are not to be scanned from the listing
+        of a directory, and counts them.
+
+        :param listing: The tuple returned by list_dir for the directory.
+        :param depth: How many levels below scan_dir the directory is (0 for
+               scan_dir itself).
+
+        :return: The same tuple as list_dir, with only the sub-directories that
+                 are to be scanned.
+        """
+
+        if not self.prunes_dirs() or not listing[1]:
+            return listing
+
+        files, sub_folders, checked_counter, skipped = listing
+
+        if self.max_depth and depth >= self.max_depth:
+            kept = list()
+        else:
+            kept = [sub_folder for sub_folder in sub_folders
+                    if not self.is_skipped_dir(sub_folder)]
+
+        if len(kept) < len(sub_folders):
+            self.pruned_count += len(sub_folders) - len(kept)
+
+            # DEBUG
+            if self.debug_obj is not None and self.debug_obj.is_enabled():
+                for sub_folder in set(sub_folders) - set(kept):
+                    self.debug_obj.debug("\npruning dir: ", sub_folder)
+
+        return files, kept, checked_counter, skipped
+
+    # --------------------------------------------------------------------------
+    def read_listing(self, root):
+        """
+        Returns the listing of a single directory. If the directory has not been
+        modified since the last snapshot was saved, the listing from the
+        snapshot is returned without reading the directory. Like list_dir, this
+        does not touch any of the object's data, so it is safe to run for
+        several directories at once. The result is handed to record_listing.
+
+        :param root: The directory to read.
+
+        :return: A tuple where the first item is the same tuple as list_dir, the
+                 second is the modification time of the directory (or None if
+                 it is not to be recorded in the snapshot), and the third is
+                 True if the listing was taken from the last snapshot.
+        """
+
+        if self.snapshot_dir is None:
+            return self.list_dir(root), None, False
+
+        # Get the modification time before reading the directory so that any
+        # change made while we read it is picked up next time.
+        try:
+            dir_mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            return self.list_dir(root), None, False
+
+        old_listing = self.old_snapshot.get(root, dir_mtime)
+        if old_listing is not None:
+
+            # DEBUG
+            if self.debug_obj is not None:
+                self.debug_obj.debug("\nreusing snapshot of: ", root)
+
+            return old_listing, dir_mtime, True
+
+        return self.list_dir(root), dir_mtime, False
+
+    # --------------------------------------------------------------------------
+    def record_listing(self, root, result, depth):
+        """
+        Records the listing of a directory for the next snapshot, and prunes its
+        sub-directories. This is only ever called from the thread running the
+        walk.
+
+        :param root: The directory.
+        :param result: The tuple returned by read_listing for the directory.
+        :param depth: How many levels below scan_dir the directory is.
+
+        :return: The same tuple as list_dir, with only the sub-directories that
+                 are to be scanned.
+        """
+
+        listing, dir_mtime, reused = result
+
+        if reused:
+            self.reused_count += 1
+        if dir_mtime is not None:
+            self.new_snapshot.add(root, dir_mtime, listing)
+
+        return self.prune_listing(listing, depth)
+
+    # --------------------------------------------------------------------------
+    def get_snapshot_path(self):
+        """
+        Returns the path to the snapshot file for this directory and these
+        filter settings.
+
+        :return: A path.
+        """
+
+        key = repr((SNAPSHOT_VERSION, os.path.realpath(self.scan_dir),
+                    self.skip_hidden, self.skip_dsstore,
+                    self.limit_to_patterns, self.patterns, self.skip_zero_len))
+        file_name = hashlib.md5(key.encode("utf-8")).hexdigest() + ".snapshot"
+
+        return os.path.join(self.snapshot_dir, file_name)
+
+    # --------------------------------------------------------------------------
+    def load_snapshot(self):
+        """
+        Loads the snapshot saved by the last scan of this directory (unless a
+        full scan has been forced).
+
+        :return: Nothing.
+        """
+
+        self.old_snapshot = DirSnapshot()
+        self.new_snapshot = DirSnapshot()
+        self.reused_count = 0
+
+        if self.snapshot_dir is None or self.force_full_scan:
+            return
+
+        snapshot_path = self.get_snapshot_path()
+        try:
+            # Unpickling runs code, so only trust files this user wrote
+            if hasattr(os, "getuid") and \
+                    os.stat(snapshot_path).st_uid != os.getuid():
+                return
+            with open(snapshot_path, "rb") as f:
+                old_snapshot = pickle.load(f)
+        except (OSError, IOError, pickle.PickleError, EOFError,
+                AttributeError, ValueError):
+            return
+
+        if isinstance(old_snapshot, DirSnapshot):
+            self.old_snapshot = old_snapshot
+
+    # --------------------------------------------------------------------------
+    def save_snapshot(self):
+        """
+        Saves the listings from this scan so that the next scan can reuse them.
+        The snapshot is written to a temporary file first and then moved into
+        place so that an interrupted save never leaves a broken snapshot.
+
+        :return: Nothing.
+        """
+
+        if self.snapshot_dir is None:
+            return
+
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+
+        snapshot_path = self.get_snapshot_path()
+        temp_path = snapshot_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(self.new_snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, snapshot_path)
+
+        # Neither snapshot is needed any more
+        self.old_snapshot = DirSnapshot()
+        self.new_snapshot = DirSnapshot()
+
+    # --------------------------------------------------------------------------
+    def walk_parallel(self, progress, executor):
+        """
+        The same as walk, but the directories are read by a pool of threads.
+        Each directory's sub-directories are handed to the pool as soon as it
+        has been read, so several directory reads are in flight at once, and
+        the listings are handed back in walk order as soon as they are ready.
+        No more than scan_jobs * READ_AHEAD_PER_JOB directories are read ahead
+        of the walk, so only a small part of the tree is held in memory.
+
+        :param progress: The Progress object to update as the scan progresses.
+        :param executor: The thread pool to read the directories in.
+
+        :return: A generator yielding tuples of each directory and its listing.
+        """
+
+        read_ahead = self.scan_jobs * READ_AHEAD_PER_JOB
+
+        # Listings that have been read but not handed back yet, and the reads
+        # still in flight
+        listings = dict()
+        pending = dict()
+        in_flight = set()
+
+        dirs_to_scan = [(self.scan_dir, 0)]
+        while dirs_to_scan:
+
+            root, depth = dirs_to_scan.pop()
+
+            if root not in listings and root not in in_flight:
+                pending[executor.submit(self.read_listing, root)] = \
+                    (root, depth)
+                in_flight.add(root)
+
+            while root not in listings:
+
+                done, not_done = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    done_root, done_depth = pending.pop(future)
+                    in_flight.discard(done_root)
+                    listing = self.record_listing(done_root, future.result(),
+                                                  done_depth)
+                    listings[done_root] = listing
+                    progress.update(listing[2])
+
+                    # Read ahead into its sub-directories while there is room
+                    for sub_folder in listing[1]:
+                        if len(listings) + len(pending) >= read_ahead:
+                            break
+                        pending[executor.submit(self.read_listing,
+                                                sub_folder)] = \
+                            (sub_folder, done_depth + 1)
+                        in_flight.add(sub_folder)
+
+            listing = listings.pop(root)
+            yield root, listing
+
+            # Scan the sub-directories in the order they were listed, starting
+            # to read any that were not read ahead, since they are next.
+            dirs_to_scan.extend([(sub_folder, depth + 1)
+                                 for sub_folder in reversed(listing[1])])
+            for sub_folder in listing[1]:
+                if len(listings) + len(pending) >= read_ahead:
+                    break
+                if sub_folder not in listings and sub_folder not in in_flight:
+                    pending[executor.submit(self.read_listing, sub_folder)] = \
+                        (sub_folder, depth + 1)
+                    in_flight.add(sub_folder)
+
+    # --------------------------------------------------------------------------
+    def walk(self, progress):
+        """
+        Yields the listing of every directory under scan_dir, depth first and in
+        the same order as os.walk. The order is the same regardless of how many
+        scan jobs were used.
+
+        :param progress: The Progress object to update as the scan progresses.
+
+        :return: A generator yielding tuples of each directory and the results
+                 of list_dir for it (with the pruned sub-directories removed).
+        """
+
+        if self.executor is not None:
+            for root, listing in self.walk_parallel(progress, self.executor):
+                yield root, listing
+            return
+
+        if self.scan_jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.scan_jobs) as executor:
+                for root, listing in self.walk_parallel(progress, executor):
+                    yield root, listing
+            return
+
+        dirs_to_scan = [(self.scan_dir, 0)]
+        while dirs_to_scan:
+
+            root, depth = dirs_to_scan.pop()
+
+            listing = self.record_listing(root, self.read_listing(root), depth)
+            progress.update(listing[2])
+
+            yield root, listing
+
+            # Scan the sub-directories in the order they were listed
+            dirs_to_scan.extend([(sub_folder, depth + 1)
+                                 for sub_folder in reversed(listing[1])])
+
+    # --------------------------------------------------------------------------
+    def scan(self, progress=None):
         """
         Actually perform the scan.
 
+        :param progress: A Progress object shared with other scans running at
+               the same time. The scan adds to it (and prints its messages
+               through it) but leaves finishing it to the caller. If None, the
+               scan shows its own progress. Defaults to None.
+
         :return: Nothing.
         """
 
@@ -66,127 +634,180 @@ class ScanDirectory(object):
         scanning = scanning.format(type=self.type,
                                    time_now=time.strftime("%I:%M:%S"))
         scanning = lib.format_string(scanning)
-        scanned_so_far = self.resources_obj.get("messages", "scanned_so_far")
         scan_summary = self.resources_obj.get("messages", "scan_summary")
 
         # initialize counters
         checked_counter = 0
         actual_counter = 0
+        self.skip_counts = dict()
+        self.pruned_count = 0
 
         # Print status
-        lib.display_message(scanning)
-        lib.display_message("-" * 80)
-
-        # Step through each of the files in the source
-        for root, sub_folders, files in os.walk(self.scan_dir):
-
-            for file_name in files:
+        shared_progress = progress is not None
+        if shared_progress:
+            display_message = progress.message
+        else:
+            display_message = lib.display_message
+        display_message(scanning)
+        display_message("-" * 80)
+
+        # Load the listings from the last scan (if we are scanning
+        # incrementally)
+        self.load_snapshot()
+
+        # Step through each of the directories in the source
+        if not shared_progress:
+            progress = Progress(self.resources_obj,
+                                self.resources_obj.get("messages",
+                                                       "stage_" + self.stage))
+        for root, (files, sub_folders, dir_checked_counter, skipped) in \
+                self.walk(progress):
+
+            checked_counter += dir_checked_counter
+            for reason, count in skipped.items():
+                self.skip_counts[reason] = \
+                    self.skip_counts.get(reason, 0) + count
+
+            # DEBUG
+            if self.debug_obj is not None and self.debug_obj.is_enabled():
+                for file_item in files:
+                    self.debug_obj.debug("adding file: ", file_item[1])
+
+            # Add all of the files in this directory to the table at once
+            self.files.add_dir(root, files)
+            actual_counter += len(files)
+
+        if not shared_progress:
+            progress.finish()
+        self.file_count = actual_counter
+        self.checked_count = checked_counter
+        display_message(scan_summary.format(
+            count_added=actual_counter,
+            count_scanned=checked_counter,
+            count_pruned=self.pruned_count,
+            time_now=time.strftime("%I:%M:%S")
+        ))
 
-                # DEBUG
-                if self.debug_obj is not None:
-                    self.debug_obj.debug("\nscanning: ", file_name)
+        # Save the listings for the next scan
+        if self.snapshot_dir is not None:
+            incremental_summary = self.resources_obj.get(
+                "messages", "incremental_scan_summary")
+            display_message(incremental_summary.format(
+                count_reused=self.reused_count,
+                count_dirs=len(self.new_snapshot)
+            ))
+            self.save_snapshot()
 
-                # Increment the number of files checked
-                checked_counter += 1
+    # --------------------------------------------------------------------------
+    def scan_from(self, outer):
+        """
+        Takes the files for this directory from the scan of a directory that
+        contains it, instead of scanning it again. Both objects must have been
+        built with the same filters.
 
-                # Update the status every 1000 files
-                if checked_counter % 1000 == 0:
+        :param outer: The scan object of the directory that contains this one.
+               Its scan must already have been performed.
 
-                    # Print the status, flush buffer, and move back to the
-                    # beginning of the line.
-                    message = scanned_so_far.format(count=checked_counter)
-                    sys.stdout.write(message)
-                    sys.stdout.flush()
-                    sys.stdout.write("\b" * (len(message)))
+        :return: Nothing.
+        """
 
-                # Skip any files that are hidden if so directed.
-                if self.skip_hidden and file_name[0] == ".":
-                    # DEBUG
-                    if self.debug_obj is not None:
-                        self.debug_obj.debug("file is hidden. skipping.")
-                    continue
+        # Express this directory the same way the outer scan names its files:
+        # the outer scan directory exactly as it was given (which may hold "./"
+        # or "..") with the path below it appended.
+        relative_dir = os.path.relpath(os.path.realpath(self.scan_dir),
+                                       os.path.realpath(outer.scan_dir))
+        if relative_dir == os.curdir:
+            dir_path = outer.scan_dir
+        else:
+            dir_path = os.path.join(outer.scan_dir, relative_dir)
+
+        self.files = outer.files.subtree(dir_path)
+        self.file_count = len(self.files)
+        self.roots = [dir_path]
+
+        # Which of the outer scan's skipped files were in here is not known
+        self.checked_count = self.file_count
+        self.skip_counts = dict()
+        self.pruned_count = 0
+
+        scan_reused = self.resources_obj.get("messages", "scan_reused")
+        lib.display_message(scan_reused.format(
+            type=self.type,
+            other_type=outer.type.lower(),
+            count_added=self.file_count,
+        ))
 
-                # Skip .DSStore files if so directed.
-                if self.skip_dsstore and file_name == ".DS_Store":
-                    # DEBUG
-                    if self.debug_obj is not None:
-                        self.debug_obj.debug("file is .DSStore. skipping.")
-                    continue
+    # --------------------------------------------------------------------------
+    def add_scan(self, other):
+        """
+        Adds the files from the scan of another directory to this one, so that
+        the files of both can be looked up in the same table. The directories
+        must not overlap.
 
-                # Skip files if they are not specific file types if so directed.
-                if self.limit_to_patterns and self.patterns is not None:
-                    ext = os.path.splitext(file_name)[1]
-                    ext = ext.upper().lstrip(".")
-                    if self.limit_to_patterns and ext not in self.patterns:
-                        # DEBUG
-                        if self.debug_obj is not None:
-                            self.debug_obj.debug("ext is wrong type. skipping.")
-                        continue
+        :param other: The scan object of the other directory. Its scan must
+               already have been performed.
 
-                # Get the path and file size of the current file.
-                file_path = os.path.join(root, file_name)
+        :return: Nothing.
+        """
 
-                try:
-                    file_size = os.path.getsize(file_path)
-                except FileNotFoundError:
-                    # TODO: Log this in the errors log (Needs to be passed
-                    # TODO: to this object first
-                    # DEBUG
-                    if self.debug_obj is not None:
-                        self.debug_obj.debug("Cannot read size. skipping.")
-                    continue
+        self.files.extend(other.files)
+        self.file_count += other.file_count
+        self.checked_count += other.checked_count
+        for reason, count in other.skip_counts.items():
+            self.skip_counts[reason] = self.skip_counts.get(reason, 0) + count
+        self.pruned_count += other.pruned_count
+        self.roots.extend(other.roots)
 
-                # If we are to skip zero files and the file size is less than 0,
-                # then continue
-                if self.skip_zero_len and file_size < 1:
-                    # DEBUG
-                    if self.debug_obj is not None:
-                        self.debug_obj.debug("file is zero length. skipping.")
-                    continue
+    # --------------------------------------------------------------------------
+    def get_state(self):
+        """
+        Returns the results of the scan, so that they can be saved to a
+        checkpoint.
 
-                # Increment the counter of added files
-                actual_counter += 1
+        :return: A dictionary.
+        """
 
-                # If this is a source directory, add to the dict keyed on path,
-                if self.type_is_source:
+        return {
+            "files": self.files,
+            "file_count": self.file_count,
+            "checked_count": self.checked_count,
+            "skip_counts": self.skip_counts,
+            "pruned_count": self.pruned_count,
+            "roots": self.roots,
+        }
 
-                    # DEBUG
-                    if self.debug_obj is not None:
-                        self.debug_obj.debug("adding file by name.")
+    # --------------------------------------------------------------------------
+    def set_state(self, state):
+        """
+        Restores the results of a scan saved by get_state, instead of scanning.
 
-                    self.items[file_path] = [file_name, file_size]
+        :param state: The dictionary returned by get_state.
 
-                # otherwise add to the dict, keyed on size.
-                else:
+        :return: Nothing.
+        """
 
-                    # If this the first time we see a file of this size, add
-                    # it to the dictionary keyed on size.
-                    if file_size not in self.items.keys():
+        self.files = state["files"]
+        self.file_count = state["file_count"]
+        self.checked_count = state["checked_count"]
+        self.skip_counts = state["skip_counts"]
+        self.pruned_count = state["pruned_count"]
+        self.roots = state["roots"]
 
-                        # DEBUG
-                        if self.debug_obj is not None:
-                            self.debug_obj.debug("adding file by size.")
-                        self.items[file_size] = [[file_path, file_size]]
+    # --------------------------------------------------------------------------
+    def root_of(self, file_path):
+        """
+        Returns which of the directories scanned (see add_scan) a file is in.
 
-                    # Otherwise we have seen this file size before, so append
-                    # the full path and size to the existing item in the
-                    # dictionary
-                    else:
+        :param file_path: The path of the file.
 
-                        # DEBUG
-                        if self.debug_obj is not None:
-                            self.debug_obj.debug("APPENDING file by size.")
-                        # self.items[file_size] = [[file_path, file_size]]
-                        temp_data = self.items[file_size]
-                        temp_data.append([file_path, file_size])
-                        self.items[file_size] = temp_data
+        :return: The scanned directory the file is in, or None if it is not in
+                 any of them.
+        """
 
-        self.file_count = actual_counter
-        lib.display_message(scan_summary.format(
-            count_added=actual_counter,
-            count_scanned=checked_counter,
-            time_now=time.strftime("%I:%M:%S")
-        ))
+        for root in self.roots:
+            if file_path.startswith(os.path.join(root, "")):
+                return root
+        return None
 
     # --------------------------------------------------------------------------
     def get_count(self):
@@ -35,7 +35,7 @@ class Settings(object):
 
         # Store the number of steps
         if advanced:
-            self.step_count = 17
+            self.step_count = 18
         else:
             self.step_count = 4
 
@@ -50,10 +50,14 @@ class Settings(object):
         # Set the attributes of this object to the default values
         self.source_dir = defaults["source_dir"]
         self.skip_source = defaults["skip_source_sub_dirs"]
-        self.source_dirs_to_skip = defaults["source_dirs_to_skip"]
-        self.target_dir = defaults["target_dir"]
+        self.source_dirs_to_skip = self.parse_dirs_to_skip(
+            defaults["source_dirs_to_skip"])
+        self.target_dirs = lib.parse_list(defaults["target_dir"])
+        if not self.target_dirs:
+            self.target_dirs = [os.path.expanduser("~")]
         self.skip_target_sub_dirs = defaults["skip_target_sub_dirs"]
-        self.target_dirs_to_skip = defaults["target_dirs_to_skip"]
+        self.target_dirs_to_skip = self.parse_dirs_to_skip(
+            defaults["target_dirs_to_skip"])
         self.log_file = defaults["log_file"]
         self.limit_to_patterns = defaults["limit_to_patterns"]
         self.pattern_list = defaults["pattern_list"]
@@ -64,7 +68,39 @@ class Settings(object):
         self.follow_links = defaults["follow_links"]
         self.many_dupes = defaults["many_dupes"]
         self.do_debug = defaults["do_debug"]
-        self.debug_limit = defaults["debug_limit"]
+        self.debug_max_mb = max(1, int(defaults["debug_max_mb"]))
+        self.debug_level = defaults["debug_level"]
+        self.use_digest_cache = defaults["use_digest_cache"]
+        self.digest_cache_limit = int(defaults["digest_cache_limit"])
+        self.jobs = max(1, int(defaults["jobs"]))
+        self.hash_algo = str(defaults["hash_algo"]).lower()
+        self.digest_size = int(defaults["digest_size"])
+        self.sample_size = max(1, int(defaults["sample_size"]))
+        self.sample_count = max(0, int(defaults["sample_count"]))
+        self.stream_max_files = int(defaults["stream_max_files"])
+        self.mmap_threshold = max(0, int(defaults["mmap_threshold"]))
+        self.scan_jobs = max(1, int(defaults["scan_jobs"]))
+        self.max_depth = max(0, int(defaults["max_depth"]))
+        self.incremental_scan = defaults["incremental_scan"]
+        self.checkpoint_interval = max(0, int(defaults["checkpoint_interval"]))
+        self.output_format = defaults["output_format"]
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def parse_dirs_to_skip(value):
+        """
+        Converts a list of sub-directories to skip, as given on the command line
+        or stored in a preset, into a list of patterns.
+
+        :param value: The value to convert.
+
+        :return: A list of strings.
+        """
+
+        # Presets saved when no directories were given hold the string "None"
+        if value is None or value == "None":
+            return list()
+        return lib.parse_list(value)
 
     # --------------------------------------------------------------------------
     def run_wizard(self):
@@ -89,45 +125,47 @@ class Settings(object):
 
             # Skip Source Dirs
             current_step += 1
-            skip = self.get_skip_source_sub_dirs(
+            self.skip_source = self.get_skip_source_sub_dirs(
                 current_step,
                 self.step_count,
                 self.defaults["skip_source_sub_dirs"])
-            if skip:
+            if self.skip_source:
                 current_step += 1
                 self.source_dirs_to_skip = self.get_source_sub_dirs_to_skip(
                     current_step,
                     self.step_count,
                     self.defaults["source_dirs_to_skip"])
             else:
+                self.source_dirs_to_skip = list()
                 current_step += 1
                 lib.display_message(
                     lib.format_string(
                         skip_msg.format(step_no=current_step)))
 
-        # Target Dir
+        # Target Dirs
         current_step += 1
-        self.target_dir = self.get_target_dir(
+        self.target_dirs = self.get_target_dirs(
             current_step,
             self.step_count,
-            self.defaults["target_dir"])
+            self.target_dirs)
 
         # The following question will only be asked if advanced is true
         if self.advanced:
 
             # Skip Target Dirs
             current_step += 1
-            skip = self.get_skip_target_sub_dirs(
+            self.skip_target_sub_dirs = self.get_skip_target_sub_dirs(
                 current_step,
                 self.step_count,
                 self.defaults["skip_target_sub_dirs"])
-            if skip:
+            if self.skip_target_sub_dirs:
                 current_step += 1
                 self.target_dirs_to_skip = self.get_target_sub_dirs_to_skip(
                     current_step,
                     self.step_count,
                     self.defaults["target_dirs_to_skip"])
             else:
+                self.target_dirs_to_skip = list()
                 current_step += 1
                 lib.display_message(
                     lib.format_string(
@@ -206,6 +244,13 @@ class Settings(object):
         # The following question will only be asked if advanced is true
         if self.advanced:
 
+            # Number of hashing jobs
+            current_step += 1
+            self.jobs = self.get_jobs(
+                current_step,
+                self.step_count,
+                self.defaults["jobs"])
+
             # Debug
             current_step += 1
             self.do_debug = self.get_do_debug(
@@ -214,10 +259,10 @@ class Settings(object):
                 self.defaults["do_debug"])
             if self.do_debug:
                 current_step += 1
-                self.debug_limit = self.get_debug_limit(
+                self.debug_max_mb = self.get_debug_max_mb(
                     current_step,
                     self.step_count,
-                    self.defaults["debug_limit"])
+                    self.defaults["debug_max_mb"])
             else:
                 current_step += 1
                 lib.display_message(
@@ -277,22 +322,25 @@ class Settings(object):
         return ui_obj.values
 
     # --------------------------------------------------------------------------
-    def get_target_dir(self, step, step_count, default="~"):
+    def get_target_dirs(self, step, step_count, default=None):
         """
-        Get the target directory from the user.
+        Get one or more target directories from the user.
 
-        :return: A list of length one containing the target directory.
+        :return: A list containing the target directories. If none were entered,
+                 the default list is returned.
         """
 
-        default = os.path.expanduser(default)
-        ui_obj = DirUI(
+        if default is None:
+            default = ["~"]
+        default = [os.path.expanduser(item) for item in default]
+        ui_obj = MultiDirUI(
             self.resources_obj,
             "target_dir",
             step,
             step_count,
-            default)
+            ", ".join(default))
         ui_obj.get_input()
-        return ui_obj.values[0]
+        return ui_obj.values or default
 
     # --------------------------------------------------------------------------
     def get_skip_target_sub_dirs(self, step, step_count, default=False):
@@ -482,6 +530,23 @@ class Settings(object):
         ui_obj.get_input()
         return ui_obj.values[0]
 
+    # --------------------------------------------------------------------------
+    def get_jobs(self, step, step_count, default=1):
+        """
+        Get the number of processes to hash files with.
+
+        :return: An integer.
+        """
+
+        ui_obj = IntUI(
+            self.resources_obj,
+            "jobs",
+            step,
+            step_count,
+            default)
+        ui_obj.get_input()
+        return max(1, ui_obj.values[0])
+
     # --------------------------------------------------------------------------
     def get_do_debug(self, step, step_count, default=False):
         """
@@ -500,16 +565,16 @@ class Settings(object):
         return ui_obj.values[0]
 
     # --------------------------------------------------------------------------
-    def get_debug_limit(self, step, step_count, default=1000):
+    def get_debug_max_mb(self, step, step_count, default=100):
         """
-        Get the number of lines in the debug log.
+        Get the size (in megabytes) at which the debug log is rotated.
 
         :return: An integer.
         """
 
         ui_obj = IntUI(
             self.resources_obj,
-            "debug_limit",
+            "debug_max_mb",
             step,
             step_count,
             default)
@@ -532,7 +597,7 @@ class Settings(object):
         preset.set("presets", "source_dir", str(self.source_dir))
         preset.set("presets", "skip_source_sub_dirs", str(self.skip_source))
         preset.set("presets", "source_dirs_to_skip", str(self.source_dirs_to_skip))
-        preset.set("presets", "target_dir", str(self.target_dir))
+        preset.set("presets", "target_dir", str(self.target_dirs))
         preset.set("presets", "skip_target_sub_dirs", str(self.skip_target_sub_dirs))
         preset.set("presets", "target_dirs_to_skip", str(self.target_dirs_to_skip))
         preset.set("presets", "log_file", str(self.log_file))
@@ -545,7 +610,24 @@ class Settings(object):
         preset.set("presets", "follow_links", str(self.follow_links))
         preset.set("presets", "many_dupes", str(self.many_dupes))
         preset.set("presets", "do_debug", str(self.do_debug))
-        preset.set("presets", "debug_limit", str(self.debug_limit))
+        preset.set("presets", "debug_max_mb", str(self.debug_max_mb))
+        preset.set("presets", "debug_level", str(self.debug_level))
+        preset.set("presets", "use_digest_cache", str(self.use_digest_cache))
+        preset.set("presets", "digest_cache_limit",
+                   str(self.digest_cache_limit))
+        preset.set("presets", "jobs", str(self.jobs))
+        preset.set("presets", "hash_algo", str(self.hash_algo))
+        preset.set("presets", "digest_size", str(self.digest_size))
+        preset.set("presets", "sample_size", str(self.sample_size))
+        preset.set("presets", "sample_count", str(self.sample_count))
+        preset.set("presets", "stream_max_files", str(self.stream_max_files))
+        preset.set("presets", "mmap_threshold", str(self.mmap_threshold))
+        preset.set("presets", "scan_jobs", str(self.scan_jobs))
+        preset.set("presets", "max_depth", str(self.max_depth))
+        preset.set("presets", "incremental_scan", str(self.incremental_scan))
+        preset.set("presets", "checkpoint_interval",
+                   str(self.checkpoint_interval))
+        preset.set("presets", "output_format", str(self.output_format))
 
         if not os.path.exists(os.path.split(file_name)[0]):
             os.makedirs(os.path.split(file_name)[0])
@@ -0,0 +1,127 @@
+import contextlib
+import threading
+import time
+
+
+class StageTimers(object):
+    """
+    Records how much wall clock time and CPU time each stage of a run takes,
+    along with the number of files it processed and the number of bytes it
+    read. A stage may be timed many times (once per batch, for example), in
+    which case the times and counts are added up.
+
+    Stages are named by short ids (i.e. "partial" or "scan_source"). The name
+    displayed for each is the stage_<id> message in the resources.
+
+    CPU time is the CPU time of this process only. Work done in the hashing
+    pool's worker processes shows up in the wall clock time, but not in the CPU
+    time.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        """
+        Initializes the object.
+
+        :return: Nothing.
+        """
+
+        # Each stage is a list of: wall time, CPU time, files and bytes. Stages
+        # are kept in the order they were first timed.
+        self.stages = dict()
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def add(self, name, files=0, num_bytes=0, wall=0.0, cpu=0.0):
+        """
+        Adds to the totals of a stage.
+
+        :param name: The id of the stage.
+        :param files: The number of files processed. Defaults to 0.
+        :param num_bytes: The number of bytes read. Defaults to 0.
+        :param wall: The wall clock time taken, in seconds. Defaults to 0.
+        :param cpu: The CPU time taken, in seconds. Defaults to 0.
+
+        :return: Nothing.
+        """
+
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += files
+            stage[3] += num_bytes
+
+    # --------------------------------------------------------------------------
+    def start(self):
+        """
+        Returns the current wall clock and CPU times, to be handed back to stop
+        when the stage is done.
+
+        :return: A tuple of the wall clock time and the CPU time.
+        """
+
+        return time.perf_counter(), time.process_time()
+
+    # --------------------------------------------------------------------------
+    def stop(self, name, started, files=0, num_bytes=0):
+        """
+        Adds the time since start was called to a stage.
+
+        :param name: The id of the stage.
+        :param started: The tuple returned by start.
+        :param files: The number of files processed. Defaults to 0.
+        :param num_bytes: The number of bytes read. Defaults to 0.
+
+        :return: Nothing.
+        """
+
+        self.add(name, files, num_bytes,
+                 time.perf_counter() - started[0],
+                 time.process_time() - started[1])
+
+    # --------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def stage(self, name, files=0, num_bytes=0):
+        """
+        Times the code inside a with block as part of a stage.
+
+        :param name: The id of the stage.
+        :param files: The number of files processed. Defaults to 0.
+        :param num_bytes: The number of bytes read. Defaults to 0.
+
+        :return: Nothing.
+        """
+
+        started = self.start()
+        try:
+            yield
+        finally:
+            self.stop(name, started, files, num_bytes)
+
+    # --------------------------------------------------------------------------
+    def summary(self, resources_obj):
+        """
+        Builds a summary of every stage, one line each.
+
+        :param resources_obj: The resources object.
+
+        :return: A list of strings.
+        """
+
+        line = resources_obj.get("messages", "stage_timer_line")
+
+        output = list()
+        with self.lock:
+            for name, stage in self.stages.items():
+                wall, cpu, files, num_bytes = stage
+                output.append(line.format(
+                    stage=resources_obj.get("messages", "stage_" + name),
+                    wall_sec=round(wall, 2),
+                    cpu_sec=round(cpu, 2),
+                    files=files,
+                    mb=round(num_bytes / (1024 * 1024), 1),
+                    mb_per_sec=round(num_bytes / (1024 * 1024) /
+                                     max(wall, 0.000001), 1)))
+
+        return output
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import benchmark
+import findDuplicates
+from checkpoint import Checkpoint
+from scanDirectory import ScanDirectory
+
+
+class CheckpointResumeTest(unittest.TestCase):
+    """
+    Tests that a compare which dies part way through and is resumed from its
+    checkpoint writes the same results as one that was never interrupted.
+    """
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.resources_obj = benchmark.read_resources()
+        self.source_dir = os.path.join(self.temp_dir.name, "source")
+        self.target_dir = os.path.join(self.temp_dir.name, "target")
+
+        # Every size is on both sides. Half of the source files have a copy in
+        # the target, the other half only share their size with a target file.
+        for index in range(12):
+            contents = bytes([index]) * (1000 + index)
+            self.write_file(os.path.join(self.source_dir, str(index)), contents)
+            if index % 2:
+                contents = b"x" + contents[1:]
+            self.write_file(os.path.join(self.target_dir, str(index)), contents)
+
+        chunk_files = findDuplicates.CHECKPOINT_BATCH_FILES
+        self.addCleanup(setattr, findDuplicates, "CHECKPOINT_BATCH_FILES",
+                        chunk_files)
+        findDuplicates.CHECKPOINT_BATCH_FILES = 4
+
+        write_result = findDuplicates.write_result
+        self.addCleanup(setattr, findDuplicates, "write_result", write_result)
+
+    # --------------------------------------------------------------------------
+    def write_file(self, file_path, contents):
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file_obj:
+            file_obj.write(contents)
+
+    # --------------------------------------------------------------------------
+    def set_up(self, log_file, position=None):
+        """
+        Sets up the module globals of findDuplicates and opens the logs, which
+        are continued from position if it is not None.
+        """
+
+        benchmark.set_up_compare(self.resources_obj, self.source_dir,
+                                 self.target_dir,
+                                 os.path.join(self.temp_dir.name, "unused"))
+        findDuplicates.results_log.close()
+        findDuplicates.errors_log.close()
+
+        results_position = None
+        errors_position = None
+        if position is not None:
+            results_position, errors_position = position
+        findDuplicates.results_log = findDuplicates.create_duplicates_log(
+            log_file, position=results_position)
+        findDuplicates.errors_log = findDuplicates.create_error_log(
+            log_file, errors_position)
+
+    # --------------------------------------------------------------------------
+    def new_scans(self):
+
+        return [ScanDirectory(self.source_dir, self.resources_obj,
+                              type_is_source=True),
+                ScanDirectory(self.target_dir, self.resources_obj,
+                              type_is_source=False)]
+
+    # --------------------------------------------------------------------------
+    def read_log(self, log_file):
+
+        with open(log_file, "r") as file_obj:
+            return sorted(file_obj.read().split("\n"))
+
+    # --------------------------------------------------------------------------
+    def test_resumed_run_matches_uninterrupted_run(self):
+
+        # A run that is never interrupted
+        log_file = os.path.join(self.temp_dir.name, "uninterrupted.log")
+        self.set_up(log_file)
+        source_obj, target_obj = self.new_scans()
+        source_obj.scan()
+        target_obj.scan()
+        findDuplicates.prune_unmatched_sizes(source_obj, target_obj)
+        expected_counts = findDuplicates.do_compare(source_obj, target_obj)
+        findDuplicates.results_log.close()
+        findDuplicates.errors_log.close()
+
+        # A run that saves a checkpoint after every chunk, and dies part way
+        # through writing its results
+        log_file = os.path.join(self.temp_dir.name, "resumed.log")
+        self.set_up(log_file)
+        findDuplicates.settings.checkpoint_interval = 0
+        checkpoint_obj = Checkpoint(log_file + ".checkpoint",
+                                    findDuplicates.checkpoint_key())
+        source_obj, target_obj = self.new_scans()
+        source_obj.scan()
+        target_obj.scan()
+        pruned = findDuplicates.prune_unmatched_sizes(source_obj, target_obj)
+        checkpoint_obj.save_scan({
+            "overlap": None,
+            "source": source_obj.get_state(),
+            "target": target_obj.get_state(),
+            "scanned_bytes": 0,
+            "pruned": pruned,
+        })
+        findDuplicates.save_progress(checkpoint_obj, -1, (0, 0, 0, 0))
+
+        write_result = findDuplicates.write_result
+        written = list()
+
+        def dying_write_result(*args):
+            if len(written) == 7:
+                raise RuntimeError("died")
+            written.append(args)
+            write_result(*args)
+
+        findDuplicates.write_result = dying_write_result
+        with self.assertRaises(RuntimeError):
+            findDuplicates.do_compare(source_obj, target_obj,
+                                      checkpoint_obj=checkpoint_obj)
+        findDuplicates.write_result = write_result
+
+        # Whatever was still held in memory is lost
+        findDuplicates.results_log.file_obj.close()
+        findDuplicates.errors_log.close()
+
+        # Resume from the checkpoint, which must be part way through
+        scan_state, progress_state = checkpoint_obj.load()
+        self.assertGreater(progress_state["done_up_to"], -1)
+        self.set_up(log_file, (progress_state["results_position"],
+                               progress_state["errors_position"]))
+        source_obj, target_obj = self.new_scans()
+        source_obj.set_state(scan_state["source"])
+        target_obj.set_state(scan_state["target"])
+        counts = findDuplicates.do_compare(source_obj, target_obj,
+                                           checkpoint_obj=checkpoint_obj,
+                                           progress_state=progress_state)
+        findDuplicates.results_log.close()
+        findDuplicates.errors_log.close()
+
+        self.assertEqual(counts, expected_counts)
+        self.assertEqual(counts[0], 6)
+        self.assertEqual(
+            self.read_log(log_file),
+            self.read_log(os.path.join(self.temp_dir.name,
+                                       "uninterrupted.log")))
+
+
+if __name__ == "__main__":
+    unittest.main()
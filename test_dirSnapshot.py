@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import benchmark
+from dirSnapshot import DirSnapshot
+from scanDirectory import ScanDirectory
+
+
+class DirSnapshotTest(unittest.TestCase):
+    """
+    Tests for DirSnapshot, and for reusing snapshots in ScanDirectory.
+    """
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.resources_obj = benchmark.read_resources()
+        self.scan_dir = os.path.join(self.temp_dir.name, "scan")
+        self.snapshot_dir = os.path.join(self.temp_dir.name, "snapshots")
+
+        for name in ["a", "sub/b", "sub/deeper/c"]:
+            self.write_file(name, b"contents of " + name.encode("utf-8"))
+
+    # --------------------------------------------------------------------------
+    def write_file(self, name, contents):
+
+        file_path = os.path.join(self.scan_dir, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file_obj:
+            file_obj.write(contents)
+
+    # --------------------------------------------------------------------------
+    def scan(self):
+        """
+        Scans the directory using the snapshots, and returns the scan object.
+        """
+
+        scan_obj = ScanDirectory(self.scan_dir, self.resources_obj,
+                                 snapshot_dir=self.snapshot_dir)
+        scan_obj.scan()
+        return scan_obj
+
+    # --------------------------------------------------------------------------
+    def scanned_paths(self, scan_obj):
+
+        return sorted([file_path for index, file_path, file_size
+                       in scan_obj.files.iter_files()])
+
+    # --------------------------------------------------------------------------
+    def change_mtime(self, dir_path):
+
+        dir_stat = os.stat(dir_path)
+        os.utime(dir_path, ns=(dir_stat.st_atime_ns,
+                               dir_stat.st_mtime_ns + 1000000000))
+
+    # --------------------------------------------------------------------------
+    def test_get(self):
+
+        files = [("a", os.path.join("d", "a"), 10, 1, 2, 3)]
+        listing = (files, [os.path.join("d", "sub")], 1, {"hidden": 1})
+        snapshot = DirSnapshot()
+        snapshot.add("d", 100, listing)
+
+        self.assertEqual(snapshot.get("d", 100), listing)
+        self.assertIsNone(snapshot.get("d", 101))
+        self.assertIsNone(snapshot.get("other", 100))
+
+    # --------------------------------------------------------------------------
+    def test_reuses_unmodified_directories(self):
+
+        first_scan = self.scan()
+        self.assertEqual(first_scan.reused_count, 0)
+
+        second_scan = self.scan()
+        self.assertEqual(second_scan.reused_count, 3)
+        self.assertEqual(self.scanned_paths(second_scan),
+                         self.scanned_paths(first_scan))
+
+    # --------------------------------------------------------------------------
+    def test_rereads_modified_directories(self):
+
+        self.scan()
+
+        # A new file changes the modification time of its directory, but the
+        # time is also set forward to make sure it differs.
+        self.write_file("sub/new", b"new")
+        self.change_mtime(os.path.join(self.scan_dir, "sub"))
+
+        scan_obj = self.scan()
+        self.assertEqual(scan_obj.reused_count, 2)
+        self.assertIn(os.path.join(self.scan_dir, "sub", "new"),
+                      self.scanned_paths(scan_obj))
+
+    # --------------------------------------------------------------------------
+    @unittest.skipUnless(hasattr(os, "getuid"), "needs os.getuid")
+    def test_ignores_snapshots_owned_by_another_user(self):
+
+        self.scan()
+
+        # Pretend to be a different user from the one who wrote the snapshot
+        getuid = os.getuid
+        self.addCleanup(setattr, os, "getuid", getuid)
+        os.getuid = lambda: getuid() + 1
+
+        scan_obj = self.scan()
+        self.assertEqual(scan_obj.reused_count, 0)
+        self.assertEqual(len(self.scanned_paths(scan_obj)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
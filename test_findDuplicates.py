@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import benchmark
+import findDuplicates
+from scanDirectory import ScanDirectory
+
+
+class StreamGroupsTest(unittest.TestCase):
+    """
+    Tests for findDuplicates.stream_groups.
+    """
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        benchmark.set_up_compare(benchmark.read_resources(), self.temp_dir.name,
+                                 self.temp_dir.name,
+                                 os.path.join(self.temp_dir.name, "results"))
+        self.addCleanup(findDuplicates.results_log.close)
+        self.addCleanup(findDuplicates.errors_log.close)
+
+    # --------------------------------------------------------------------------
+    def write_file(self, name, contents):
+
+        file_path = os.path.join(self.temp_dir.name, name)
+        with open(file_path, "wb") as file_obj:
+            file_obj.write(contents)
+        return file_path
+
+    # --------------------------------------------------------------------------
+    def test_hardlinked_pair_next_to_a_different_file(self):
+
+        other_path = self.write_file("other.bin", b"a" * 4096)
+        source_path = self.write_file("source.bin", b"b" * 4096)
+        target_path = os.path.join(self.temp_dir.name, "target.bin")
+        os.link(source_path, target_path)
+
+        other_inode = (os.stat(other_path).st_dev, os.stat(other_path).st_ino)
+        source_inode = (os.stat(source_path).st_dev,
+                        os.stat(source_path).st_ino)
+        group = [(other_path, None, True, other_inode),
+                 (target_path, None, True, source_inode),
+                 (source_path, 0, False, source_inode)]
+
+        identical_groups, failed_groups = findDuplicates.stream_groups(
+            [(4096, group)])
+
+        self.assertEqual(failed_groups, [])
+        self.assertEqual(identical_groups, [(4096, group[1:])])
+        self.assertEqual(findDuplicates.digest_memo, dict())
+
+
+
+# ==============================================================================
+class FindDuplicateGroupsTest(unittest.TestCase):
+    """
+    Tests for the size, partial digest and full digest stages of the compare.
+    """
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.resources_obj = benchmark.read_resources()
+        benchmark.set_up_compare(self.resources_obj, self.temp_dir.name,
+                                 self.temp_dir.name,
+                                 os.path.join(self.temp_dir.name, "results"))
+        self.addCleanup(findDuplicates.results_log.close)
+        self.addCleanup(findDuplicates.errors_log.close)
+
+        # Go straight from the partial digest to the full digest
+        findDuplicates.settings.sample_count = 0
+        findDuplicates.settings.stream_max_files = 0
+
+    # --------------------------------------------------------------------------
+    def write_file(self, name, contents):
+
+        file_path = os.path.join(self.temp_dir.name, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file_obj:
+            file_obj.write(contents)
+        return file_path
+
+    # --------------------------------------------------------------------------
+    def member(self, file_path, source_index=None):
+
+        file_stat = os.stat(file_path)
+        return (file_path, source_index, source_index is None,
+                (file_stat.st_dev, file_stat.st_ino))
+
+    # --------------------------------------------------------------------------
+    def test_refine_groups(self):
+
+        contents = b"a" * 4096
+        source = self.member(self.write_file("a", contents), 0)
+        copy = self.member(self.write_file("b", contents))
+        head_differs = self.member(self.write_file("c", b"c" + contents[1:]))
+        tail_differs = self.member(self.write_file("d", contents[:-1] + b"d"))
+        missing_path = os.path.join(self.temp_dir.name, "e")
+        missing = (missing_path, None, True, (0, 0))
+        groups = [(4096, [source, copy, head_differs, missing, tail_differs])]
+
+        errors = dict()
+        groups = findDuplicates.refine_groups(
+            groups, findDuplicates.partial_digests, errors)
+        self.assertEqual(groups, [(4096, [source, copy, tail_differs])])
+        self.assertEqual(list(errors.keys()), [missing_path])
+
+        groups = findDuplicates.refine_groups(
+            groups, findDuplicates.full_digests, errors)
+        self.assertEqual(groups, [(4096, [source, copy])])
+
+    # --------------------------------------------------------------------------
+    def test_find_duplicate_groups(self):
+
+        contents = b"a" * 4096
+        source_path = self.write_file("source/a", contents)
+        self.write_file("source/unique_size", b"x" * 100)
+        copy_path = self.write_file("target/b", contents)
+        self.write_file("target/c", b"c" + contents[1:])
+        self.write_file("target/d", contents[:-1] + b"d")
+        deleted_path = self.write_file("target/e", contents)
+
+        scans = list()
+        for name, is_source in [("source", True), ("target", False)]:
+            scan_obj = ScanDirectory(os.path.join(self.temp_dir.name, name),
+                                     self.resources_obj,
+                                     type_is_source=is_source)
+            scan_obj.scan()
+            scans.append(scan_obj)
+
+        # A file that goes away after the scan is an error in the middle of
+        # its group, and the rest of the group is still compared
+        os.remove(deleted_path)
+
+        errors = dict()
+        groups = list(findDuplicates.find_duplicate_groups(scans[0], scans[1],
+                                                           errors))
+
+        self.assertEqual(len(groups), 1)
+        file_size, group = groups[0]
+        self.assertEqual(file_size, 4096)
+        self.assertEqual(sorted([member[0] for member in group]),
+                         [source_path, copy_path])
+        self.assertEqual(list(errors.keys()), [deleted_path])
+
+
+# ==============================================================================
+class DropNestedDirsTest(unittest.TestCase):
+    """
+    Tests for findDuplicates.drop_nested_dirs.
+    """
+
+    # --------------------------------------------------------------------------
+    def test_reports_the_directory_that_is_kept(self):
+
+        kept, dropped = findDuplicates.drop_nested_dirs(["t/a/b", "t/a", "t"])
+
+        self.assertEqual(kept, ["t"])
+        self.assertEqual(dropped, [("t/a/b", "t"), ("t/a", "t")])
+
+    # --------------------------------------------------------------------------
+    def test_keeps_the_first_of_the_same_directory(self):
+
+        kept, dropped = findDuplicates.drop_nested_dirs(["t", "x", "t/"])
+
+        self.assertEqual(kept, ["t", "x"])
+        self.assertEqual(dropped, [("t/", "t")])
+
+
+# ==============================================================================
+class CompareTest(unittest.TestCase):
+    """
+    Tests that run findDuplicates.py from the command line.
+    """
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    # --------------------------------------------------------------------------
+    def write_file(self, name, contents):
+
+        file_path = os.path.join(self.temp_dir.name, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file_obj:
+            file_obj.write(contents)
+        return file_path
+
+    # --------------------------------------------------------------------------
+    def run_compare(self, *args):
+        """
+        Runs a compare and returns the result lines of its log, sorted.
+        """
+
+        log_file = os.path.join(self.temp_dir.name, "results.log")
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "findDuplicates.py")
+        subprocess.run([sys.executable, script, "-g", log_file, "-o",
+                        "--no-digest-cache"] + list(args),
+                       check=True, stdout=subprocess.DEVNULL)
+
+        # The header ends in a literal backslash-n, so the first result shares
+        # its line
+        with open(log_file, "r") as file_obj:
+            lines = file_obj.read().split("\n")
+        return sorted([line[line.index("RESULT\t"):] for line in lines
+                       if "RESULT\t" in line])
+
+    # --------------------------------------------------------------------------
+    def test_source_is_also_one_of_several_targets(self):
+
+        source_dir = os.path.join(self.temp_dir.name, "X")
+        other_dir = os.path.join(self.temp_dir.name, "Y")
+        self.write_file("X/a", b"same")
+        self.write_file("X/sub/b", b"same")
+        self.write_file("Y/c", b"same")
+
+        for target_dir in [source_dir, os.path.join(source_dir, "sub")]:
+            lines = self.run_compare("-s", source_dir, "-t", target_dir,
+                                     "-t", other_dir)
+            self.assertEqual(len(lines), 1)
+            self.assertIn(os.path.join(source_dir, "a"), lines[0])
+            self.assertIn(os.path.join(other_dir, "c"), lines[0])
+
+
+    # --------------------------------------------------------------------------
+    def test_file_whose_only_match_is_a_hardlink(self):
+
+        source_path = self.write_file("source/a", b"linked")
+        os.makedirs(os.path.join(self.temp_dir.name, "target"))
+        os.link(source_path, os.path.join(self.temp_dir.name, "target", "b"))
+
+        lines = self.run_compare("-s", os.path.dirname(source_path),
+                                 "-t", os.path.join(self.temp_dir.name,
+                                                    "target"))
+
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("RESULT\t\tHARDLINK\t"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+#! /usr/bin/env python3
+
+import unittest
+
+import lib
+
+
+class ParseListTest(unittest.TestCase):
+    """
+    Tests for lib.parse_list.
+    """
+
+    # --------------------------------------------------------------------------
+    def test_lists(self):
+
+        self.assertEqual(lib.parse_list("['a', 'b']"), ["a", "b"])
+        self.assertEqual(lib.parse_list('"a","b"'), ["a", "b"])
+        self.assertEqual(lib.parse_list("a"), ["a"])
+
+    # --------------------------------------------------------------------------
+    def test_values_that_only_look_like_lists(self):
+
+        self.assertEqual(lib.parse_list("[old"), ["[old"])
+        self.assertEqual(lib.parse_list("[photos]"), ["[photos]"])
+        self.assertEqual(lib.parse_list("'unterminated"), ["'unterminated"])
+
+
+if __name__ == "__main__":
+    unittest.main()
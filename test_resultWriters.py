@@ -0,0 +1,38 @@
+#! /usr/bin/env python3
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from resultWriters import new_result_writer
+
+
+class SqliteResultWriterTest(unittest.TestCase):
+    """
+    Tests for resultWriters.SqliteResultWriter.
+    """
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.file_name = os.path.join(self.temp_dir.name, "results.log")
+
+    # --------------------------------------------------------------------------
+    def test_replaces_a_file_that_is_not_a_database(self):
+
+        with open(self.file_name, "w") as file_obj:
+            file_obj.write("DUPLICATE\t/a\t1\tFalse\n")
+
+        new_result_writer("sqlite", self.file_name).close()
+
+        connection = sqlite3.connect(self.file_name)
+        self.addCleanup(connection.close)
+        self.assertEqual(
+            connection.execute("SELECT COUNT(*) FROM results").fetchone(), (0,))
+
+
+if __name__ == "__main__":
+    unittest.main()